@@ -1,7 +1,7 @@
 import json
 import os
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
 from controllers.attendance_controller import AttendanceController
@@ -10,7 +10,15 @@ from controllers.sample_controller import SampleController
 from controllers.user_controller import UserController
 from services.network_service import NetworkService
 
+from db.admission import AdmissionGate
+from db.cache import QueryCache
+from db.config import PoolConfig
 from db.database import Database
+from db.jobs import JobQueue
+from db.limits import QueryLimits
+from db.notifications import AttendanceFeed
+from db.shards import ShardRouter
+from db.slow_log import SlowQueryLog
 from services.auth import AuthService
 
 
@@ -18,6 +26,15 @@ from services.auth import AuthService
 app = Flask(__name__)
 CORS(app)
 
+# statement_timeout (ms) of routes that need a different bound than
+# DB_STATEMENT_TIMEOUT_MS
+ROUTE_STATEMENT_TIMEOUTS_MS = {
+    'check_in': 200,
+    'check_in_batch': 500,
+    'rsvp': 200,
+    'unrsvp': 200,
+}
+
 
 # Error handling
 @app.errorhandler(HTTPException)
@@ -48,6 +65,16 @@ def health():
     return jsonify(status='UP', commit_id=commit_id)
 
 
+@app.route('/health/db')
+def health_db():
+    """Returns connection pool statistics of this worker."""
+    stats = app.ctx.db.get_pool_stats()
+    if app.ctx.admission is not None:
+        stats['admission'] = app.ctx.admission.to_dict()
+    stats['stream'] = app.ctx.feed.to_dict()
+    return jsonify(stats)
+
+
 @app.route('/signin', methods=['POST'])
 def signin():
     """POST /signin"""
@@ -118,6 +145,16 @@ def get_event(event_id):
 @app.route('/events/<event_id>/attendances')
 def get_attendances(event_id):
     """GET /events/<event_id>/attendances"""
+    if 'limit' in request.args or 'cursor' in request.args:
+        # Paginated: {"attendances": [...], "next_cursor": "..."}
+        return jsonify(app.ctx.attendance.get_attendance_page(
+            event_id,  # "abcdefghijklmn"
+            request.args.get('is_invited'),
+            request.args.get('is_rsvped'),
+            request.args.get('is_checked_in'),
+            request.args.get('limit'),  # 100
+            request.args.get('cursor'),  # next_cursor of the last page
+        ))
     return jsonify(app.ctx.attendance.get_attendances(
         event_id,  # "abcdefghijklmn"
         request.args.get('is_invited'),
@@ -126,15 +163,36 @@ def get_attendances(event_id):
     ))
 
 
+@app.route('/events/<event_id>/stats')
+def get_event_stats(event_id):
+    """GET /events/<event_id>/stats"""
+    return jsonify(app.ctx.attendance.get_stats(
+        event_id,  # "abcdefghijklmn"
+    ))
+
+
 @app.route('/events/<event_id>/invite', methods=['POST'])
 def invite(event_id):
     """POST /events/<event_id>/invite"""
     app.ctx.auth.verify_request(request.headers,
                                 app.ctx.event.get_organizer_id(event_id))
     emails = request.json.get('emails')
-    return jsonify(app.ctx.attendance.invite(
+    summary = app.ctx.attendance.invite(
         event_id,  # "abcdefghijklmn"
         emails,  # ["abc@abc.com", "def@def.com"]
+    )
+    # 202: the emails are sent by worker.py; poll the job for progress
+    return jsonify(summary), 202 if summary['job_id'] is not None else 200
+
+
+@app.route('/events/<event_id>/invite/<int:job_id>')
+def get_invite_progress(event_id, job_id):
+    """GET /events/<event_id>/invite/<job_id>"""
+    app.ctx.auth.verify_request(request.headers,
+                                app.ctx.event.get_organizer_id(event_id))
+    return jsonify(app.ctx.attendance.get_invite_progress(
+        event_id,  # "abcdefghijklmn"
+        job_id,  # 42
     ))
 
 
@@ -165,6 +223,63 @@ def check_in(event_id, personal_code):
     ))
 
 
+@app.route('/events/<event_id>/check_in', methods=['POST'])
+def check_in_batch(event_id):
+    """POST /events/<event_id>/check_in"""
+    app.ctx.auth.verify_request(request.headers,
+                                app.ctx.event.get_organizer_id(event_id))
+    return jsonify(app.ctx.attendance.check_in_batch(
+        event_id,  # "abcdefghijklmn"
+        request.json.get('personal_codes'),  # ["abcdefghijklmn", ...]
+    ))
+
+
+@app.route('/events/<event_id>/roster')
+def get_roster(event_id):
+    """GET /events/<event_id>/roster"""
+    app.ctx.auth.verify_request(request.headers,
+                                app.ctx.event.get_organizer_id(event_id))
+    # Devices send back the ETag of their snapshot; 304 if still current
+    version = app.ctx.attendance.get_roster_version(event_id)
+    if request.if_none_match.contains(str(version)):
+        return '', 304, {'ETag': f'"{version}"'}
+    response = jsonify(app.ctx.attendance.get_roster(
+        event_id,  # "abcdefghijklmn"
+        version,
+    ))
+    response.set_etag(str(version))
+    return response
+
+
+@app.route('/events/<event_id>/roster/sync', methods=['POST'])
+def sync_check_ins(event_id):
+    """POST /events/<event_id>/roster/sync"""
+    app.ctx.auth.verify_request(request.headers,
+                                app.ctx.event.get_organizer_id(event_id))
+    return jsonify(app.ctx.attendance.sync_check_ins(
+        event_id,  # "abcdefghijklmn"
+        request.json.get('check_ins'),  # [{"personal_code": ..., ...}]
+    ))
+
+
+@app.route('/events/<event_id>/stream')
+def stream_attendances(event_id):
+    """GET /events/<event_id>/stream (Server-Sent Events)"""
+    app.ctx.event.get_event(event_id)  # 400 for unknown events
+    subscription = app.ctx.feed.subscribe(
+        app.ctx.db.use_shard(event_id=event_id), event_id)
+    # Not stream_with_context: the request's connection and admission
+    # slot are released before streaming starts
+    response = Response(app.ctx.feed.stream(subscription),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 # Keeps nginx from buffering the events
+                                 'X-Accel-Buffering': 'no'})
+    # Also unsubscribes a client that left before the stream started
+    response.call_on_close(lambda: app.ctx.feed.unsubscribe(subscription))
+    return response
+
+
 @app.route('/sample/users')
 def get_sample_users():
     return jsonify(app.ctx.sample.get_sample_users())
@@ -181,18 +296,71 @@ def create_sample_user():
 
 class Context:
     def __init__(self):
-        pool = Database.get_connection('postgresql://postgres@db:5432/aapi')
-        requests = NetworkService()
-        self.db = Database(pool)
+        limits = QueryLimits.from_env(ROUTE_STATEMENT_TIMEOUTS_MS)
+        primary = PoolConfig.from_env(name='primary')
+        pool = Database.get_connection(primary,
+                                       statement_timeout_ms=(
+                                           limits.statement_timeout_ms))
+        replica = None
+        if os.getenv('DATABASE_REPLICA_URL'):
+            replica = Database.get_connection(
+                PoolConfig.from_env('DATABASE_REPLICA_URL', 'DB_REPLICA_POOL',
+                                    name='replica'),
+                read_only=True,
+                statement_timeout_ms=limits.statement_timeout_ms)
+        shard_pools = []
+        shard_urls = [url.strip() for url in os.getenv(
+            'DATABASE_SHARD_URLS', default='').split(',') if url.strip()]
+        for number, url in enumerate(shard_urls, start=1):
+            # Shards 1..n; DATABASE_URL is shard 0. Sized like it.
+            config = PoolConfig.from_env(name=f'shard{number}')
+            config.conninfo = url
+            shard_pools.append(Database.get_connection(
+                config, statement_timeout_ms=limits.statement_timeout_ms))
+        # LISTEN connections of the live attendance streams, by shard
+        self.feed = AttendanceFeed.from_env([primary.conninfo] + shard_urls)
+        lanes = {}
+        if os.getenv('DB_BULK_POOL_MAX_SIZE'):
+            # Separate connections for bulk work (Database.lane)
+            lanes[Database.BULK] = Database.get_connection(
+                PoolConfig.from_env(prefix='DB_BULK_POOL', name='bulk'),
+                statement_timeout_ms=limits.statement_timeout_ms)
+        # One pooled HTTP client for Google and Mailgun calls
+        requests = NetworkService.from_env()
+        self.db = Database(pool, SlowQueryLog.from_env(), replica,
+                           float(os.getenv('DB_READ_YOUR_WRITES_SECONDS',
+                                           default=5.0)),
+                           QueryCache.from_env(),
+                           float(os.getenv('DB_POOL_CHECKOUT_TIMEOUT',
+                                           default=2.0)),
+                           int(os.getenv('RETRY_AFTER_SECONDS', default=1)),
+                           limits,
+                           ShardRouter.from_env(shard_pools),
+                           lanes)
+        self.admission = AdmissionGate.from_env()
         self.auth = AuthService(os.getenv("AUTH_KEY"))
-        self.attendance = AttendanceController(self.db)
-        self.event = EventController(self.db)
+        self.jobs = JobQueue.from_env(self.db)
+        code_key = os.getenv('PERSONAL_CODE_KEY')
+        if not code_key:
+            # Without a secret, anyone could derive any attendee's code
+            raise ValueError('PERSONAL_CODE_KEY must be set')
+        self.attendance = AttendanceController(self.db, self.jobs, requests,
+                                               code_key)
+        self.event = EventController(self.db, requests)
         self.user = UserController(self.db, self.auth, requests)
         self.sample = SampleController(self.db)
 
 
 def init(app):
     app.ctx = Context()
+    if app.ctx.admission is not None:
+        # Before the db hooks, so shed requests never hold a connection
+        app.ctx.admission.init_app(app)
+    app.ctx.db.init_app(app,
+                        os.getenv('DB_REQUEST_SCOPED_CONNECTION',
+                                  default='false') == 'true',
+                        os.getenv('DB_QUERY_COUNTER',
+                                  default='false') == 'true')
 
 
 if __name__ == '__main__':
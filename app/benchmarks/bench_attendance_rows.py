@@ -0,0 +1,66 @@
+"""
+Benchmarks the row -> JSON-ready dict path of
+AttendanceController.get_attendances, without a database.
+
+    $ python benchmarks/bench_attendance_rows.py [rows]
+
+"before" is the old path: dict_row dicts copied into Attendance objects and
+copied again by to_dict(). "after" is the current path: tuple rows
+serialized straight to dicts by Attendance.rows_to_dicts().
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from models.attendance import Attendance  # noqa: E402
+
+
+def make_tuple_rows(n):
+    now = datetime.now(timezone.utc)
+    return [('abcdefghijklmn', f'attendee{i}@example.com', 'attendee',
+             f'{i:032x}', True, i % 2 == 0, i % 3 == 0, now, now)
+            for i in range(n)]
+
+
+def before(rows):
+    # what psycopg's dict_row builds, then the per-row object + to_dict()
+    dict_rows = [dict(zip(Attendance.FIELDS, r)) for r in rows]
+    return [Attendance(att["event_id"], att["user_email"],
+                       att["user_role"], att["personal_code"],
+                       att["is_invited"], att["is_rsvped"],
+                       att["is_checked_in"], att["created_at"],
+                       att["updated_at"]).to_dict()
+            for att in dict_rows]
+
+
+def after(rows):
+    return Attendance.rows_to_dicts(rows)
+
+
+def measure(fn, rows, repeat=5):
+    # timed without tracemalloc, which slows allocations down
+    elapsed = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(rows)
+        elapsed = min(elapsed, time.perf_counter() - start)
+        assert len(result) == len(rows)
+        del result
+    tracemalloc.start()
+    fn(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rows = make_tuple_rows(n)
+    for name, fn in (('before', before), ('after', after)):
+        elapsed, peak = measure(fn, rows)
+        print(f'{name:>6}: {n} rows, {elapsed / n * 1e6:.2f} us/row, '
+              f'peak {peak / 1024 / 1024:.1f} MiB')
@@ -1,15 +1,48 @@
+from db import queries
 from db.database import Database
+from db.jobs import JobQueue
 from flask import abort
 import requests
+import base64
+import binascii
 import json
+import logging
 import os
-from psycopg.errors import ForeignKeyViolation, UniqueViolation
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from psycopg import DatabaseError
+from psycopg.rows import tuple_row
 from models.attendance import Attendance
+from services.network_service import NetworkService
+
+logger = logging.getLogger(__name__)
 
 
 class AttendanceController():
-    def __init__(self, db: Database):
+    # Emails per INSERT statement of a bulk invite
+    INVITE_CHUNK_SIZE = 1000
+    # Personal codes per check_in_batch request
+    CHECK_IN_BATCH_SIZE = 1000
+    # Offline check-ins per sync request, and per statement
+    SYNC_MAX_CHECK_INS = 20000
+    SYNC_BATCH_SIZE = 1000
+    # Largest page of get_attendance_page
+    MAX_PAGE_SIZE = 1000
+    # Recipients per Mailgun call, its batch sending limit
+    MAILGUN_BATCH_SIZE = 1000
+    MAILGUN_DOMAIN = "team-aapi.me"
+    EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+    def __init__(self, db: Database, jobs: Optional[JobQueue] = None,
+                 req: Optional[NetworkService] = None,
+                 code_key: Optional[str] = None):
         self.db = db
+        self.jobs = jobs if jobs is not None else JobQueue(db)
+        self.requests = req if req is not None else NetworkService()
+        # Secret of the personal codes (PERSONAL_CODE_KEY); invite fails
+        # without one
+        self.code_key = (code_key or '').encode('utf-8')
 
     def get_attendances(self, event_id: str, invited=None, rsvped=None,
                         checked_in=None) -> list:
@@ -24,7 +57,62 @@ class AttendanceController():
         """
         if not event_id:
             return abort(400, "Missing event_id..")
-        statement = "SELECT * FROM Attendance WHERE event_id = %s"
+        statement, param = self._filter_attendances(event_id, invited,
+                                                    rsvped, checked_in)
+        # Bulk read: tuple rows serialized straight to dicts, skipping the
+        # dict_row and Attendance copies
+        attendances = self.db.get(statement, param, row_factory=tuple_row)
+        return Attendance.rows_to_dicts(attendances)
+
+    def get_attendance_page(self, event_id: str, invited=None, rsvped=None,
+                            checked_in=None, limit=None,
+                            cursor: str = None) -> dict:
+        """
+        @param: event_id: str, required,
+        @param: invited: bool,
+        @param: rsvped: bool,
+        @param: checked_in: bool,
+        @param: limit: int, page size, at most MAX_PAGE_SIZE (the default),
+        @param: cursor: str, next_cursor of the previous page
+        @return: {attendances: page of satisfying attendances ordered by
+                  user_email, next_cursor: cursor of the next page or None}
+
+        Keyset pagination: a page starts after the user_email in the
+        cursor, so every page costs the same index range scan however far
+        into the list it is.
+        """
+        if not event_id:
+            return abort(400, "Missing event_id..")
+        try:
+            limit = self.MAX_PAGE_SIZE if limit is None else int(limit)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.MAX_PAGE_SIZE:
+            return abort(400, "The input limit must be between 1 and "
+                              f"{self.MAX_PAGE_SIZE}..")
+        statement, param = self._filter_attendances(event_id, invited,
+                                                    rsvped, checked_in)
+        if cursor:
+            statement += " AND user_email > %s"
+            param.append(self.decode_cursor(cursor))
+        # One extra row tells whether there is a next page
+        statement += " ORDER BY user_email LIMIT %s"
+        param.append(limit + 1)
+        rows = self.db.get(statement, param, row_factory=tuple_row)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(
+                rows[-1][Attendance.FIELDS.index('user_email')])
+        return {
+            'attendances': Attendance.rows_to_dicts(rows),
+            'next_cursor': next_cursor,
+        }
+
+    @staticmethod
+    def _filter_attendances(event_id: str, invited, rsvped,
+                            checked_in) -> Tuple[str, list]:
+        statement = queries.ATTENDANCES_BY_EVENT
         param = [event_id]
         if invited is not None:
             statement += " AND is_invited = %s"
@@ -35,15 +123,58 @@ class AttendanceController():
         if checked_in is not None:
             statement += " AND is_checked_in = %s"
             param.append(checked_in)
-        attendances = self.db.get(statement, param)
-        resp = []
-        for att in attendances:
-            resp.append(Attendance(att["event_id"], att["user_email"],
-                                   att["user_role"], att["personal_code"],
-                                   att["is_invited"], att["is_rsvped"],
-                                   att["is_checked_in"], att["created_at"],
-                                   att["updated_at"]).to_dict())
-        return resp
+        return statement, param
+
+    @staticmethod
+    def encode_cursor(user_email: str) -> str:
+        return base64.urlsafe_b64encode(
+            user_email.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> str:
+        try:
+            return base64.b64decode(cursor + '=' * (-len(cursor) % 4),
+                                    altchars=b'-_',
+                                    validate=True).decode('utf-8')
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            return abort(400, "The input cursor is invalid..")
+
+    def get_stats(self, event_id: str) -> dict:
+        """
+        @param: event_id: str, required
+        @return: numbers of attendances, invited, rsvped and checked in
+
+        Reads the counters kept by the Attendance triggers, so the cost
+        does not grow with the number of attendees.
+        """
+        if not event_id:
+            return abort(400, "Missing event_id..")
+        stats = self.db.get_one(queries.EVENT_STATS, [event_id])
+        if not stats:
+            return abort(400, "The input event_id is invalid..")
+        return stats
+
+    def rebuild_stats(self, event_id: str) -> dict:
+        """
+        @param: event_id: str, required
+        @return: the counters before and after, and whether they matched
+
+        Consistency check: recounts the event's attendances and overwrites
+        its counters. The counters row is locked first, so writes made
+        meanwhile are neither lost nor counted twice.
+        """
+        with self.db.transaction():
+            before = self.db.get_one(queries.LOCK_EVENT_STATS, [event_id])
+            after = self.db.set_returning(queries.REBUILD_EVENT_STATS,
+                                          [event_id, event_id])
+        before = dict(before) if before else {
+            'total': 0, 'invited': 0, 'rsvped': 0, 'checked_in': 0}
+        return {
+            'event_id': event_id,
+            'before': before,
+            'after': dict(after),
+            'consistent': dict(after) == before,
+        }
 
     def check_in(self, event_id: str, personal_code: str) -> dict:
         '''
@@ -57,86 +188,298 @@ class AttendanceController():
         '''
         if not event_id or not personal_code:
             return abort(400, "Missing event_id or personal_code..")
-        query = """
-                SELECT * FROM Attendance WHERE event_id = %s
-                AND personal_code = %s
-                """
-        param = [event_id, personal_code]
-        exist = self.db.get_one(query, param)
-        if not exist:
-            return abort(400, "The input event_id-personal_code \
-                               combination is invalid..")
-        try:
-            statement = "UPDATE Attendance \
-                         SET is_checked_in = True \
-                         WHERE event_id = %s \
-                         AND personal_code = %s"
-            self.db.set(statement, param)
-        except (ForeignKeyViolation, UniqueViolation) as e:
-            abort(400, e)
-
-        updated = self.db.get_one(query, param)
+        # One round trip: no row back means the code is invalid
+        updated = self.db.set_returning(queries.CHECK_IN,
+                                        [event_id, personal_code])
         if not updated:
             return abort(400, "The input event_id-personal_code \
                                combination is invalid..")
+        return Attendance.row_to_dict(updated)
+
+    def check_in_batch(self, event_id: str, personal_codes: list) -> dict:
+        '''
+        @param: event_id: str, required,
+        @param: personal_codes: list, required, at most CHECK_IN_BATCH_SIZE
+        @return: counts and the result of every code, in request order:
+                 checked_in, already_checked_in or invalid
 
-        return Attendance(updated["event_id"], updated["user_email"],
-                          updated["user_role"], updated["personal_code"],
-                          updated["is_invited"], updated["is_rsvped"],
-                          updated["is_checked_in"], updated["created_at"],
-                          updated["updated_at"]).to_dict()
+        Intended for door scanners flushing queued scans: the whole batch
+        is applied by one UPDATE.
+        '''
+        if not event_id:
+            return abort(400, "Missing event_id..")
+        if not isinstance(personal_codes, list) or not personal_codes or \
+                not all(isinstance(code, str) and code
+                        for code in personal_codes):
+            return abort(400, "Missing personal_codes..")
+        if len(personal_codes) > self.CHECK_IN_BATCH_SIZE:
+            return abort(400, "At most "
+                              f"{self.CHECK_IN_BATCH_SIZE} personal_codes "
+                              "per request..")
+        rows = self.db.set_returning(queries.CHECK_IN_BATCH,
+                                     [personal_codes, event_id, event_id],
+                                     one=False)
+        by_code = {row['personal_code']: row['result'] for row in rows}
+        results = [{'personal_code': code,
+                    'result': by_code.get(code, 'invalid')}
+                   for code in personal_codes]
+        summary = {'event_id': event_id, 'checked_in': 0,
+                   'already_checked_in': 0, 'invalid': 0}
+        for result in results:
+            summary[result['result']] += 1
+        summary['results'] = results
+        return summary
+
+    def get_roster_version(self, event_id: str) -> int:
+        '''
+        @param: event_id: str, required
+        @return: version of the event's roster, changed by every write to
+                 its attendances
+        '''
+        if not event_id:
+            return abort(400, "Missing event_id..")
+        row = self.db.get_one(queries.ROSTER_VERSION, [event_id])
+        if not row:
+            return abort(400, "The input event_id is invalid..")
+        return row['version']
+
+    def get_roster(self, event_id: str, version: int = None) -> dict:
+        '''
+        @param: event_id: str, required,
+        @param: version: int, from get_roster_version, if already known
+        @return: snapshot of the roster for an offline check-in device:
+                 {event_id, version, fields, attendees: {personal_code:
+                 [values of fields]}}
+
+        The version is read before the roster, so a snapshot is never
+        older than its version.
+        '''
+        if version is None:
+            version = self.get_roster_version(event_id)
+        # One large read: keep it off the interactive pool
+        with self.db.lane(Database.BULK):
+            rows = self.db.get(queries.ROSTER, [event_id],
+                               row_factory=tuple_row)
+        return {
+            'event_id': event_id,
+            'version': version,
+            'fields': list(Attendance.ROSTER_FIELDS),
+            'attendees': Attendance.rows_to_roster(rows),
+        }
 
-    def invite(self, event_id: str, emails: list) -> list:
+    def sync_check_ins(self, event_id: str, check_ins: list) -> dict:
+        '''
+        @param: event_id: str, required,
+        @param: check_ins: list, required, offline log entries:
+                {personal_code, checked_in_at (ISO 8601),
+                 is_checked_in (default True)}
+        @return: counts and the result of every code: applied, superseded
+                 (the server has a later change) or invalid
+
+        Merges the log of an offline check-in device, last writer wins per
+        code. Replaying a log, e.g. after a lost response, is harmless.
+        '''
+        if not event_id:
+            return abort(400, "Missing event_id..")
+        if not isinstance(check_ins, list) or not check_ins:
+            return abort(400, "Missing check_ins..")
+        if len(check_ins) > self.SYNC_MAX_CHECK_INS:
+            return abort(400, f"At most {self.SYNC_MAX_CHECK_INS} "
+                              "check_ins per request..")
+        latest = self._latest_check_ins(check_ins)
+
+        codes = list(latest)
+        results = {}
+        with self.db.lane(Database.BULK):
+            for start in range(0, len(codes), self.SYNC_BATCH_SIZE):
+                chunk = codes[start:start + self.SYNC_BATCH_SIZE]
+                rows = self.db.set_returning(queries.SYNC_CHECK_INS, [
+                    chunk, [latest[code][0] for code in chunk],
+                    [latest[code][1] for code in chunk], event_id,
+                    event_id], one=False)
+                results.update((row['personal_code'], row['result'])
+                               for row in rows)
+        summary = {'event_id': event_id, 'applied': 0, 'superseded': 0,
+                   'invalid': 0}
+        summary['results'] = [{'personal_code': code,
+                               'result': results.get(code, 'invalid')}
+                              for code in codes]
+        for result in summary['results']:
+            summary[result['result']] += 1
+        return summary
+
+    @staticmethod
+    def _latest_check_ins(
+            check_ins: list) -> Dict[str, Tuple[bool, datetime]]:
+        '''Validates a sync's log entries; returns the latest
+        (is_checked_in, checked_in_at) of each code.'''
+        latest = {}
+        for entry in check_ins:
+            try:
+                code = entry['personal_code']
+                checked_in_at = AttendanceController.parse_timestamp(
+                    entry['checked_in_at'])
+                is_checked_in = entry.get('is_checked_in', True)
+            except (KeyError, TypeError, ValueError):
+                return abort(400, f"Invalid check_in: {entry}..")
+            if not isinstance(code, str) or \
+                    not isinstance(is_checked_in, bool):
+                return abort(400, f"Invalid check_in: {entry}..")
+            # Only the latest entry of a code can win
+            if code not in latest or latest[code][1] < checked_in_at:
+                latest[code] = (is_checked_in, checked_in_at)
+        return latest
+
+    @staticmethod
+    def parse_timestamp(value: str) -> datetime:
+        '''Parses ISO 8601; times without a zone are taken as UTC.'''
+        if not isinstance(value, str):
+            raise ValueError(f"Invalid timestamp {value}")
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed
+
+    def invite(self, event_id: str, emails: list) -> dict:
         '''
         @param: event_id: str, required,
         @param: emails: list
+        @return: summary: inserted, duplicates (repeated in the request or
+                 already invited), failures and the job_id of the emails
 
-        Request event invites
+        Request event invites. Emails are normalized and de-duplicated,
+        inserted INVITE_CHUNK_SIZE at a time, and one job is queued to email
+        the new invitees (see send_invitations), in the same transaction;
+        its progress is reported by get_invite_progress.
         ** Question here: do we create new users if there are unknown emails?
-        ** How to reduce costly queries?
         ** For iteration 1, all emails are linked to existing users.
         '''
         if not event_id:
             return abort(400, "Missing event_id..")
-        query = """SELECT *
-                   FROM Events
-                   JOIN Users ON Users.user_id = Events.user_id
-                   WHERE event_id = %s
-                """
-        exist = self.db.get_one(query, [event_id])
+        exist = self.db.get_one(queries.EVENT_WITH_ORGANIZER, [event_id])
         if not exist:
             return abort(400, "The input event_id is invalid..")
 
-        organizer_name = exist["username"]
-        event_name = exist["event_name"]
-        event_description = exist["event_description"]
-        event_location = exist["event_location"]
-        event_start_time = exist["event_start_time"].strftime(
-            "%m/%d/%Y, %H:%M:%S")
-        event_end_time = exist["event_end_time"].strftime(
-            "%m/%d/%Y, %H:%M:%S")
-
-        statement = """
-                    INSERT INTO Attendance
-                    VALUES (%s, %s, 'attendee',%s)
-                    """
-        failed = []
-        for email in emails:
-            personal_code = Attendance.generate_personal_code(event_id, email)
-            try:
-                self.db.set(statement, [event_id, email, personal_code])
-            except (ForeignKeyViolation, UniqueViolation):
-                failed.append(email)
+        requested = len(emails or [])
+        emails, duplicates, invalid = self.normalize_emails(emails)
+        failures = [{'email': str(email), 'reason': 'invalid_email'}
+                    for email in invalid]
+        invited = []
+        job_id = None
+        # On the bulk lane so a large invite can't starve rsvp/check_in.
+        # The invitations and their email job commit together: if the job
+        # can't be queued nothing is inserted, so a retry invites them
+        # again instead of reporting them as duplicates never emailed.
+        with self.db.lane(Database.BULK), self.db.transaction():
+            for start in range(0, len(emails), self.INVITE_CHUNK_SIZE):
+                chunk = emails[start:start + self.INVITE_CHUNK_SIZE]
+                codes = [Attendance.generate_personal_code(event_id, email,
+                                                           self.code_key)
+                         for email in chunk]
+                try:
+                    # Savepoint: a failed chunk doesn't undo the others
+                    with self.db.transaction():
+                        rows = self.db.set_returning(
+                            queries.INSERT_ATTENDANCES,
+                            [event_id, chunk, codes], one=False)
+                except DatabaseError:
+                    logger.exception('Failed to insert invitations for '
+                                     'event %s', event_id)
+                    failures.extend({'email': email,
+                                     'reason': 'insert_failed'}
+                                    for email in chunk)
+                    continue
+                # Rows not returned were already invited
+                duplicates += len(chunk) - len(rows)
+                invited.extend(rows)
+
+            if invited:
+                job_id = self.jobs.enqueue(JobQueue.INVITE_EMAILS, event_id, {
+                    'event_id': event_id,
+                    'items': [{'email': row["user_email"],
+                               'personal_code': row["personal_code"]}
+                              for row in invited],
+                })
+
+        return {
+            'event_id': event_id,
+            'requested': requested,
+            'inserted': len(invited),
+            'duplicates': duplicates,
+            'failures': failures,
+            'job_id': job_id,
+        }
+
+    def get_invite_progress(self, event_id: str, job_id: int) -> dict:
+        '''
+        @param: event_id: str, required,
+        @param: job_id: int, required
+        @return: status of the invite emails job, with the number of emails
+                 sent, failed (after all retries) and pending
+        '''
+        if not event_id or not job_id:
+            return abort(400, "Missing event_id or job_id..")
+        progress = self.jobs.get_progress(event_id, job_id)
+        if progress is None:
+            return abort(404, "The input event_id-job_id \
+                               combination is invalid..")
+        # Recipients whose last attempt failed: retried while the job is
+        # queued, given up on once it failed
+        progress['failures'] = [{'email': item['email'],
+                                 'reason': item['reason']}
+                                for item in progress.pop('failed_items')]
+        return progress
+
+    def send_invitations(self, payload: dict) -> list:
+        '''
+        @param: payload: dict, the event_id and items (email, personal_code)
+                of an invite emails job
+        @return: items that could not be emailed, with the reason
+
+        Job handler run by worker.py. The event's template variables are
+        computed once, and recipients are sent MAILGUN_BATCH_SIZE per call.
+        '''
+        event_id = payload['event_id']
+        exist = self.db.get_one(queries.EVENT_WITH_ORGANIZER, [event_id])
+        if not exist:
+            raise ValueError(f"Unknown event {event_id}")
+        variables = self.invite_variables(exist)
 
+        items = payload['items']
+        failed = []
+        for start in range(0, len(items), self.MAILGUN_BATCH_SIZE):
+            chunk = items[start:start + self.MAILGUN_BATCH_SIZE]
             try:
-                self.send_email(organizer_name, email, personal_code,
-                                event_name, event_description, event_location,
-                                event_start_time, event_end_time, event_id)
-            except requests.exceptions.RequestException:
-                failed.append(email)
+                response = self.send_batch(exist["username"], variables,
+                                           event_id, chunk)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                logger.exception('Failed to send invitations for event %s',
+                                 event_id)
+                # Mailgun accepts or rejects a batch as a whole
+                failed.extend(dict(item, reason=str(e)) for item in chunk)
+        return failed
 
-        print("failed to invite: ", failed)
-        return self.get_attendances(event_id, invited=True)
+    @staticmethod
+    def normalize_emails(emails) -> Tuple[List[str], int, list]:
+        '''
+        @param: emails: list
+        @return: unique trimmed, lower-cased emails in input order, number
+                 of duplicates dropped, entries that are not emails
+        '''
+        unique = {}
+        duplicates = 0
+        invalid = []
+        for email in emails or []:
+            normalized = email.strip().lower() if isinstance(email, str) \
+                else ''
+            if not AttendanceController.EMAIL_PATTERN.match(normalized):
+                invalid.append(email)
+            elif normalized in unique:
+                duplicates += 1
+            else:
+                unique[normalized] = None
+        return list(unique), duplicates, invalid
 
     def rsvp(self, event_id: str, personal_code: str) -> dict:
         '''
@@ -148,33 +491,13 @@ class AttendanceController():
         '''
         if not event_id or not personal_code:
             return abort(400, "Missing event_id or personal_code..")
-        query = "SELECT * FROM Attendance \
-                 WHERE event_id = %s \
-                 AND personal_code = %s"
-        param = [event_id, personal_code]
-        exist = self.db.get_one(query, param)
-        if not exist:
-            return abort(400, "The input event_id-personal_code \
-                               combination is invalid..")
-        try:
-            statement = "UPDATE Attendance \
-                         SET is_rsvped = True \
-                         WHERE event_id = %s \
-                        AND personal_code = %s"
-            self.db.set(statement, param)
-        except (ForeignKeyViolation, UniqueViolation) as e:
-            abort(400, e)
-
-        updated = self.db.get_one(query, param)
+        # One round trip: no row back means the code is invalid
+        updated = self.db.set_returning(queries.RSVP,
+                                        [event_id, personal_code])
         if not updated:
             return abort(400, "The input event_id-personal_code \
                                combination is invalid..")
-
-        return Attendance(updated["event_id"], updated["user_email"],
-                          updated["user_role"], updated["personal_code"],
-                          updated["is_invited"], updated["is_rsvped"],
-                          updated["is_checked_in"], updated["created_at"],
-                          updated["updated_at"]).to_dict()
+        return Attendance.row_to_dict(updated)
 
     def unrsvp(self, event_id: str, personal_code: str) -> dict:
         '''
@@ -184,73 +507,76 @@ class AttendanceController():
         '''
         if not event_id or not personal_code:
             return abort(400, "Missing event_id or personal_code..")
-        query = "SELECT * FROM Attendance \
-                 WHERE event_id = %s \
-                 AND personal_code = %s"
-        param = [event_id, personal_code]
-        exist = self.db.get_one(query, param)
-        if not exist:
-            return abort(400, "The input event_id-personal_code \
-                               combination is invalid..")
-        try:
-            statement = "UPDATE Attendance \
-                         SET is_rsvped = False \
-                         WHERE event_id = %s \
-                         AND personal_code = %s"
-            self.db.set(statement, param)
-        except (ForeignKeyViolation, UniqueViolation) as e:
-            abort(400, e)
-
-        updated = self.db.get_one(query, param)
+        # One round trip: no row back means the code is invalid
+        updated = self.db.set_returning(queries.UNRSVP,
+                                        [event_id, personal_code])
         if not updated:
             return abort(400, "The input event_id-personal_code \
                                combination is invalid..")
-
-        return Attendance(updated["event_id"], updated["user_email"],
-                          updated["user_role"], updated["personal_code"],
-                          updated["is_invited"], updated["is_rsvped"],
-                          updated["is_checked_in"], updated["created_at"],
-                          updated["updated_at"]).to_dict()
+        return Attendance.row_to_dict(updated)
 
     @staticmethod
-    def send_email(organizer_name: str, invitee_email: str,
-                   personal_code: str, event_name: str,
-                   event_description: str, event_location: str,
-                   event_start_time: str, event_end_time: str,
-                   event_id: str):
-        apikey = os.getenv("MAILGUN_API", default="")
+    def invite_variables(event: dict) -> dict:
+        '''
+        @param: event: dict, row of EVENT_WITH_ORGANIZER
+        @return: template variables of the invite email, the same for every
+                 invitee; invite_link is filled in per recipient by Mailgun
+        '''
         maps_key = os.getenv("MAPS_API", default="")
-        domain = "team-aapi.me"
-        url = f"https://api.mailgun.net/v3/mg.{domain}/messages"
-        location = str(event_location)[1:-1].split(',')[-1]
+        location = str(event["event_location"])[1:-1].split(',')[-1]
         location_query_string = location.replace(" ", "+")
-        invite_link = (f"http://{domain}/static/attendee.html?"
-                       f"event_id={event_id}&"
-                       f"personal_code={personal_code}")
+        return {"invite_msg_body": "invite message body",
+                "organizer_name": event["username"],
+                "invite_link": "%recipient.invite_link%",
+                "event_name": event["event_name"],
+                "event_description": event["event_description"],
+                "event_location": location,
+                "event_start_time": event["event_start_time"].strftime(
+                    "%m/%d/%Y, %H:%M:%S"),
+                "event_end_time": event["event_end_time"].strftime(
+                    "%m/%d/%Y, %H:%M:%S"),
+                "embed_link": "https://maps.googleapis.com/" +
+                "maps/api/staticmap?" +
+                "zoom=13&size=600x300&maptype=roadmap&" +
+                "markers=color:blue%7C" +
+                f"label:Event%7C{location_query_string}" +
+                f"&key={maps_key}"
+                }
+
+    def send_batch(self, organizer_name: str, variables: dict, event_id: str,
+                   items: list):
+        '''
+        @param: organizer_name: str,
+        @param: variables: dict, from invite_variables
+        @param: event_id: str,
+        @param: items: list of {email, personal_code}, at most
+                MAILGUN_BATCH_SIZE
+        @return: response of Mailgun
+
+        Sends the invite email to every item in one call. With
+        recipient-variables, Mailgun sends each recipient their own
+        message, with their own invite link.
+        '''
+        apikey = os.getenv("MAILGUN_API", default="")
+        domain = AttendanceController.MAILGUN_DOMAIN
+        # MAILGUN_URL points the worker at a fake mail endpoint in tests
+        url = os.getenv("MAILGUN_URL",
+                        default=f"https://api.mailgun.net/v3/mg.{domain}"
+                                "/messages")
+        recipient_variables = {
+            item['email']: {
+                "invite_link": (f"http://{domain}/static/attendee.html?"
+                                f"event_id={event_id}&"
+                                f"personal_code={item['personal_code']}"),
+            } for item in items}
 
-        return requests.post(
+        return self.requests.post(
             url,
             auth=("api", apikey),
-            data={"from": f"{organizer_name} <mailgun@mg.team-aapi.me>",
-                  "to": f"{organizer_name} <mailgun@mg.team-aapi.me>",
-                  "bcc": [invitee_email],
+            data={"from": f"{organizer_name} <mailgun@mg.{domain}>",
+                  "to": list(recipient_variables),
                   "subject": "You're invited!",
                   "template": "invite",
-                  "h:X-Mailgun-Variables":
-                      json.dumps(
-                          {"invite_msg_body": "invite message body",
-                           "organizer_name": organizer_name,
-                           "invite_link": invite_link,
-                           "event_name": event_name,
-                           "event_description": event_description,
-                           "event_location": location,
-                           "event_start_time": event_start_time,
-                           "event_end_time": event_end_time,
-                           "embed_link": "https://maps.googleapis.com/" +
-                           "maps/api/staticmap?" +
-                           "zoom=13&size=600x300&maptype=roadmap&" +
-                           "markers=color:blue%7C" +
-                           f"label:Event%7C{location_query_string}" +
-                           f"&key={maps_key}"
-                           })}
+                  "h:X-Mailgun-Variables": json.dumps(variables),
+                  "recipient-variables": json.dumps(recipient_variables)}
         )
@@ -1,16 +1,18 @@
+from db import queries
 from db.database import Database
 from models.event import Event
 from schema import Schema, And, SchemaError
 import re
 from flask import abort
 from psycopg.errors import ForeignKeyViolation, UniqueViolation
-import requests
+from services.network_service import NetworkService
 import os
 
 
 class EventController():
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, req: NetworkService = None):
         self.db = db
+        self.requests = req if req is not None else NetworkService()
 
     def get_event(self, event_id) -> dict:
         """
@@ -22,30 +24,9 @@ class EventController():
         if not event_id:
             return abort(400, "Missing event_id")
         if self.validate_event_id(event_id):
-            row = self.db.get_one("SELECT * FROM Events WHERE event_id = %s",
-                                  (event_id, ))
-            # 'event_location' returns in format:
-            # '(columbia,12.2,23.4,address)' - Need to fix it before insert
-
-            # Removes parentheses
-            loc_str = re.sub("[()]", "", row['event_location'])
-
-            # Make it a list of strings
-            loc_str_list = list(map(str, loc_str.split(',')))
-
-            # Get each field
-            loc_name = loc_str_list[0]
-            lat = float(loc_str_list[1])
-            long = float(loc_str_list[2])
-            address = loc_str_list[3]
-
-            event_location = f'(\'{loc_name}\', {lat}, {long}, \'{address}\')'
+            row = self.db.get_one(queries.EVENT_BY_ID, (event_id, ))
             if row is not None:
-                event = Event(row['user_id'], row['event_name'],
-                              row['event_description'], event_location,
-                              row['event_start_time'], row['event_end_time'],
-                              row['attendee_limit'], row['event_id'])
-                return event.to_dict()
+                return Event.from_row(row).to_dict()
             else:
                 abort(400, "The input event_id doesn't exist")
         else:
@@ -78,18 +59,15 @@ class EventController():
             loc_str = f'({location_name}, {lat}, {long}, {address})'
             event = Event(user_id, event_name, description, loc_str,
                           start_time, end_time, attendee_limit)
+            # Events live on their organizer's shard, which the ID records
+            self.db.use_shard(user_id=user_id)
+            event.event_id = self.db.tag_event_id(event.event_id)
             try:
-                query = """
-                        INSERT INTO Events
-                        VALUES (%s, %s, %s, %s,
-                        ROW(%s, %s, %s, %s),
-                        %s, %s, %s)
-                        """
                 param = (event.event_id, event.event_name, event.user_id,
                          event.event_description, location_name, lat, long,
                          address, event.event_start_time, event.event_end_time,
                          event.attendee_limit,)
-                self.db.set(query, param)
+                self.db.set(queries.INSERT_EVENT, param)
                 return self.get_event(event.event_id)
             except (ForeignKeyViolation, UniqueViolation) as e:
                 abort(400, e)
@@ -195,7 +173,8 @@ class EventController():
         """
         payloads = {"address": address, "key": os.getenv("MAPS_API",
                     default="")}
-        resp = requests.get(
+        resp = self.requests.request(
+                        "GET",
                         "https://maps.googleapis.com/maps/api/geocode/json",
                         params=payloads
                         )
@@ -5,6 +5,7 @@ from flask import abort
 from psycopg.errors import ForeignKeyViolation, UniqueViolation
 from schema import Schema, And, SchemaError
 
+from db import queries
 from db.database import Database
 from models.user import User
 from models.event import Event
@@ -30,34 +31,9 @@ class UserController():
         Get list of events created by user
         """
         if self.validate_user_id(user_id):
-            query = "SELECT * FROM Events WHERE user_id = %s"
-            param = [user_id]
-            rows = self.db.get(query, param)
-
-            events = []
-            for row in rows:
-                # 'event_location' returns in format:
-                # '(columbia,12.2,23.4,address)' - Need to fix it before insert
-
-                # Removes parentheses
-                loc_str = re.sub("[()]", "", row['event_location'])
-
-                # Make it a list of strings
-                loc_str_list = list(map(str, loc_str.split(',')))
-
-                # Get each field
-                location_name = loc_str_list[0]
-                lat = float(loc_str_list[1])
-                long = float(loc_str_list[2])
-                address = loc_str_list[3]
-
-                event_location = f'(\'{location_name}\', {lat}, \
-                    {long}, \'{address}\')'
-                event = Event(row['user_id'], row['event_name'],
-                              row['event_description'], event_location,
-                              row['event_start_time'], row['event_end_time'],
-                              row['attendee_limit'], row['event_id'])
-                events.append(event.to_dict())
+            rows = self.db.get(queries.EVENTS_BY_USER, [user_id])
+
+            events = [Event.from_row(row).to_dict() for row in rows]
             return events
         else:
             return abort(400, 'Invalid parameter value')
@@ -90,15 +66,13 @@ class UserController():
 
     def __get_user(self, user_id) -> Optional[dict]:
         print('__get_user', user_id)
-        query = "SELECT * FROM Users WHERE user_id = %s"
-        param = [user_id]
-        row = self.db.get_one(query, param)
+        self.db.use_shard(user_id=user_id)
+        row = self.db.get_one(queries.USER_BY_ID, [user_id])
 
         if row is None:
             return None
         else:
-            user = User(row['user_id'], row['org_name'],
-                        row['username']).to_dict()
+            user = User.from_row(row).to_dict()
             user['aapi-key'] = self.auth.sign(row['user_id'])
             return user
 
@@ -131,11 +105,10 @@ class UserController():
         """
         if self.validate_user_input(user_id, org_name, username):
             user = User(user_id, org_name, username)
+            self.db.use_shard(user_id=user_id)
             try:
-                query = "INSERT INTO Users (user_id, org_name, username) \
-                         VALUES (%s, %s, %s)"
                 params = (user.user_id, user.org_name, user.username)
-                self.db.set(query, params)
+                self.db.set(queries.INSERT_USER, params)
                 user = user.to_dict()
                 user['aapi-key'] = self.auth.sign(user['user_id'])
                 return user
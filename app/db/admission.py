@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class Overloaded(ServiceUnavailable):
+    """503 with a Retry-After header, raised instead of queueing forever.
+
+    A subclass of werkzeug's ServiceUnavailable, so it is rendered by the
+    app's JSON HTTPException handler like any other abort().
+    """
+
+    description = 'Server is busy. Please retry shortly.'
+
+
+class AdmissionGate():
+    """Per-worker limit on requests served at once, with a short queue.
+
+    Up to max_active requests run; the next max_queue wait at most
+    queue_timeout seconds for a slot, and anything beyond that is rejected
+    right away with Overloaded. Excess load is then shed before it reaches
+    the connection pool, instead of every request timing out inside it.
+    Configured by ADMISSION_MAX_ACTIVE (0 disables the gate),
+    ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT and RETRY_AFTER_SECONDS.
+    """
+
+    def __init__(self, max_active: int = 8, max_queue: int = 16,
+                 queue_timeout: float = 1.0, retry_after: int = 1) -> None:
+        if max_active < 1 or max_queue < 0:
+            raise ValueError(f'Invalid admission limits: '
+                             f'max_active={max_active}, '
+                             f'max_queue={max_queue}')
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @staticmethod
+    def from_env() -> Optional['AdmissionGate']:
+        max_active = int(os.getenv('ADMISSION_MAX_ACTIVE', default=8))
+        if max_active <= 0:
+            return None
+        return AdmissionGate(
+            max_active,
+            int(os.getenv('ADMISSION_MAX_QUEUE', default=16)),
+            float(os.getenv('ADMISSION_QUEUE_TIMEOUT', default=1.0)),
+            int(os.getenv('RETRY_AFTER_SECONDS', default=1)),
+        )
+
+    def acquire(self) -> None:
+        '''Takes a slot, or raises Overloaded.'''
+        with self._cond:
+            if self.active < self.max_active:
+                self.active += 1
+                self.admitted += 1
+                return
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded(retry_after=self.retry_after)
+            self.queued += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.max_active:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        raise Overloaded(retry_after=self.retry_after)
+                    self._cond.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.active += 1
+            self.admitted += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def init_app(self, app, exempt: Iterable[str] = ('health', 'health_db')
+                 ) -> None:
+        """
+        Runs every request except the exempt endpoints through the gate.
+        Register before Database.init_app, so a rejected request never
+        checks out a connection.
+        """
+        exempt = frozenset(exempt)
+
+        @app.before_request
+        def admit_request():
+            if request.endpoint in exempt:
+                return
+            self.acquire()
+            g.admitted = True
+
+        @app.teardown_request
+        def finish_request(exc):
+            if g.pop('admitted', False):
+                self.release()
+
+    def to_dict(self) -> dict:
+        with self._cond:
+            return {
+                'max_active': self.max_active,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
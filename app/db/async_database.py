@@ -0,0 +1,265 @@
+import logging
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from contextvars import ContextVar
+from typing import (Any, AsyncIterator, Dict, Iterable, List, Optional,
+                    Sequence, Union)
+
+from psycopg import AsyncConnection, AsyncCursor, OperationalError, sql
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from db import queries
+from db.config import PoolConfig
+from db.slow_log import SlowQueryLog
+from db.stats import PoolStats
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDatabase():
+    """asyncio counterpart of db.database.Database.
+
+    Same API and dict_row results, but every call is a coroutine, so one
+    process can run many queries concurrently instead of blocking a worker
+    per query. State pinned by transaction() lives in context variables,
+    so it follows the asyncio task instead of the thread.
+    """
+
+    def __init__(self, pool=None, slow_log: Optional[SlowQueryLog] = None):
+        self._pool = pool
+        self._stats = PoolStats()
+        self._slow_log = slow_log if slow_log is not None else SlowQueryLog()
+        self._conn: ContextVar[Optional[AsyncConnection]] = ContextVar(
+            f'async_db_conn_{id(self)}', default=None)
+        self._depth: ContextVar[int] = ContextVar(
+            f'async_db_depth_{id(self)}', default=0)
+
+    @staticmethod
+    async def get_connection(config: Union[PoolConfig, str]
+                             ) -> AsyncConnectionPool:
+        '''Returns an open psycopg_pool.AsyncConnectionPool.'''
+        if isinstance(config, str):
+            config = PoolConfig(config)
+        logger.info('AsyncDatabase.get_connection: %s', config.to_dict())
+        conn_pool = AsyncConnectionPool(config.conninfo,
+                                        min_size=config.min_size,
+                                        max_size=config.max_size,
+                                        timeout=config.timeout,
+                                        max_idle=config.max_idle,
+                                        max_lifetime=config.max_lifetime,
+                                        name=config.name,
+                                        configure=(AsyncDatabase
+                                                   .prepare_statements),
+                                        kwargs={"row_factory": dict_row},
+                                        open=False)
+        await conn_pool.open(wait=True)
+        return conn_pool
+
+    @staticmethod
+    async def prepare_statements(conn: AsyncConnection) -> None:
+        '''Prepares the warm registered queries on a new connection.'''
+        try:
+            for query in queries.warm_queries():
+                await conn.execute(query.sql, [None] * query.param_count,
+                                   prepare=True)
+        except Exception as ex:
+            logger.warning('AsyncDatabase.prepare_statements failed: %s', ex)
+            await conn.rollback()
+        else:
+            await conn.commit()
+
+    @staticmethod
+    async def _execute(cur: AsyncCursor, query: str,
+                       params: Optional[Sequence[Any]]) -> None:
+        if queries.is_registered(query):
+            await cur.execute(query=query, params=params, prepare=True)
+        else:
+            await cur.execute(query=query, params=params)
+
+    async def _record_if_slow(self, conn: AsyncConnection, query: str,
+                              params: Optional[Sequence[Any]],
+                              start: float) -> None:
+        duration_ms = (time.perf_counter() - start) * 1000
+        if not self._slow_log.is_slow(duration_ms):
+            return
+        plan = None
+        if self._slow_log.should_explain():
+            plan = await self._explain(conn, query, params)
+        self._slow_log.record(query, params, duration_ms, plan)
+
+    async def _explain(self, conn: AsyncConnection, query: str,
+                       params: Optional[Sequence[Any]]) -> Optional[Any]:
+        try:
+            # Savepoint, so a failing EXPLAIN can't abort the caller's
+            # work; always rolled back, so nothing EXPLAIN ANALYZE ran is
+            # kept
+            async with conn.transaction(force_rollback=True):
+                async with conn.cursor() as cur:
+                    await cur.execute(SlowQueryLog.explain_statement(query),
+                                      params)
+                    row = await cur.fetchone()
+        except Exception as ex:
+            logger.warning('AsyncDatabase.explain failed: %s', ex)
+            return None
+        if isinstance(row, dict):
+            return next(iter(row.values()))
+        return row[0]
+
+    def get_slow_queries(self) -> List[Dict[str, Any]]:
+        return self._slow_log.entries()
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        stats = self._stats.to_dict()
+        stats['pool'] = self._pool.get_stats()
+        return stats
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[AsyncConnection]:
+        '''Yields the pinned connection, or checks one out of the pool.'''
+        pinned = self._conn.get()
+        if pinned is not None:
+            yield pinned
+            return
+        async with AsyncExitStack() as stack:
+            self._stats.wait_started()
+            start = time.perf_counter()
+            try:
+                conn = await stack.enter_async_context(self._pool.connection())
+            except OperationalError:
+                self._stats.checkout_failed()
+                raise
+            self._stats.checked_out_after(
+                (time.perf_counter() - start) * 1000)
+            stack.callback(self._stats.checked_in)
+            yield conn
+
+    def in_transaction(self) -> bool:
+        return self._depth.get() > 0
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[AsyncConnection]:
+        """
+        Example:
+            async with db.transaction():
+                await db.set("UPDATE Users SET username = %s "
+                             "WHERE user_id = %s", ("John Doe", "user1234"))
+                await db.get_one("SELECT * FROM Users WHERE user_id = %s",
+                                 ("user1234",))
+        """
+        async with self._connection() as conn:
+            conn_token = self._conn.set(conn)
+            depth_token = self._depth.set(self._depth.get() + 1)
+            try:
+                async with conn.transaction():
+                    yield conn
+            finally:
+                self._depth.reset(depth_token)
+                self._conn.reset(conn_token)
+
+    @asynccontextmanager
+    async def _committing(self, conn: AsyncConnection) -> AsyncIterator[None]:
+        if self.in_transaction():
+            yield
+            return
+        try:
+            yield
+        except Exception as ex:
+            logger.error('DB update failed: %s', ex)
+            await conn.rollback()
+            raise ex
+        else:
+            await conn.commit()
+
+    async def get(self, query: str, params: Optional[Sequence[Any]] = None
+                  ) -> List[Dict[str, Any]]:
+        """
+        Example:
+            await db.get("SELECT * FROM Users WHERE user_id = (%s)",
+                         ("user1234",))
+        """
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                start = time.perf_counter()
+                await self._execute(cur, query, params)
+                data = await cur.fetchall()
+                await self._record_if_slow(conn, query, params, start)
+        return data
+
+    async def get_one(self, query: str,
+                      params: Optional[Sequence[Any]] = None
+                      ) -> Optional[Dict[str, Any]]:
+        """
+        Example:
+            await db.get_one("SELECT * FROM Users WHERE user_id = (%s)",
+                             ("user1234",))
+        """
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                start = time.perf_counter()
+                await self._execute(cur, query, params)
+                data = await cur.fetchone()
+                await self._record_if_slow(conn, query, params, start)
+        return data
+
+    async def set(self, query: str,
+                  params: Optional[Sequence[Any]] = None) -> None:
+        """
+        Example:
+            await db.set("UPDATE Users SET username = (%s) "
+                         "WHERE user_id = (%s)", ("John Doe", "user1234"))
+        """
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                async with self._committing(conn):
+                    start = time.perf_counter()
+                    await self._execute(cur, query, params)
+                    await self._record_if_slow(conn, query, params, start)
+
+    async def set_returning(self, query: str,
+                            params: Optional[Sequence[Any]] = None,
+                            one: bool = True) -> Any:
+        '''Runs a write with a RETURNING clause, commits, returns rows.'''
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                async with self._committing(conn):
+                    start = time.perf_counter()
+                    await self._execute(cur, query, params)
+                    data = (await cur.fetchone() if one
+                            else await cur.fetchall())
+                    await self._record_if_slow(conn, query, params, start)
+        return data
+
+    async def set_many(self, query: str,
+                       params_seq: Iterable[Sequence[Any]]) -> int:
+        '''Runs query for every params tuple and commits once.'''
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                async with self._committing(conn):
+                    await cur.executemany(query, params_seq)
+                return cur.rowcount
+
+    @asynccontextmanager
+    async def pipeline(self) -> AsyncIterator[AsyncCursor]:
+        '''Pipeline-mode block on one connection, committed once.'''
+        async with self._connection() as conn:
+            async with self._committing(conn):
+                async with conn.pipeline():
+                    async with conn.cursor() as cur:
+                        yield cur
+
+    async def copy_in(self, table: str, columns: Sequence[str],
+                      rows: Iterable[Sequence[Any]]) -> int:
+        '''Bulk-loads rows with COPY ... FROM STDIN and commits once.'''
+        statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(table.lower()),
+            sql.SQL(', ').join(sql.Identifier(c.lower()) for c in columns))
+        count = 0
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                async with self._committing(conn):
+                    async with cur.copy(statement) as copy:
+                        for row in rows:
+                            await copy.write_row(row)
+                            count += 1
+        return count
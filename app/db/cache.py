@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Hashable, Optional, Sequence, Tuple
+
+_TABLE_PATTERN = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE|COPY)\s+(\w+)',
+                            re.IGNORECASE)
+
+MISSING = object()
+
+
+def tables_of(query: str) -> FrozenSet[str]:
+    '''Returns the (lower-cased) tables a statement reads or writes.'''
+    return frozenset(t.lower() for t in _TABLE_PATTERN.findall(query))
+
+
+def _size_of(value: Any) -> int:
+    '''Rough memory estimate of a cached result (rows of dicts).'''
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sys.getsizeof(v)
+                                          for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_size_of(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class QueryCache():
+    """Per-worker LRU/TTL cache of query results, tagged by table.
+
+    Entries are keyed by SQL text and parameters and tagged with the tables
+    the query reads; a write to any of those tables drops them. Writes made
+    by other workers are not seen, so keep the TTL short. Configured by
+    DB_QUERY_CACHE_TTL (0 disables it), DB_QUERY_CACHE_MAX_ENTRIES and
+    DB_QUERY_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, ttl_seconds: float = 5.0, max_entries: int = 1024,
+                 max_bytes: int = 16 * 1024 * 1024) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (expires_at, size, tables, value), least recent first
+        self._entries: 'OrderedDict[Hashable, Tuple]' = OrderedDict()
+        self._by_table: Dict[str, set] = {}
+        self.bytes = 0
+        # Bumped by every invalidation; a result read before a concurrent
+        # write must not be cached after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def from_env() -> Optional['QueryCache']:
+        ttl = float(os.getenv('DB_QUERY_CACHE_TTL', default=0))
+        if ttl <= 0:
+            return None
+        return QueryCache(
+            ttl,
+            int(os.getenv('DB_QUERY_CACHE_MAX_ENTRIES', default=1024)),
+            int(os.getenv('DB_QUERY_CACHE_MAX_BYTES',
+                          default=16 * 1024 * 1024)),
+        )
+
+    @staticmethod
+    def key(query: str, params: Optional[Sequence[Any]]) -> Hashable:
+        return (query, tuple(params) if params is not None else None)
+
+    def get(self, key: Hashable) -> Any:
+        '''Returns the cached value, or MISSING.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3]
+
+    def put(self, key: Hashable, query: str, value: Any,
+            generation: int) -> None:
+        '''Caches value unless an invalidation happened since generation.'''
+        size = _size_of(value)
+        if size > self.max_bytes:
+            return
+        tables = tables_of(query)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size,
+                                  tables, value)
+            self.bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while (len(self._entries) > self.max_entries
+                   or self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tables: FrozenSet[str]) -> None:
+        with self._lock:
+            self.generation += 1
+            for table in tables:
+                for key in list(self._by_table.get(table, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._by_table.clear()
+            self.bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, tables, _ = self._entries.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,57 @@
+import os
+from typing import Optional
+
+DEFAULT_CONNINFO = 'postgresql://postgres@db:5432/aapi'
+
+
+class PoolConfig():
+    """Settings for one psycopg ConnectionPool.
+
+    Every value can be overridden from the environment, e.g.
+    DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT,
+    DB_POOL_MAX_IDLE and DB_POOL_MAX_LIFETIME. Sizes are per uWSGI worker.
+    """
+
+    def __init__(self, conninfo: str = DEFAULT_CONNINFO, min_size: int = 1,
+                 max_size: int = 2, timeout: float = 30.0,
+                 max_idle: float = 600.0, max_lifetime: float = 3600.0,
+                 name: Optional[str] = None) -> None:
+        if min_size < 0 or max_size < max(min_size, 1):
+            raise ValueError(f'Invalid pool size: min_size={min_size}, '
+                             f'max_size={max_size}')
+        self.conninfo = conninfo
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.name = name
+
+    @staticmethod
+    def from_env(url_var: str = 'DATABASE_URL', prefix: str = 'DB_POOL',
+                 default_conninfo: str = DEFAULT_CONNINFO,
+                 name: Optional[str] = None) -> 'PoolConfig':
+        """
+        Example:
+            PoolConfig.from_env()
+            PoolConfig.from_env('DATABASE_REPLICA_URL', 'DB_REPLICA_POOL')
+        """
+        return PoolConfig(
+            os.getenv(url_var, default=default_conninfo),
+            int(os.getenv(f'{prefix}_MIN_SIZE', default=1)),
+            int(os.getenv(f'{prefix}_MAX_SIZE', default=2)),
+            float(os.getenv(f'{prefix}_TIMEOUT', default=30.0)),
+            float(os.getenv(f'{prefix}_MAX_IDLE', default=600.0)),
+            float(os.getenv(f'{prefix}_MAX_LIFETIME', default=3600.0)),
+            name,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'timeout': self.timeout,
+            'max_idle': self.max_idle,
+            'max_lifetime': self.max_lifetime,
+            'name': self.name,
+        }
@@ -1,50 +1,629 @@
-from typing import Any, List, Dict, Optional, Sequence
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from typing import (Any, FrozenSet, Iterable, Iterator, List, Dict, Optional,
+                    Sequence, Union)
 
-from psycopg.rows import dict_row
-from psycopg_pool import ConnectionPool
+from flask import request
+from psycopg import (Connection, Cursor, OperationalError, Pipeline,
+                     errors, sql)
+from psycopg.pq import TransactionStatus
+from psycopg.rows import RowFactory, dict_row
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+from db import queries
+from db.admission import Overloaded
+from db.cache import MISSING, QueryCache, tables_of
+from db.config import PoolConfig
+from db.limits import QueryLimits, QueryTimeout
+from db.query_counter import QueryCounter
+from db.shards import ShardRouter
+from db.slow_log import SlowQueryLog
+from db.stats import PoolStats
+
+logger = logging.getLogger(__name__)
 
 
 class Database():
-    def __init__(self, pool=None):
+    # Lanes: the default pool serves interactive work; bulk work (invites,
+    # exports) can be given its own pool so it never holds the
+    # connections RSVP and check-in need
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
+
+    def __init__(self, pool=None, slow_log: Optional[SlowQueryLog] = None,
+                 replica=None, read_your_writes_seconds: float = 5.0,
+                 cache: Optional[QueryCache] = None,
+                 checkout_timeout: Optional[float] = None,
+                 retry_after: int = 1,
+                 limits: Optional[QueryLimits] = None,
+                 shards: Optional[ShardRouter] = None,
+                 lanes: Optional[Dict[str, Any]] = None):
         self._pool = pool
+        # Extra pools by lane name, each with its own size limit; the
+        # interactive lane is self._pool
+        self._lanes = {name: (lane_pool, PoolStats())
+                       for name, lane_pool in (lanes or {}).items()}
+        # Pools of shards 1..n and the routing to them; self._pool is
+        # shard 0
+        self._shards = shards if shards is not None else ShardRouter()
+        # Longest a query waits for a free connection before the request
+        # is failed with Overloaded (503); None waits the pool's timeout
+        self._checkout_timeout = checkout_timeout
+        self._retry_after = retry_after
+        # Per-route statement timeouts and per-request query-time budget
+        self._limits = (limits if limits is not None
+                        else QueryLimits(statement_timeout_ms=None))
+        self._stats = PoolStats()
+        self._slow_log = slow_log if slow_log is not None else SlowQueryLog()
+        # Optional read-only pool that get/get_one are routed to
+        self._replica = replica
+        self._replica_stats = PoolStats()
+        self._read_your_writes_seconds = read_your_writes_seconds
+        # Optional result cache for queries registered with cache=True
+        self._cache = cache
+        # Connection pinned to the current thread by transaction() or
+        # bind_connection(), how many transaction() blocks are open, when
+        # this thread (request) last wrote, which cached tables the open
+        # transaction wrote to, the statement timeout and query-time
+        # budget left of the current request, its QueryCounter, the shard
+        # it is routed to and the lane it runs in
+        self._local = threading.local()
 
     @staticmethod
-    def get_connection(conninfo) -> ConnectionPool:
-        '''Returns a psycopg.Connection instance.'''
-        print('Database.connect_to_db: conninfo=', conninfo)
-        conn_pool = ConnectionPool(conninfo, min_size=1, max_size=2,
-                                   kwargs={"row_factory": dict_row})
+    def get_connection(config: Union[PoolConfig, str],
+                       read_only: bool = False,
+                       statement_timeout_ms: Optional[float] = None
+                       ) -> ConnectionPool:
+        '''Returns a psycopg_pool.ConnectionPool sized by config.'''
+        if isinstance(config, str):
+            config = PoolConfig(config)
+        logger.info('Database.get_connection: %s', config.to_dict())
+        kwargs = {"row_factory": dict_row}
+        options = []
+        if read_only:
+            options.append("-c default_transaction_read_only=on")
+        if statement_timeout_ms:
+            options.append(f"-c statement_timeout={int(statement_timeout_ms)}")
+        if options:
+            kwargs["options"] = " ".join(options)
+        conn_pool = ConnectionPool(config.conninfo,
+                                   min_size=config.min_size,
+                                   max_size=config.max_size,
+                                   timeout=config.timeout,
+                                   max_idle=config.max_idle,
+                                   max_lifetime=config.max_lifetime,
+                                   name=config.name,
+                                   configure=partial(
+                                       Database.prepare_statements,
+                                       reads_only=read_only),
+                                   kwargs=kwargs)
         conn_pool.wait()
         return conn_pool
 
-    def get(self, query: str, params: Optional[Sequence[Any]] = None
-            ) -> List[Dict[str, Any]]:
+    @staticmethod
+    def prepare_statements(conn: Connection, reads_only: bool = False
+                           ) -> None:
+        '''Prepares the warm registered queries on a new connection.'''
+        try:
+            for query in queries.warm_queries():
+                if reads_only and not query.is_read:
+                    continue
+                conn.execute(query.sql, [None] * query.param_count,
+                             prepare=True)
+        except Exception as ex:
+            # A cold connection is still usable; don't fail the pool
+            logger.warning('Database.prepare_statements failed: %s', ex)
+            conn.rollback()
+        else:
+            conn.commit()
+
+    @staticmethod
+    def _execute(cur: Cursor, query: str,
+                 params: Optional[Sequence[Any]]) -> None:
+        if queries.is_registered(query):
+            cur.execute(query=query, params=params, prepare=True)
+        else:
+            cur.execute(query=query, params=params)
+
+    @contextmanager
+    def _timed(self, conn: Connection, query: str,
+               params: Optional[Sequence[Any]]) -> Iterator[None]:
+        '''Logs the wrapped statement if it is slower than the threshold.'''
+        start = time.perf_counter()
+        with self._bounded(conn):
+            yield
+        duration_ms = (time.perf_counter() - start) * 1000
+        self._count(query, duration_ms)
+        if not self._slow_log.is_slow(duration_ms):
+            return
+        plan = None
+        if self._slow_log.should_explain():
+            plan = self._explain(conn, query, params)
+        self._slow_log.record(query, params, duration_ms, plan)
+
+    @contextmanager
+    def _bounded(self, conn: Connection, pipelined: bool = True
+                 ) -> Iterator[None]:
+        '''Applies the route's statement timeout and the request's budget.
+
+        The timeout is set in the same pipeline as the wrapped statement,
+        so it costs no round trip of its own; COPY can't be pipelined, so
+        copy_in passes pipelined=False. Raises QueryTimeout when the
+        budget is spent or Postgres cancels the statement.
+        '''
+        timeout_ms = getattr(self._local, 'timeout_ms', None)
+        budget_ms = getattr(self._local, 'budget_ms', None)
+        if budget_ms is not None:
+            if budget_ms <= 0:
+                raise QueryTimeout(retry_after=self._retry_after)
+            limit_ms = timeout_ms or self._limits.statement_timeout_ms
+            timeout_ms = (budget_ms if limit_ms is None
+                          else min(limit_ms, budget_ms))
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                if timeout_ms is not None:
+                    if pipelined and Pipeline.is_supported():
+                        stack.enter_context(conn.pipeline())
+                    # 0 would mean no timeout at all
+                    conn.execute(queries.SET_STATEMENT_TIMEOUT,
+                                 (str(max(int(timeout_ms), 1)), ),
+                                 prepare=True)
+                    self._count(queries.SET_STATEMENT_TIMEOUT,
+                                (time.perf_counter() - start) * 1000)
+                yield
+        except errors.QueryCanceled as ex:
+            logger.warning('Query canceled after %s ms: %s', timeout_ms, ex)
+            raise QueryTimeout(retry_after=self._retry_after) from ex
+        finally:
+            if budget_ms is not None:
+                self._local.budget_ms = (
+                    budget_ms - (time.perf_counter() - start) * 1000)
+
+    def _explain(self, conn: Connection, query: str,
+                 params: Optional[Sequence[Any]]) -> Optional[Any]:
+        try:
+            # Savepoint, so a failing EXPLAIN can't abort the caller's
+            # work; always rolled back, so nothing EXPLAIN ANALYZE ran is
+            # kept
+            with conn.transaction(force_rollback=True):
+                with conn.cursor() as cur:
+                    cur.execute(SlowQueryLog.explain_statement(query), params)
+                    row = cur.fetchone()
+        except Exception as ex:
+            logger.warning('Database.explain failed: %s', ex)
+            return None
+        if isinstance(row, dict):
+            return next(iter(row.values()))
+        return row[0]
+
+    def _count(self, query: str, duration_ms: float) -> None:
+        counter = getattr(self._local, 'counter', None)
+        if counter is not None:
+            counter.record(query, duration_ms)
+
+    @staticmethod
+    def _new_counter() -> QueryCounter:
+        # Every statement under a timeout has its set_config: not an N+1
+        return QueryCounter(not_repeats=[queries.SET_STATEMENT_TIMEOUT])
+
+    @contextmanager
+    def count_queries(self) -> Iterator[QueryCounter]:
+        """
+        Counts the statements this thread runs inside the block, e.g. to
+        give an endpoint a query budget in tests.
+
+        Example:
+            with db.count_queries() as counter:
+                controller.invite(event_id, emails)
+            assert counter.count <= 2 and not counter.repeated()
+        """
+        prev = getattr(self._local, 'counter', None)
+        counter = self._local.counter = self._new_counter()
+        try:
+            yield counter
+        finally:
+            self._local.counter = prev
+
+    def get_slow_queries(self) -> List[Dict[str, Any]]:
+        '''Returns the most recent slow queries of this worker.'''
+        return self._slow_log.entries()
+
+    @contextmanager
+    def _checkout(self, pool, stats: PoolStats) -> Iterator[Connection]:
+        '''Checks a connection out of pool, recording wait time.'''
+        with ExitStack() as stack:
+            stats.wait_started()
+            start = time.perf_counter()
+            try:
+                if self._checkout_timeout is not None:
+                    checkout = pool.connection(timeout=self._checkout_timeout)
+                else:
+                    checkout = pool.connection()
+                conn = stack.enter_context(checkout)
+            except OperationalError:
+                # PoolTimeout is an OperationalError too
+                stats.checkout_failed()
+                raise
+            stats.checked_out_after((time.perf_counter() - start) * 1000)
+            stack.callback(stats.checked_in)
+            yield conn
+
+    @contextmanager
+    def _connection(self, read: bool = False) -> Iterator[Connection]:
+        '''Yields the pinned connection, or checks one out of the pool.
+
+        Reads go to the replica pool when there is one, unless this thread
+        wrote recently (read-your-writes) or the replica is unavailable.
+        '''
+        pinned = getattr(self._local, 'conn', None)
+        if pinned is not None:
+            yield pinned
+            return
+        with ExitStack() as stack:
+            conn = None
+            if read and self._use_replica():
+                try:
+                    conn = stack.enter_context(
+                        self._checkout(self._replica, self._replica_stats))
+                except OperationalError as ex:
+                    logger.warning('Replica unavailable, reading from '
+                                   'primary: %s', ex)
+            if conn is None:
+                pool, stats = self._shard_pool()
+                try:
+                    conn = stack.enter_context(self._checkout(pool, stats))
+                except PoolTimeout as ex:
+                    # Pool exhausted: shed the request instead of queueing
+                    logger.warning('Database pool exhausted: %s', ex)
+                    raise Overloaded(retry_after=self._retry_after) from ex
+            yield conn
+
+    def _shard_pool(self):
+        shard = getattr(self._local, 'shard', 0)
+        if shard == 0:
+            lane = self._lanes.get(getattr(self._local, 'lane', None))
+            if lane is not None:
+                return lane
+            return self._pool, self._stats
+        return self._shards.pools[shard - 1], self._shards.stats[shard - 1]
+
+    def _use_replica(self) -> bool:
+        # The replica is a replica of shard 0
+        if self._replica is None or getattr(self._local, 'shard', 0):
+            return False
+        last_write = getattr(self._local, 'last_write', None)
+        return (last_write is None or time.monotonic() - last_write
+                >= self._read_your_writes_seconds)
+
+    def start_request(self, statement_timeout_ms: Optional[float] = None
+                      ) -> None:
+        '''Resets the per-request state of this thread.'''
+        self._local.last_write = None
+        self._local.shard = 0
+        self._local.timeout_ms = statement_timeout_ms
+        self._local.budget_ms = self._limits.request_budget_ms
+
+    @property
+    def shard_count(self) -> int:
+        return self._shards.count
+
+    def use_shard(self, user_id: Optional[str] = None,
+                  event_id: Optional[str] = None,
+                  shard: Optional[int] = None) -> int:
+        """
+        Routes the following queries of this thread to the shard of an
+        event (and its attendances) or, failing that, of a user's
+        organization. Returns the shard number. init_app does this for
+        routes with <event_id> or <user_id>; controllers call it when the
+        key only comes in the request body, and the job worker passes a
+        shard number to visit every shard.
+
+        Example:
+            db.use_shard(user_id="organizer1@gmail.com")
+            db.use_shard(event_id="S01bwaPbxV1aRTSykhZ84WRx5A")
+        """
+        if shard is not None:
+            if not 0 <= shard < self._shards.count:
+                raise ValueError(f'Invalid shard {shard}')
+        elif event_id:
+            shard = self._shards.shard_of_event(event_id)
+        elif user_id:
+            shard = self._shards.shard_of_user(user_id)
+        else:
+            shard = 0
+        if shard == getattr(self._local, 'shard', 0):
+            return shard
+        if self.in_transaction():
+            raise RuntimeError('Cannot change shards inside a transaction')
+        rebind = getattr(self._local, 'scope', None) is not None
+        if rebind:
+            # The request-scoped connection belongs to the old shard
+            self.release_connection()
+        self._local.shard = shard
+        if rebind:
+            self.bind_connection()
+        return shard
+
+    @contextmanager
+    def lane(self, name: str) -> Iterator[None]:
+        """
+        Runs the queries of this thread inside the block in a lane's pool.
+        Lanes without a pool of their own, and connections already pinned
+        by transaction() or bind_connection(), are used as they are. Lane
+        pools belong to shard 0; other shards have one pool for all work.
+
+        Example:
+            with db.lane(Database.BULK):
+                db.set_returning(queries.INSERT_ATTENDANCES, params)
+        """
+        prev = getattr(self._local, 'lane', None)
+        self._local.lane = name
+        try:
+            yield
+        finally:
+            self._local.lane = prev
+
+    def tag_event_id(self, event_id: str) -> str:
+        '''Marks a new event ID with the shard this thread is routed to.'''
+        return self._shards.tag_event_id(event_id,
+                                         getattr(self._local, 'shard', 0))
+
+    @contextmanager
+    def statement_timeout(self, timeout_ms: Optional[float]
+                          ) -> Iterator[None]:
+        """
+        Bounds every statement run by this thread inside the block, e.g. a
+        controller method that must answer fast or an export that may take
+        longer than the route's timeout.
+
+        Example:
+            with db.statement_timeout(200):
+                db.set(queries.CHECK_IN, (event_id, personal_code))
+        """
+        prev = getattr(self._local, 'timeout_ms', None)
+        self._local.timeout_ms = timeout_ms
+        try:
+            yield
+        finally:
+            self._local.timeout_ms = prev
+
+    def in_transaction(self) -> bool:
+        return getattr(self._local, 'depth', 0) > 0
+
+    @contextmanager
+    def transaction(self) -> Iterator[Connection]:
+        """
+        Unit of work: every get/get_one/set/set_many made by this thread
+        inside the block runs on one connection and in one transaction,
+        committed when the block exits and rolled back if it raises.
+        Nested blocks become savepoints.
+
+        Example:
+            with db.transaction():
+                db.set("UPDATE Users SET username = %s WHERE user_id = %s",
+                       ("John Doe", "user1234"))
+                db.get_one("SELECT * FROM Users WHERE user_id = %s",
+                           ("user1234",))
+        """
+        with self._connection() as conn:
+            prev_conn = getattr(self._local, 'conn', None)
+            depth = getattr(self._local, 'depth', 0)
+            if (depth == 0 and conn.info.transaction_status
+                    == TransactionStatus.INTRANS):
+                # Reads on a bound connection leave a transaction open, in
+                # which conn.transaction() would only be a savepoint that
+                # never commits. Only reads are pending: writes commit.
+                conn.commit()
+            self._local.conn = conn
+            self._local.depth = depth + 1
+            try:
+                with conn.transaction():
+                    yield conn
+            finally:
+                self._local.depth = depth
+                self._local.conn = prev_conn
+                if depth == 0:
+                    self._flush_invalidations()
+
+    def bind_connection(self) -> None:
+        '''Pins one pooled connection to this thread until released.'''
+        if getattr(self._local, 'conn', None) is not None:
+            return
+        scope = ExitStack()
+        self._local.conn = scope.enter_context(self._connection())
+        self._local.scope = scope
+
+    def release_connection(self) -> None:
+        '''Returns the connection pinned by bind_connection() to the pool.'''
+        scope = getattr(self._local, 'scope', None)
+        self._local.scope = None
+        self._local.conn = None
+        if scope is not None:
+            scope.close()
+
+    def init_app(self, app, request_scoped_connection: bool = False,
+                 count_queries: bool = False) -> None:
+        """
+        Resets per-request state (read-your-writes, query budget), routes
+        the request to the shard of its <event_id> or <user_id> and applies
+        the route's statement timeout at the start of every Flask request.
+        With request_scoped_connection, also gives every request one
+        connection for all of its queries instead of a checkout per query;
+        that connection is held for the whole request, including time
+        spent on outbound HTTP calls.
+
+        With count_queries (dev/test), every response carries the number of
+        queries and the DB time of its request in X-DB-Query-Count and
+        X-DB-Query-Time-Ms headers, and statements repeated within one
+        request (N+1 patterns) are logged and counted in
+        X-DB-Repeated-Queries.
+        """
+        @app.before_request
+        def start_db_request():
+            self.start_request(self._limits.for_endpoint(request.endpoint))
+            view_args = request.view_args or {}
+            self.use_shard(view_args.get('user_id'), view_args.get('event_id'))
+            if request_scoped_connection:
+                self.bind_connection()
+            if count_queries:
+                self._local.counter = self._new_counter()
+
+        @app.after_request
+        def report_db_queries(response):
+            counter = getattr(self._local, 'counter', None)
+            if counter is not None:
+                response.headers.update(counter.headers())
+                counter.warn_repeated(request.endpoint)
+            return response
+
+        @app.teardown_request
+        def end_db_request(exc):
+            self._local.counter = None
+            self.release_connection()
+
+    def get_pool_stats(self) -> Dict[str, Any]:
         """
+        Example:
+            db.get_pool_stats()
+            {'checked_out': 1, 'waiting': 0, 'connection_errors': 0,
+             'wait_ms_histogram': {'le_1ms': 42, ...},
+             'pool': {'pool_size': 2, 'pool_available': 1, ...}}
+        """
+        stats = self._stats.to_dict()
+        stats['pool'] = self._pool.get_stats()
+        if self._replica is not None:
+            stats['replica'] = self._replica_stats.to_dict()
+            stats['replica']['pool'] = self._replica.get_stats()
+        if self._cache is not None:
+            stats['cache'] = self._cache.to_dict()
+        if self._lanes:
+            stats['lanes'] = {}
+            for name, (pool, lane_stats) in self._lanes.items():
+                stats['lanes'][name] = lane_stats.to_dict()
+                stats['lanes'][name]['pool'] = pool.get_stats()
+        if self._shards.pools:
+            stats['shards'] = []
+            for pool, shard_stats in zip(self._shards.pools,
+                                         self._shards.stats):
+                shard = shard_stats.to_dict()
+                shard['pool'] = pool.get_stats()
+                stats['shards'].append(shard)
+        return stats
+
+    @staticmethod
+    def _copy(data: Any) -> Any:
+        '''Shallow copy, so callers can't modify cached rows.'''
+        if isinstance(data, list):
+            return [dict(row) if isinstance(row, dict) else row
+                    for row in data]
+        if isinstance(data, dict):
+            return dict(data)
+        return data
+
+    def _read(self, query: str, params: Optional[Sequence[Any]],
+              one: bool, row_factory: Optional[RowFactory] = None) -> Any:
+        cache = None
+        if (self._cache is not None and queries.is_cached(query)
+                and row_factory is None and not self.in_transaction()):
+            cache = self._cache
+            key = cache.key(query, params)
+            data = cache.get(key)
+            if data is not MISSING:
+                return self._copy(data)
+            generation = cache.generation
+        # Cached rows come from the primary: a lagging replica's rows would
+        # outlive the invalidation of the write they are missing
+        with self._connection(read=cache is None) as conn:
+            if row_factory is not None:
+                cursor = conn.cursor(row_factory=row_factory)
+            else:
+                cursor = conn.cursor()
+            with cursor as cur:
+                with self._timed(conn, query, params):
+                    self._execute(cur, query, params)
+                    data = cur.fetchone() if one else cur.fetchall()
+        if cache is not None:
+            cache.put(key, query, data, generation)
+            return self._copy(data)
+        return data
+
+    def _invalidate(self, tables: Optional[FrozenSet[str]]) -> None:
+        '''Drops cached results of tables (None: all) after a write.
+
+        Inside transaction() this waits until the transaction ends.
+        '''
+        if self._cache is None:
+            return
+        if self.in_transaction():
+            dirty = getattr(self._local, 'dirty', None)
+            if dirty is None:
+                dirty = self._local.dirty = []
+            dirty.append(tables)
+            return
+        if tables is None:
+            self._cache.clear()
+        else:
+            self._cache.invalidate(tables)
+
+    def _flush_invalidations(self) -> None:
+        dirty = getattr(self._local, 'dirty', None)
+        self._local.dirty = None
+        for tables in dirty or ():
+            self._invalidate(tables)
+
+    def get_cache_stats(self) -> Optional[Dict[str, Any]]:
+        '''Returns hit/miss/eviction counters of the query cache.'''
+        return self._cache.to_dict() if self._cache is not None else None
+
+    def get(self, query: str, params: Optional[Sequence[Any]] = None,
+            row_factory: Optional[RowFactory] = None) -> List[Any]:
+        """
+        Rows are dicts unless another psycopg row_factory is given; bulk
+        reads can pass tuple_row or namedtuple_row to skip building a dict
+        per row.
+
         Example:
             db.fetch_all("SELECT * FROM Users")
             db.fetch_all("SELECT * FROM Users WHERE user_id = (%s)",
                     ("user1234",))
+            db.get("SELECT user_id, username FROM Users",
+                   row_factory=tuple_row)
         """
-        print(f'Database.get: query={query}', params)
-        with self._pool.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query=query, params=params)
-                data = cur.fetchall()
-        return data
+        return self._read(query, params, one=False, row_factory=row_factory)
 
-    def get_one(self, query: str, params: Optional[Sequence[Any]] = None
-                ) -> Optional[Dict[str, Any]]:
+    def get_one(self, query: str, params: Optional[Sequence[Any]] = None,
+                row_factory: Optional[RowFactory] = None
+                ) -> Optional[Any]:
         """
         Example:
             db.fetch_one("SELECT * FROM Users WHERE user_id = (%s)",
                 ("user1234",))
         """
-        print(f'Database.get_one: query={query}', params)
-        with self._pool.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query=query, params=params)
-                data = cur.fetchone()
-        return data
+        return self._read(query, params, one=True, row_factory=row_factory)
+
+    @contextmanager
+    def _committing(self, conn: Connection) -> Iterator[None]:
+        '''Commits a write, or rolls it back if it raises.
+
+        Inside transaction() the outer block decides instead.
+        '''
+        # Read-your-writes: keep this thread's reads on the primary
+        self._local.last_write = time.monotonic()
+        if self.in_transaction():
+            yield
+            return
+        try:
+            yield
+        except Exception as ex:
+            logger.error('DB update failed: %s', ex)
+            conn.rollback()
+            raise ex
+        else:
+            conn.commit()
 
     def set(self, query: str, params: Optional[Sequence[Any]] = None) -> None:
         """
@@ -54,14 +633,108 @@ class Database():
             db.set("UPDATE Users SET username = (%s) WHERE user_id = (%s)",
                     ("John Doe", "user1234"))
         """
-        print(f'Database.set: query={query}', params)
-        with self._pool.connection() as conn:
+        with self._connection() as conn:
             with conn.cursor() as cur:
-                try:
-                    cur.execute(query=query, params=params)
-                except Exception as ex:
-                    print('DB update failed:', ex)
-                    conn.rollback()
-                    raise ex
-                else:
-                    conn.commit()
+                with self._committing(conn):
+                    with self._timed(conn, query, params):
+                        self._execute(cur, query, params)
+        self._invalidate(tables_of(query))
+
+    def set_returning(self, query: str,
+                      params: Optional[Sequence[Any]] = None,
+                      one: bool = True) -> Any:
+        """
+        Runs a write with a RETURNING clause and commits it, returning the
+        first row (None if no row was written) or, with one=False, all
+        of them.
+
+        Example:
+            db.set_returning("UPDATE Users SET username = %s "
+                             "WHERE user_id = %s RETURNING *",
+                             ("John Doe", "user1234"))
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                with self._committing(conn):
+                    with self._timed(conn, query, params):
+                        self._execute(cur, query, params)
+                        data = cur.fetchone() if one else cur.fetchall()
+        self._invalidate(tables_of(query))
+        return data
+
+    def set_many(self, query: str, params_seq: Iterable[Sequence[Any]]
+                 ) -> int:
+        """
+        Runs one statement for every params tuple and commits once.
+        psycopg pipelines executemany(), so this is a single round trip.
+        Returns the number of affected rows.
+
+        Example:
+            db.set_many("INSERT INTO Users (user_id, username) "
+                        "VALUES (%s, %s)",
+                        [("user1234", "John Doe"), ("user5678", "Jane Doe")])
+        """
+        logger.debug('Database.set_many: query=%s', query)
+        start = time.perf_counter()
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                with self._committing(conn), self._bounded(conn):
+                    cur.executemany(query, params_seq)
+                count = cur.rowcount
+        self._count(query, (time.perf_counter() - start) * 1000)
+        self._invalidate(tables_of(query))
+        return count
+
+    @contextmanager
+    def pipeline(self) -> Iterator[Cursor]:
+        """
+        Runs every statement executed on the yielded cursor in psycopg
+        pipeline mode on one connection, and commits once at the end.
+        Rolls back everything if any statement fails.
+
+        Example:
+            with db.pipeline() as cur:
+                cur.execute("UPDATE Events SET attendee_limit = %s "
+                            "WHERE event_id = %s", (100, "abc"))
+                cur.execute("DELETE FROM Attendance WHERE event_id = %s",
+                            ("abc",))
+        """
+        logger.debug('Database.pipeline')
+        start = time.perf_counter()
+        with self._connection() as conn:
+            with self._committing(conn), self._bounded(conn):
+                with conn.pipeline():
+                    with conn.cursor() as cur:
+                        yield cur
+        # One round trip, whatever ran in it
+        self._count('PIPELINE', (time.perf_counter() - start) * 1000)
+        # Statements run in the block are unknown here
+        self._invalidate(None)
+
+    def copy_in(self, table: str, columns: Sequence[str],
+                rows: Iterable[Sequence[Any]]) -> int:
+        """
+        Bulk-loads rows with COPY ... FROM STDIN and commits once.
+        Returns the number of copied rows.
+
+        Example:
+            db.copy_in("Attendance", ("event_id", "user_email"),
+                       [("abc", "a@a.com"), ("abc", "b@b.com")])
+        """
+        # Our tables are created with unquoted (case-folded) names
+        statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(table.lower()),
+            sql.SQL(', ').join(sql.Identifier(c.lower()) for c in columns))
+        logger.debug('Database.copy_in: table=%s %s', table, columns)
+        count = 0
+        start = time.perf_counter()
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                with self._committing(conn), self._bounded(conn, False):
+                    with cur.copy(statement) as copy:
+                        for row in rows:
+                            copy.write_row(row)
+                            count += 1
+        self._count(f'COPY {table}', (time.perf_counter() - start) * 1000)
+        self._invalidate(frozenset([table.lower()]))
+        return count
@@ -0,0 +1,96 @@
+import os
+from typing import Optional
+
+from psycopg.types.json import Jsonb
+
+from db import queries
+from db.database import Database
+
+
+class JobQueue():
+    """Durable queue of background jobs, stored in the Jobs table.
+
+    A job is a kind, the event it belongs to and a payload whose 'items'
+    (e.g. the recipients of an invite) are its units of work. Workers
+    (worker.py) claim jobs with SELECT ... FOR UPDATE SKIP LOCKED and
+    report how many items were done; failed items are retried with
+    exponential backoff until max_attempts, then counted as failed.
+    Jobs live on the shard of their event, like its attendances.
+    Configured by JOB_MAX_ATTEMPTS, JOB_BACKOFF_SECONDS,
+    JOB_MAX_BACKOFF_SECONDS and JOB_LEASE_SECONDS.
+    """
+
+    INVITE_EMAILS = 'invite_emails'
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, db: Database, max_attempts: int = 5,
+                 backoff_seconds: float = 30.0,
+                 max_backoff_seconds: float = 3600.0,
+                 lease_seconds: float = 300.0) -> None:
+        self.db = db
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lease_seconds = lease_seconds
+
+    @staticmethod
+    def from_env(db: Database) -> 'JobQueue':
+        return JobQueue(
+            db,
+            int(os.getenv('JOB_MAX_ATTEMPTS', default=5)),
+            float(os.getenv('JOB_BACKOFF_SECONDS', default=30.0)),
+            float(os.getenv('JOB_MAX_BACKOFF_SECONDS', default=3600.0)),
+            float(os.getenv('JOB_LEASE_SECONDS', default=300.0)),
+        )
+
+    def enqueue(self, kind: str, event_id: str, payload: dict) -> int:
+        '''Stores a job, runnable right away, and returns its job_id.'''
+        row = self.db.set_returning(queries.INSERT_JOB, [
+            kind, event_id, Jsonb(payload), len(payload.get('items', [])),
+            self.max_attempts])
+        return row['job_id']
+
+    def claim(self) -> Optional[dict]:
+        '''Takes the next runnable job of the current shard, if any.'''
+        return self.db.set_returning(queries.CLAIM_JOB, [self.lease_seconds])
+
+    def backoff(self, attempts: int) -> float:
+        '''Seconds to wait before the attempt after attempts.'''
+        return min(self.backoff_seconds * 2 ** (attempts - 1),
+                   self.max_backoff_seconds)
+
+    def finish(self, job: dict, sent: int, failed_items: list,
+               error: Optional[str] = None) -> str:
+        '''
+        Records an attempt of a claimed job: sent items are done, and
+        failed_items are retried later, or given up on once the job ran
+        max_attempts times. Returns the new status.
+        '''
+        attempts = job['attempts']
+        delay = 0.0
+        failed = 0
+        if not failed_items:
+            status = self.DONE
+        elif attempts >= job['max_attempts']:
+            status = self.FAILED
+            failed = len(failed_items)
+        else:
+            status = self.QUEUED
+            delay = self.backoff(attempts)
+        payload = dict(job['payload'], items=failed_items)
+        self.db.set(queries.FINISH_JOB, [status, Jsonb(payload), sent, failed,
+                                         delay, error, job['job_id'],
+                                         attempts])
+        return status
+
+    def get_progress(self, event_id: str, job_id: int) -> Optional[dict]:
+        '''Returns the counts of a job of an event, None if unknown.'''
+        job = self.db.get_one(queries.JOB_PROGRESS, [job_id, event_id])
+        if job is None:
+            return None
+        job['pending'] = job['total'] - job['sent'] - job['failed']
+        return job
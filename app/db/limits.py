@@ -0,0 +1,44 @@
+import os
+from typing import Dict, Optional
+
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class QueryTimeout(ServiceUnavailable):
+    """Raised when a statement hits its statement_timeout, or a request
+    runs out of query-time budget. Rendered as JSON by the app's
+    HTTPException handler.
+    """
+
+    description = 'The request took too long to process. Please retry.'
+
+
+class QueryLimits():
+    """Bounds on how long queries may run.
+
+    statement_timeout_ms applies to every connection of the pool (Postgres
+    statement_timeout); routes maps Flask endpoint names to a tighter or
+    looser bound for the queries of that route. request_budget_ms caps the
+    total query time of one request. Configured by DB_STATEMENT_TIMEOUT_MS
+    and DB_REQUEST_BUDGET_MS (0 disables either).
+    """
+
+    def __init__(self, statement_timeout_ms: Optional[float] = 5000.0,
+                 request_budget_ms: Optional[float] = None,
+                 routes: Optional[Dict[str, float]] = None) -> None:
+        self.statement_timeout_ms = statement_timeout_ms or None
+        self.request_budget_ms = request_budget_ms or None
+        self.routes = dict(routes or {})
+
+    @staticmethod
+    def from_env(routes: Optional[Dict[str, float]] = None
+                 ) -> 'QueryLimits':
+        return QueryLimits(
+            float(os.getenv('DB_STATEMENT_TIMEOUT_MS', default=5000.0)),
+            float(os.getenv('DB_REQUEST_BUDGET_MS', default=0)),
+            routes,
+        )
+
+    def for_endpoint(self, endpoint: Optional[str]) -> Optional[float]:
+        '''Returns the statement timeout of a route, None for the default.'''
+        return self.routes.get(endpoint)
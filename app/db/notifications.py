@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Sequence
+
+import psycopg
+
+from db.admission import Overloaded
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription():
+    """The queue of attendance changes of one event for one SSE client."""
+
+    def __init__(self, shard: int, event_id: str, size: int) -> None:
+        self.shard = shard
+        self.event_id = event_id
+        self.changes = queue.Queue(size)
+        # Changes were dropped: the client has to reload the attendances
+        self.lagged = False
+
+    def put(self, change: str) -> None:
+        try:
+            self.changes.put_nowait(change)
+        except queue.Full:
+            self.lagged = True
+
+
+class AttendanceFeed():
+    """Fans out attendance changes to the SSE streams of this worker.
+
+    The attendance_notify triggers NOTIFY each inserted or changed
+    attendance on CHANNEL when its transaction commits. While a shard has
+    subscribers, one thread LISTENs on one dedicated connection to it (not
+    a pooled one, which is reset between uses) and hands every change to
+    the subscribers of its event, so the streams of a worker share a
+    single connection per shard. A subscriber that falls behind, or
+    misses changes while the listener reconnects, is sent a resync event
+    and reloads. Every stream holds a uWSGI thread, so max_subscribers
+    has to stay below the worker's threads. Configured by
+    STREAM_MAX_SUBSCRIBERS, STREAM_QUEUE_SIZE, STREAM_HEARTBEAT_SECONDS,
+    STREAM_MAX_SECONDS and RETRY_AFTER_SECONDS.
+    """
+
+    CHANNEL = 'attendance_changes'
+    # EventSource waits this long (ms) before reconnecting
+    RECONNECT_MS = 3000
+
+    def __init__(self, conninfos: Sequence[str], max_subscribers: int = 8,
+                 queue_size: int = 100, heartbeat_seconds: float = 15.0,
+                 max_seconds: float = 300.0, retry_after: int = 1,
+                 reconnect_seconds: float = 1.0) -> None:
+        self.conninfos = list(conninfos)
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_seconds = max_seconds
+        self.retry_after = retry_after
+        self.reconnect_seconds = reconnect_seconds
+        self._lock = threading.Lock()
+        self._subscribers: List[Dict[str, List[Subscription]]] = [
+            {} for _ in self.conninfos]
+        self._listeners: List[threading.Thread] = [None] * len(conninfos)
+        self.count = 0
+        self.rejected = 0
+
+    @staticmethod
+    def from_env(conninfos: Sequence[str]) -> 'AttendanceFeed':
+        return AttendanceFeed(
+            conninfos,
+            int(os.getenv('STREAM_MAX_SUBSCRIBERS', default=8)),
+            int(os.getenv('STREAM_QUEUE_SIZE', default=100)),
+            float(os.getenv('STREAM_HEARTBEAT_SECONDS', default=15.0)),
+            float(os.getenv('STREAM_MAX_SECONDS', default=300.0)),
+            int(os.getenv('RETRY_AFTER_SECONDS', default=1)),
+        )
+
+    def subscribe(self, shard: int, event_id: str) -> Subscription:
+        '''Subscribes to the changes of an event, or raises Overloaded.'''
+        subscription = Subscription(shard, event_id, self.queue_size)
+        with self._lock:
+            if self.count >= self.max_subscribers:
+                self.rejected += 1
+                raise Overloaded(retry_after=self.retry_after)
+            self._subscribers[shard].setdefault(event_id, []).append(
+                subscription)
+            self.count += 1
+            if self._listeners[shard] is None:
+                self._listeners[shard] = threading.Thread(
+                    target=self._listen, args=(shard,), daemon=True,
+                    name=f'attendance-feed-{shard}')
+                self._listeners[shard].start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscribers[subscription.shard].get(
+                subscription.event_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+                self.count -= 1
+            if not subscriptions:
+                self._subscribers[subscription.shard].pop(
+                    subscription.event_id, None)
+
+    def publish(self, shard: int, payload: str) -> None:
+        '''Hands a NOTIFY payload to the subscribers of its event.'''
+        try:
+            event_id = json.loads(payload)['event_id']
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Bad %s payload: %s', self.CHANNEL, payload)
+            return
+        with self._lock:
+            subscriptions = list(self._subscribers[shard].get(event_id, ()))
+        for subscription in subscriptions:
+            subscription.put(payload)
+
+    def resync(self, shard: int) -> None:
+        '''Makes every subscriber of a shard reload.'''
+        with self._lock:
+            subscriptions = [subscription
+                             for subscriptions in self._subscribers[shard]
+                             .values()
+                             for subscription in subscriptions]
+        for subscription in subscriptions:
+            subscription.lagged = True
+
+    def _keep_listening(self, shard: int) -> bool:
+        # Deciding to stop and clearing the slot under the lock lets
+        # subscribe() start a new listener without ever running two
+        with self._lock:
+            if self._subscribers[shard]:
+                return True
+            self._listeners[shard] = None
+            return False
+
+    def _listen(self, shard: int) -> None:
+        lost = False
+        while True:
+            try:
+                with psycopg.connect(self.conninfos[shard],
+                                     autocommit=True) as conn:
+                    conn.execute(f'LISTEN {self.CHANNEL}')
+                    if lost:
+                        # Changes made while disconnected were not seen
+                        self.resync(shard)
+                        lost = False
+                    while self._keep_listening(shard):
+                        for notify in conn.notifies(
+                                timeout=self.heartbeat_seconds):
+                            self.publish(shard, notify.payload)
+                    return
+            except psycopg.Error as e:
+                logger.warning('Listener of shard %s lost: %s', shard, e)
+                lost = True
+                time.sleep(self.reconnect_seconds)
+                if not self._keep_listening(shard):
+                    return
+
+    def stream(self, subscription: Subscription) -> Iterator[str]:
+        """
+        Yields a subscription's Server-Sent Events for at most max_seconds,
+        then unsubscribes; EventSource reconnects by itself, which spreads
+        long-lived dashboards across workers. A comment line every
+        heartbeat_seconds keeps proxies from timing out and detects
+        clients that went away.
+        """
+        try:
+            yield f'retry: {self.RECONNECT_MS}\n\n'
+            deadline = time.monotonic() + self.max_seconds
+            while time.monotonic() < deadline:
+                if subscription.lagged:
+                    subscription.lagged = False
+                    while not subscription.changes.empty():
+                        subscription.changes.get_nowait()
+                    yield 'event: resync\ndata: {}\n\n'
+                try:
+                    change = subscription.changes.get(
+                        timeout=self.heartbeat_seconds)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'event: attendance\ndata: {change}\n\n'
+        finally:
+            self.unsubscribe(subscription)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'max_subscribers': self.max_subscribers,
+                'subscribers': self.count,
+                'rejected': self.rejected,
+                'listening_shards': [shard for shard, listener
+                                     in enumerate(self._listeners)
+                                     if listener is not None],
+            }
@@ -0,0 +1,307 @@
+"""
+Named queries used by the controllers.
+
+Database executes every registered query as a server-side prepared
+statement (psycopg prepare=True), so Postgres parses and plans it once per
+connection instead of on every call. Queries registered with warm=True are
+also prepared as soon as a pooled connection is opened (see
+Database.prepare_statements), before the worker serves its first request.
+Only register statements that are safe to run with all-NULL parameters as
+warm: reads, and UPDATE/DELETE filtered by the parameters.
+"""
+from typing import Dict, List
+
+
+class NamedQuery():
+    def __init__(self, name: str, sql: str, warm: bool,
+                 cache: bool = False) -> None:
+        self.name = name
+        # Collapse the indentation/backslash whitespace of inline SQL
+        self.sql = ' '.join(sql.split())
+        self.warm = warm
+        self.cache = cache
+        self.param_count = self.sql.count('%s')
+        self.is_read = self.sql.split(None, 1)[0].upper() == 'SELECT'
+
+
+_by_name: Dict[str, NamedQuery] = {}
+_by_sql: Dict[str, NamedQuery] = {}
+
+
+def register(name: str, sql: str, warm: bool = True,
+             cache: bool = False) -> str:
+    """Registers a query and returns its normalized SQL text.
+
+    cache=True lets Database serve the query from its QueryCache, if one
+    is configured; only use it for lookups that tolerate a few seconds of
+    staleness across workers.
+    """
+    query = NamedQuery(name, sql, warm, cache)
+    if name in _by_name and _by_name[name].sql != query.sql:
+        raise ValueError(f'Query {name} is already registered')
+    _by_name[name] = query
+    _by_sql[query.sql] = query
+    return query.sql
+
+
+def is_registered(sql: str) -> bool:
+    return sql in _by_sql
+
+
+def is_cached(sql: str) -> bool:
+    query = _by_sql.get(sql)
+    return query is not None and query.cache
+
+
+def get(name: str) -> NamedQuery:
+    return _by_name[name]
+
+
+def warm_queries() -> List[NamedQuery]:
+    return [q for q in _by_name.values() if q.warm]
+
+
+# Session
+SET_STATEMENT_TIMEOUT = register(
+    'set_statement_timeout',
+    # Transaction-local, so it never leaks to the next user of the
+    # pooled connection
+    "SELECT set_config('statement_timeout', %s, true)",
+    warm=False)
+
+# Users
+USER_BY_ID = register(
+    'user_by_id',
+    # Columns listed, not *: a prepared statement whose result columns
+    # change (ALTER TABLE ... ADD COLUMN) fails until it is re-prepared
+    """SELECT user_id, org_name, username, created_at, updated_at
+       FROM Users WHERE user_id = %s""",
+    cache=True)
+INSERT_USER = register(
+    'insert_user',
+    "INSERT INTO Users (user_id, org_name, username) VALUES (%s, %s, %s)",
+    warm=False)
+
+# Events
+EVENT_BY_ID = register(
+    'event_by_id',
+    "SELECT * FROM Events WHERE event_id = %s",
+    cache=True)
+EVENTS_BY_USER = register(
+    'events_by_user',
+    "SELECT * FROM Events WHERE user_id = %s",
+    cache=True)
+EVENT_WITH_ORGANIZER = register(
+    'event_with_organizer',
+    """SELECT *
+       FROM Events
+       JOIN Users ON Users.user_id = Events.user_id
+       WHERE event_id = %s""",
+    cache=True)
+INSERT_EVENT = register(
+    'insert_event',
+    """INSERT INTO Events
+       VALUES (%s, %s, %s, %s, ROW(%s, %s, %s, %s), %s, %s, %s)""",
+    warm=False)
+
+# Attendance
+# Attendance.FIELDS, returned by the prepared state transitions instead of
+# *, so adding a column (e.g. checked_in_at) doesn't break them
+_ATTENDANCE_FIELDS = """event_id, user_email, user_role, personal_code,
+    is_invited, is_rsvped, is_checked_in, created_at, updated_at"""
+ATTENDANCES_BY_EVENT = register(
+    'attendances_by_event',
+    # Columns in Attendance.FIELDS order, for tuple rows
+    """SELECT event_id, user_email, user_role, personal_code, is_invited,
+       is_rsvped, is_checked_in, created_at, updated_at
+       FROM Attendance WHERE event_id = %s""")
+INSERT_ATTENDANCES = register(
+    'insert_attendances',
+    # Bulk invite: one statement (and one plan) for any number of rows;
+    # the rows returned are the ones not already invited
+    """INSERT INTO Attendance
+       (event_id, user_email, user_role, personal_code)
+       SELECT %s, invite.user_email, 'attendee', invite.personal_code
+       FROM unnest(%s::varchar[], %s::varchar[])
+            AS invite(user_email, personal_code)
+       ON CONFLICT (event_id, user_email) DO NOTHING
+       RETURNING user_email, personal_code""",
+    warm=False)
+# State transitions return the updated row, so each is one round trip;
+# no row means an invalid event_id/personal_code
+RSVP = register(
+    'rsvp',
+    f"""UPDATE Attendance SET is_rsvped = True
+       WHERE event_id = %s AND personal_code = %s
+       RETURNING {_ATTENDANCE_FIELDS}""")
+UNRSVP = register(
+    'unrsvp',
+    f"""UPDATE Attendance SET is_rsvped = False
+       WHERE event_id = %s AND personal_code = %s
+       RETURNING {_ATTENDANCE_FIELDS}""")
+CHECK_IN = register(
+    'check_in',
+    # checked_in_at is the time of the last change of is_checked_in: the
+    # last-writer-wins clock of offline check-in sync (SYNC_CHECK_INS)
+    f"""UPDATE Attendance SET is_checked_in = True,
+       checked_in_at = current_timestamp
+       WHERE event_id = %s AND personal_code = %s
+       RETURNING {_ATTENDANCE_FIELDS}""")
+CHECK_IN_BATCH = register(
+    'check_in_batch',
+    # One statement for a batch of scans. The outer SELECT sees Attendance
+    # as it was before the UPDATE, so a code that exists but was not
+    # updated was already checked in.
+    """WITH codes AS (
+           SELECT DISTINCT unnest(%s::varchar[]) AS personal_code
+       ), updated AS (
+           UPDATE Attendance SET is_checked_in = True,
+                  checked_in_at = current_timestamp
+           WHERE event_id = %s
+             AND personal_code IN (SELECT personal_code FROM codes)
+             AND is_checked_in IS NOT TRUE
+           RETURNING personal_code
+       )
+       SELECT codes.personal_code,
+              CASE WHEN updated.personal_code IS NOT NULL THEN 'checked_in'
+                   WHEN Attendance.personal_code IS NOT NULL
+                       THEN 'already_checked_in'
+                   ELSE 'invalid'
+              END AS result
+       FROM codes
+       LEFT JOIN updated ON updated.personal_code = codes.personal_code
+       LEFT JOIN Attendance ON Attendance.event_id = %s
+            AND Attendance.personal_code = codes.personal_code""",
+    warm=False)
+ROSTER_VERSION = register(
+    'roster_version',
+    # Changes with every write to the event's attendances (EventStats
+    # triggers); 0 before the first one
+    """SELECT coalesce(
+           (extract(epoch FROM EventStats.updated_at) * 1000000)::bigint, 0)
+           AS version
+       FROM Events LEFT JOIN EventStats USING (event_id)
+       WHERE Events.event_id = %s""",
+    warm=False)
+ROSTER = register(
+    'roster',
+    # Columns in Attendance.ROSTER_FIELDS order, for tuple rows
+    """SELECT personal_code, user_email, is_invited, is_rsvped,
+       is_checked_in, checked_in_at
+       FROM Attendance WHERE event_id = %s""",
+    warm=False)
+SYNC_CHECK_INS = register(
+    'sync_check_ins',
+    # Merges an offline check-in log: per code, the latest entry is applied
+    # if it is newer than the last change on the server (last writer
+    # wins), so replaying a log changes nothing. Device clocks ahead of the
+    # server are capped at its time.
+    """WITH log AS (
+           SELECT DISTINCT ON (personal_code) personal_code, is_checked_in,
+                  least(checked_in_at, current_timestamp) AS checked_in_at
+           FROM unnest(%s::varchar[], %s::boolean[], %s::timestamptz[])
+                AS log(personal_code, is_checked_in, checked_in_at)
+           ORDER BY personal_code, checked_in_at DESC
+       ), applied AS (
+           UPDATE Attendance
+           SET is_checked_in = log.is_checked_in,
+               checked_in_at = log.checked_in_at
+           FROM log
+           WHERE Attendance.event_id = %s
+             AND Attendance.personal_code = log.personal_code
+             AND (Attendance.checked_in_at IS NULL
+                  OR Attendance.checked_in_at < log.checked_in_at)
+           RETURNING Attendance.personal_code
+       )
+       SELECT log.personal_code,
+              CASE WHEN applied.personal_code IS NOT NULL THEN 'applied'
+                   WHEN Attendance.personal_code IS NOT NULL
+                       THEN 'superseded'
+                   ELSE 'invalid'
+              END AS result
+       FROM log
+       LEFT JOIN applied ON applied.personal_code = log.personal_code
+       LEFT JOIN Attendance ON Attendance.event_id = %s
+            AND Attendance.personal_code = log.personal_code""",
+    warm=False)
+
+# Event stats (EventStats, kept by triggers on Attendance). Not warm, like
+# the jobs below.
+EVENT_STATS = register(
+    'event_stats',
+    # An event without attendances has no EventStats row yet
+    """SELECT Events.event_id, coalesce(total, 0) AS total,
+       coalesce(invited, 0) AS invited, coalesce(rsvped, 0) AS rsvped,
+       coalesce(checked_in, 0) AS checked_in, EventStats.updated_at
+       FROM Events LEFT JOIN EventStats USING (event_id)
+       WHERE Events.event_id = %s""",
+    warm=False)
+LOCK_EVENT_STATS = register(
+    'lock_event_stats',
+    # Holds off the triggers of concurrent writes until the rebuild commits
+    """SELECT total, invited, rsvped, checked_in FROM EventStats
+       WHERE event_id = %s FOR UPDATE""",
+    warm=False)
+REBUILD_EVENT_STATS = register(
+    'rebuild_event_stats',
+    """INSERT INTO EventStats (event_id, total, invited, rsvped, checked_in)
+       SELECT %s, count(*), count(*) FILTER (WHERE is_invited),
+              count(*) FILTER (WHERE is_rsvped),
+              count(*) FILTER (WHERE is_checked_in)
+       FROM Attendance WHERE event_id = %s
+       ON CONFLICT (event_id) DO UPDATE SET
+           total = EXCLUDED.total, invited = EXCLUDED.invited,
+           rsvped = EXCLUDED.rsvped, checked_in = EXCLUDED.checked_in,
+           updated_at = current_timestamp
+       RETURNING total, invited, rsvped, checked_in""",
+    warm=False)
+EVENT_IDS = register(
+    'event_ids',
+    "SELECT event_id FROM Events ORDER BY event_id",
+    warm=False)
+
+# Jobs (db/jobs.py). Not warm: a database created before the Jobs table
+# must still prepare the other statements.
+INSERT_JOB = register(
+    'insert_job',
+    """INSERT INTO Jobs (kind, event_id, payload, total, max_attempts)
+       VALUES (%s, %s, %s, %s, %s)
+       RETURNING job_id""",
+    warm=False)
+CLAIM_JOB = register(
+    'claim_job',
+    # SKIP LOCKED: concurrent workers each take a different job instead of
+    # queueing on the same row. A running job whose lease expired (its
+    # worker died) is claimed again.
+    """UPDATE Jobs
+       SET status = 'running', attempts = attempts + 1,
+           locked_at = current_timestamp
+       WHERE job_id = (
+           SELECT job_id FROM Jobs
+           WHERE (status = 'queued' AND run_at <= current_timestamp)
+              OR (status = 'running' AND locked_at <
+                  current_timestamp - make_interval(secs => %s))
+           ORDER BY run_at
+           LIMIT 1
+           FOR UPDATE SKIP LOCKED)
+       RETURNING *""",
+    warm=False)
+FINISH_JOB = register(
+    'finish_job',
+    # attempts fences off a worker whose lease expired and was reclaimed
+    """UPDATE Jobs
+       SET status = %s, payload = %s, sent = sent + %s, failed = failed + %s,
+           run_at = current_timestamp + make_interval(secs => %s),
+           last_error = %s, locked_at = NULL
+       WHERE job_id = %s AND attempts = %s""",
+    warm=False)
+JOB_PROGRESS = register(
+    'job_progress',
+    # failed_items: the items whose last attempt failed (they have a
+    # reason), without shipping the whole payload
+    """SELECT job_id, kind, event_id, status, total, sent, failed, attempts,
+       max_attempts, run_at, last_error, created_at,
+       jsonb_path_query_array(payload, '$.items[*] ? (exists(@.reason))')
+           AS failed_items
+       FROM Jobs WHERE job_id = %s AND event_id = %s""",
+    warm=False)
@@ -0,0 +1,46 @@
+import logging
+from collections import Counter
+from typing import Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter():
+    """Counts the queries and DB time of one request (or block).
+
+    Statements are grouped by shape, i.e. their parameterized SQL text, so
+    the same statement run once per item of a loop (an N+1 pattern) shows
+    up as one shape with a high count.
+    """
+
+    def __init__(self, repeat_threshold: int = 3,
+                 not_repeats: Iterable[str] = ()) -> None:
+        self.repeat_threshold = repeat_threshold
+        # Shapes expected once per statement, e.g. a set_config
+        self.not_repeats = frozenset(' '.join(query.split())
+                                     for query in not_repeats)
+        self.count = 0
+        self.total_ms = 0.0
+        self.shapes: Counter = Counter()
+
+    def record(self, query: str, duration_ms: float) -> None:
+        self.count += 1
+        self.total_ms += duration_ms
+        self.shapes[' '.join(query.split())] += 1
+
+    def repeated(self) -> Dict[str, int]:
+        '''Returns the shapes run at least repeat_threshold times.'''
+        return {shape: count for shape, count in self.shapes.items()
+                if count >= self.repeat_threshold
+                and shape not in self.not_repeats}
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            'X-DB-Query-Count': str(self.count),
+            'X-DB-Query-Time-Ms': f'{self.total_ms:.1f}',
+            'X-DB-Repeated-Queries': str(len(self.repeated())),
+        }
+
+    def warn_repeated(self, where: str) -> None:
+        for shape, count in self.repeated().items():
+            logger.warning('Possible N+1 in %s: %d x %s', where, count, shape)
@@ -0,0 +1,80 @@
+import os
+import re
+import zlib
+from typing import Dict, Optional, Sequence
+
+from db.stats import PoolStats
+
+# Shard-tagged event IDs: 'S', two-digit shard number, random part.
+# Untagged (pre-sharding) IDs start with 'b' and live on shard 0.
+_TAGGED_EVENT_ID = re.compile(r'^S(\d{2})[A-Za-z0-9]+$')
+
+
+class ShardRouter():
+    """Maps organizations, and their users, events and attendances, to
+    database shards.
+
+    Shard 0 is Database's primary pool; pools holds the pools of shards
+    1..n. An organization is the domain of its users' emails (what Google
+    sign-in reports as org_name). Its shard is pinned in orgs, or picked
+    by hashing the domain. Events are created on their organizer's shard
+    and carry the shard in their ID, and attendances live with their
+    event, so no lookup is needed to route a request.
+
+    Hashing depends on the number of shards: before adding one, pin the
+    existing organizations in orgs. Configured by DATABASE_SHARD_URLS and
+    DB_SHARD_ORGS (e.g. "columbia.edu=1,example.com=2").
+    """
+
+    def __init__(self, pools: Sequence = (),
+                 orgs: Optional[Dict[str, int]] = None) -> None:
+        self.pools = list(pools)
+        self.stats = [PoolStats() for _ in self.pools]
+        self.count = len(self.pools) + 1
+        self.orgs = {org.lower(): shard for org, shard in (orgs or {}).items()}
+        for org, shard in self.orgs.items():
+            if not 0 <= shard < self.count:
+                raise ValueError(f'Invalid shard {shard} for {org}')
+
+    @staticmethod
+    def parse_orgs(value: Optional[str]) -> Dict[str, int]:
+        '''Parses "org=shard,org=shard" (DB_SHARD_ORGS).'''
+        orgs = {}
+        for item in (value or '').split(','):
+            if item.strip():
+                org, shard = item.split('=')
+                orgs[org.strip()] = int(shard)
+        return orgs
+
+    @staticmethod
+    def org_of(user_id: str) -> str:
+        return user_id.rsplit('@', 1)[-1].lower()
+
+    def shard_of_org(self, org: str) -> int:
+        org = org.lower()
+        if org in self.orgs:
+            return self.orgs[org]
+        # crc32, unlike hash(), is the same in every worker and release
+        return zlib.crc32(org.encode('utf-8')) % self.count
+
+    def shard_of_user(self, user_id: str) -> int:
+        return self.shard_of_org(self.org_of(user_id))
+
+    def shard_of_event(self, event_id: str) -> int:
+        match = _TAGGED_EVENT_ID.match(event_id)
+        if match is None:
+            return 0
+        shard = int(match.group(1))
+        # An ID for a shard we don't have can't exist; let shard 0 404 it
+        return shard if shard < self.count else 0
+
+    def tag_event_id(self, event_id: str, shard: int) -> str:
+        '''Prefixes a new event ID with the shard it is created on.'''
+        if self.count == 1:
+            return event_id
+        return f'S{shard:02d}{event_id}'
+
+    @staticmethod
+    def from_env(pools: Sequence) -> 'ShardRouter':
+        return ShardRouter(pools,
+                           ShardRouter.parse_orgs(os.getenv('DB_SHARD_ORGS')))
@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+import random
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class SlowQueryLog():
+    """Structured log of queries slower than a threshold.
+
+    A sample of the slow queries also gets its EXPLAIN plan captured, so we
+    can see which attendance/event queries degrade as the tables grow.
+    Configured by DB_SLOW_QUERY_MS, DB_EXPLAIN_SAMPLE_RATE and
+    DB_SLOW_QUERY_LOG_SIZE.
+    """
+
+    def __init__(self, threshold_ms: float = 200.0,
+                 explain_sample_rate: float = 0.0,
+                 max_entries: int = 100) -> None:
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> 'SlowQueryLog':
+        return SlowQueryLog(
+            float(os.getenv('DB_SLOW_QUERY_MS', default=200.0)),
+            float(os.getenv('DB_EXPLAIN_SAMPLE_RATE', default=0.05)),
+            int(os.getenv('DB_SLOW_QUERY_LOG_SIZE', default=100)),
+        )
+
+    def is_slow(self, duration_ms: float) -> bool:
+        return duration_ms >= self.threshold_ms
+
+    def should_explain(self) -> bool:
+        return random.random() < self.explain_sample_rate
+
+    @staticmethod
+    def explain_statement(query: str) -> str:
+        """
+        EXPLAIN ANALYZE runs the statement, so only do that for a plain
+        SELECT: a WITH can hide an UPDATE (CHECK_IN_BATCH, SYNC_CHECK_INS).
+        """
+        if query.lstrip().split(None, 1)[0].upper() == 'SELECT':
+            return f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}'
+        return f'EXPLAIN (FORMAT JSON) {query}'
+
+    def record(self, query: str, params: Optional[Sequence[Any]],
+               duration_ms: float, plan: Optional[Any] = None) -> None:
+        entry = {
+            'event': 'slow_query',
+            'duration_ms': round(duration_ms, 3),
+            'threshold_ms': self.threshold_ms,
+            'query': ' '.join(query.split()),
+            'params': list(params) if params is not None else None,
+            'plan': plan,
+        }
+        with self._lock:
+            self._entries.append(entry)
+        logger.warning(json.dumps(entry, default=str))
+
+    def entries(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._entries)
@@ -0,0 +1,73 @@
+import threading
+from typing import Dict, List
+
+
+class PoolStats():
+    """Thread-safe counters around pool checkouts.
+
+    psycopg_pool already reports pool-side numbers (size, available,
+    requests_waiting, ...). This adds what it cannot see: how many
+    connections our code holds right now and how long each checkout waited.
+    """
+
+    # Upper bounds (ms) of the checkout wait-time histogram buckets.
+    # The last bucket counts everything above the highest bound.
+    WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.connection_errors = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+        self.wait_histogram: List[int] = [0] * (len(self.WAIT_BUCKETS_MS) + 1)
+
+    def wait_started(self) -> None:
+        with self._lock:
+            self.waiting += 1
+
+    def checked_out_after(self, wait_ms: float) -> None:
+        with self._lock:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.wait_ms_total += wait_ms
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+            self.wait_histogram[self._bucket(wait_ms)] += 1
+
+    def checkout_failed(self) -> None:
+        with self._lock:
+            self.waiting -= 1
+            self.connection_errors += 1
+
+    def checked_in(self) -> None:
+        with self._lock:
+            self.checked_out -= 1
+
+    def _bucket(self, wait_ms: float) -> int:
+        for i, bound in enumerate(self.WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                return i
+        return len(self.WAIT_BUCKETS_MS)
+
+    def histogram(self) -> Dict[str, int]:
+        labels = [f'le_{b}ms' for b in self.WAIT_BUCKETS_MS]
+        labels.append(f'gt_{self.WAIT_BUCKETS_MS[-1]}ms')
+        return dict(zip(labels, self.wait_histogram))
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'checked_out': self.checked_out,
+                'max_checked_out': self.max_checked_out,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'connection_errors': self.connection_errors,
+                'wait_ms_total': round(self.wait_ms_total, 3),
+                'wait_ms_max': round(self.wait_ms_max, 3),
+                'wait_ms_histogram': self.histogram(),
+            }
@@ -5,6 +5,8 @@ import app
 
 @postfork
 def init_uwsgi():
+    # Opens this worker's pool; each new connection prepares the registered
+    # queries (db/queries.py) before the worker serves its first request
     app.init(app.app)
 
 
@@ -1,4 +1,23 @@
+import base64
+import hashlib
+import hmac
+from typing import Any, Dict, List, Mapping, Sequence, Union
+
+Row = Union[Mapping[str, Any], Sequence[Any]]
+
+
 class Attendance:
+    # Column order of the Attendance table; also the order of tuple rows
+    FIELDS = ('event_id', 'user_email', 'user_role', 'personal_code',
+              'is_invited', 'is_rsvped', 'is_checked_in',
+              'created_at', 'updated_at')
+    __slots__ = FIELDS
+    # Attendee columns of an offline roster, keyed by personal_code
+    ROSTER_FIELDS = ('user_email', 'is_invited', 'is_rsvped',
+                     'is_checked_in', 'checked_in_at')
+    # HMAC bytes kept in a personal code: 16 base64url characters
+    PERSONAL_CODE_BYTES = 12
+
     def __init__(self, event_id, user_email,
                  user_role, personal_code,
                  is_invited, is_rsvped, is_checked_in,
@@ -14,9 +33,62 @@ class Attendance:
         self.updated_at = updated_at
 
     @staticmethod
-    def generate_personal_code(event_id, user_email) -> str:
-        # Generate personal_code with simple base64 encoding on utf-8
-        return bytes(f'{event_id}:{user_email}', 'utf-8').hex()
+    def from_row(row: Row) -> 'Attendance':
+        '''Builds an Attendance from a dict row or a FIELDS-ordered tuple.'''
+        if isinstance(row, Mapping):
+            return Attendance(*(row[f] for f in Attendance.FIELDS))
+        return Attendance(*row)
+
+    @staticmethod
+    def row_to_dict(row: Row) -> Dict[str, Any]:
+        '''Serializes a row directly, without building an Attendance.'''
+        if isinstance(row, dict):
+            return {f: row[f] for f in Attendance.FIELDS}
+        return dict(zip(Attendance.FIELDS, row))
+
+    @staticmethod
+    def rows_to_dicts(rows: Sequence[Row]) -> List[Dict[str, Any]]:
+        '''Serializes a whole result set; the attendance-list hot path.'''
+        if rows and isinstance(rows[0], dict):
+            return [Attendance.row_to_dict(row) for row in rows]
+        return [{'event_id': event_id,
+                 'user_email': user_email,
+                 'user_role': user_role,
+                 'personal_code': personal_code,
+                 'is_invited': is_invited,
+                 'is_rsvped': is_rsvped,
+                 'is_checked_in': is_checked_in,
+                 'created_at': created_at,
+                 'updated_at': updated_at}
+                for (event_id, user_email, user_role, personal_code,
+                     is_invited, is_rsvped, is_checked_in,
+                     created_at, updated_at) in rows]
+
+    @staticmethod
+    def rows_to_roster(rows: Sequence[Sequence[Any]]
+                       ) -> Dict[str, List[Any]]:
+        '''Maps personal_code to ROSTER_FIELDS values, from ROSTER rows.'''
+        return {personal_code: [user_email, is_invited, is_rsvped,
+                                is_checked_in,
+                                checked_in_at.isoformat() if checked_in_at
+                                else None]
+                for (personal_code, user_email, is_invited, is_rsvped,
+                     is_checked_in, checked_in_at) in rows}
+
+    @staticmethod
+    def generate_personal_code(event_id, user_email, key: bytes) -> str:
+        '''
+        A fixed-length code that can't be derived without key: the
+        HMAC-SHA256 of "event_id:user_email", cut to PERSONAL_CODE_BYTES
+        and base64url-encoded. Codes generated before (the hex of
+        "event_id:user_email") are stored as they were and stay valid.
+        '''
+        if not key:
+            raise ValueError('A personal code key is required')
+        digest = hmac.new(key, f'{event_id}:{user_email}'.encode('utf-8'),
+                          hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(
+            digest[:Attendance.PERSONAL_CODE_BYTES]).decode('ascii')
 
     def to_dict(self) -> dict:
         return {
@@ -2,9 +2,14 @@ import uuid
 import base64
 import re
 from ast import literal_eval
+from typing import Any, Mapping
 
 
 class Event:
+    __slots__ = ('event_id', 'user_id', 'event_name', 'event_description',
+                 'event_location', 'event_start_time', 'event_end_time',
+                 'attendee_limit')
+
     def __init__(self, user_id, event_name, event_description, event_location,
                  event_start_time, event_end_time,
                  attendee_limit, event_id=None):
@@ -20,20 +25,49 @@ class Event:
         self.event_end_time = event_end_time
         self.attendee_limit = attendee_limit
 
+    @staticmethod
+    def from_row(row: Mapping[str, Any]) -> 'Event':
+        '''Builds an Event from an Events row.'''
+        return Event(row['user_id'], row['event_name'],
+                     row['event_description'],
+                     Event.format_location(row['event_location']),
+                     row['event_start_time'], row['event_end_time'],
+                     row['attendee_limit'], row['event_id'])
+
+    @staticmethod
+    def format_location(loc: str) -> str:
+        # 'event_location' returns in format:
+        # '(columbia,12.2,23.4,address)' - Need to fix it before insert
+
+        # Removes parentheses
+        loc_str = re.sub("[()]", "", loc)
+
+        # Make it a list of strings
+        loc_str_list = list(map(str, loc_str.split(',')))
+
+        # Get each field
+        loc_name = loc_str_list[0]
+        lat = float(loc_str_list[1])
+        long = float(loc_str_list[2])
+        address = loc_str_list[3]
+
+        return f'(\'{loc_name}\', {lat}, {long}, \'{address}\')'
+
     def generate_id(self):
         self.event_id = re.sub("[^0-9a-zA-Z]+", "",
                                str(base64.b64encode(uuid.uuid4().bytes)))
 
     def to_dict(self):
+        location = literal_eval(self.event_location)
         return {
             'event_id': self.event_id,
             'user_id': self.user_id,
             'event_name': self.event_name,
             'event_description': self.event_description,
-            'location': literal_eval(self.event_location)[0].strip('"'),
-            'lat': literal_eval(self.event_location)[1],
-            'long': literal_eval(self.event_location)[2],
-            'address': literal_eval(self.event_location)[3].strip('"'),
+            'location': location[0].strip('"'),
+            'lat': location[1],
+            'long': location[2],
+            'address': location[3].strip('"'),
             'start_time': self.event_start_time,
             'end_time': self.event_end_time,
             'attendee_limit': self.attendee_limit,
@@ -1,9 +1,18 @@
+from typing import Any, Mapping
+
+
 class User:
+    __slots__ = ('user_id', 'org_name', 'username')
+
     def __init__(self, user_id, org_name, username):
         self.user_id = user_id
         self.org_name = org_name
         self.username = username
 
+    @staticmethod
+    def from_row(row: Mapping[str, Any]) -> 'User':
+        return User(row['user_id'], row['org_name'], row['username'])
+
     def to_dict(self):
         return {
             'user_id': self.user_id,
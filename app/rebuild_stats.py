@@ -0,0 +1,39 @@
+import logging
+import sys
+
+import app
+from db import queries
+
+
+def events(db, event_ids):
+    '''Yields (shard, event_id) of the given events, or of all events.'''
+    if event_ids:
+        for event_id in event_ids:
+            yield db.use_shard(event_id=event_id), event_id
+        return
+    for shard in range(db.shard_count):
+        db.use_shard(shard=shard)
+        for row in db.get(queries.EVENT_IDS):
+            yield shard, row['event_id']
+
+
+def main(event_ids):
+    """Rebuilds the attendance counters of the given events, or of every
+    event of every shard, and reports the ones that had drifted.
+
+    $ python rebuild_stats.py [event_id ...]
+    """
+    logging.basicConfig(level=logging.INFO)
+    ctx = app.Context()
+    drifted = 0
+    for shard, event_id in events(ctx.db, event_ids):
+        ctx.db.use_shard(shard=shard)
+        result = ctx.attendance.rebuild_stats(event_id)
+        if not result['consistent']:
+            drifted += 1
+            print(f"{event_id}: {result['before']} -> {result['after']}")
+    print(f'{drifted} event(s) had drifted counters')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
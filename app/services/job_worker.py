@@ -0,0 +1,98 @@
+import logging
+import os
+import time
+from typing import Callable, Dict
+
+from db.database import Database
+from db.jobs import JobQueue
+
+logger = logging.getLogger(__name__)
+
+# A handler gets a job's payload and returns the items that failed
+Handler = Callable[[dict], list]
+
+
+class JobWorker():
+    """Runs the jobs of a JobQueue, polling every shard in turn.
+
+    handlers maps a job kind to the function doing its items. Items the
+    handler returns as failed, or all of them if it raises, are retried
+    by the queue with backoff. Configured by JOB_POLL_SECONDS, the sleep
+    when no shard has a runnable job.
+
+    An error outside of a handler (e.g. a shard that is down) doesn't stop
+    the worker: it sleeps, longer after each consecutive error, and goes on.
+    """
+    # Longest sleep after consecutive errors
+    MAX_ERROR_SLEEP_SECONDS = 60.0
+
+    def __init__(self, db: Database, queue: JobQueue,
+                 handlers: Dict[str, Handler],
+                 poll_seconds: float = 1.0) -> None:
+        self.db = db
+        self.queue = queue
+        self.handlers = handlers
+        self.poll_seconds = poll_seconds
+        self.running = False
+
+    @staticmethod
+    def from_env(db: Database, queue: JobQueue,
+                 handlers: Dict[str, Handler]) -> 'JobWorker':
+        return JobWorker(db, queue, handlers,
+                         float(os.getenv('JOB_POLL_SECONDS', default=1.0)))
+
+    def run_once(self) -> int:
+        '''Runs at most one job per shard; returns how many ran.'''
+        ran = 0
+        for shard in range(self.db.shard_count):
+            self.db.use_shard(shard=shard)
+            job = self.queue.claim()
+            if job is not None:
+                self.process(job)
+                ran += 1
+        return ran
+
+    def process(self, job: dict) -> str:
+        '''Runs a claimed job and records the attempt; returns its status.'''
+        items = job['payload'].get('items', [])
+        handler = self.handlers.get(job['kind'])
+        if handler is None:
+            error = f"Unknown job kind {job['kind']}"
+            return self.queue.finish(job, 0, self.failed(items, error), error)
+        try:
+            failed_items = handler(job['payload'])
+        except Exception as e:
+            logger.exception('Job %s failed', job['job_id'])
+            return self.queue.finish(job, 0, self.failed(items, str(e)),
+                                     str(e))
+        error = (f'{len(failed_items)} of {len(items)} items failed'
+                 if failed_items else None)
+        return self.queue.finish(job, len(items) - len(failed_items),
+                                 failed_items, error)
+
+    @staticmethod
+    def failed(items: list, reason: str) -> list:
+        '''Items of a failed attempt, with the reason shown by the job
+        progress.'''
+        return [dict(item, reason=reason) for item in items]
+
+    def run(self) -> None:
+        '''Processes jobs until stop() is called.'''
+        self.running = True
+        errors = 0
+        while self.running:
+            try:
+                ran = self.run_once()
+            except Exception:
+                logger.exception('Polling for jobs failed')
+                errors += 1
+                time.sleep(min(self.poll_seconds * 2 ** errors,
+                               self.MAX_ERROR_SLEEP_SECONDS))
+                continue
+            errors = 0
+            if ran == 0:
+                time.sleep(self.poll_seconds)
+
+    def stop(self, *args) -> None:
+        '''Stops run() after the current jobs; usable as a signal handler.'''
+        self.running = False
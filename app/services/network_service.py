@@ -1,9 +1,75 @@
+import os
+from typing import Optional
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class NetworkService:
+    """The one client for outbound HTTP calls (Google, Mailgun).
+
+    Calls share a requests.Session, so connections are kept alive and
+    reused instead of paying a TCP+TLS handshake each time. The session is
+    created on first use in each process: a session inherited across
+    uWSGI's fork would share its sockets with the master. Idempotent
+    requests are retried on connection errors and 429/5xx responses;
+    POSTs (e.g. Mailgun) are not, their callers retry. Configured by
+    HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_RETRIES,
+    HTTP_BACKOFF_FACTOR and HTTP_TIMEOUT_SECONDS.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 10,
+                 retries: int = 2, backoff_factor: float = 0.3,
+                 timeout: Optional[float] = 10.0) -> None:
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout or None
+        self._session = None
+        self._pid = None
+
+    @staticmethod
+    def from_env() -> 'NetworkService':
+        return NetworkService(
+            int(os.getenv('HTTP_POOL_CONNECTIONS', default=10)),
+            int(os.getenv('HTTP_POOL_MAXSIZE', default=10)),
+            int(os.getenv('HTTP_RETRIES', default=2)),
+            float(os.getenv('HTTP_BACKOFF_FACTOR', default=0.3)),
+            float(os.getenv('HTTP_TIMEOUT_SECONDS', default=10.0)),
+        )
+
+    @property
+    def session(self) -> requests.Session:
+        '''Returns this process's session, creating it after a fork.'''
+        if self._session is None or self._pid != os.getpid():
+            self._session = self.create_session()
+            self._pid = os.getpid()
+        return self._session
+
+    def create_session(self) -> requests.Session:
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                      status_forcelist=self.RETRY_STATUSES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        '''Sends a request on the pooled session, with the default timeout.'''
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        '''GETs url and returns the decoded JSON body.'''
+        return self.request('GET', url, **kwargs).json()
 
-    def get(self, url: str):
-        '''Wrapper around the requests module'''
-        r = requests.get(url)
-        return r.json()
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
@@ -0,0 +1,171 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+from psycopg_pool import PoolTimeout
+
+from db import queries
+from db.async_database import AsyncDatabase
+from db.slow_log import SlowQueryLog
+
+
+class Test_AsyncDatabase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.cursor = MagicMock()
+        self.cursor.__aenter__ = AsyncMock(return_value=self.cursor)
+        self.cursor.__aexit__ = AsyncMock(return_value=False)
+        self.cursor.execute = AsyncMock(return_value=3)
+        self.cursor.executemany = AsyncMock()
+        self.cursor.fetchall = AsyncMock(return_value=[])
+        self.cursor.fetchone = AsyncMock(return_value=None)
+
+        self.mock_conn = MagicMock()
+        self.mock_conn.rollback = AsyncMock()
+        self.mock_conn.commit = AsyncMock()
+        self.mock_conn.__aenter__ = AsyncMock(return_value=self.mock_conn)
+        self.mock_conn.__aexit__ = AsyncMock(return_value=False)
+        self.mock_conn.cursor = Mock(return_value=self.cursor)
+
+        self.mock_pool = Mock()
+        self.mock_pool.connection = Mock(return_value=self.mock_conn)
+
+        self.db = AsyncDatabase(self.mock_pool)
+
+    def tearDown(self) -> None:
+        self.mock_conn = None
+        self.mock_pool = None
+        self.db = None
+
+    async def test01_db_set(self):
+        await self.db.set(
+            'UPDATE Users SET username = (%s) WHERE user_id = (%s)',
+            ('John Doe', 'user1234')
+        )
+
+        self.cursor.execute.assert_called_with(
+            query='UPDATE Users SET username = (%s) WHERE user_id = (%s)',
+            params=('John Doe', 'user1234')
+        )
+        self.mock_pool.connection.assert_called()
+        self.mock_conn.commit.assert_awaited()
+        self.mock_conn.__aenter__.assert_awaited()
+        self.mock_conn.__aexit__.assert_awaited()
+
+    async def test02_db_set_error(self):
+        self.cursor.execute = AsyncMock(side_effect=Exception('db exception'))
+
+        with self.assertRaises(Exception) as ctx:
+            await self.db.set(
+                'UPDATE Users SET username = (%s) WHERE user_id = (%s)',
+                ('John Doe', 'user1234')
+            )
+
+        self.cursor.execute.assert_called_with(
+            query='UPDATE Users SET username = (%s) WHERE user_id = (%s)',
+            params=('John Doe', 'user1234')
+        )
+        self.assertEqual('db exception', ctx.exception.args[0])
+        self.mock_conn.rollback.assert_awaited()
+
+    async def test03_db_get(self):
+        await self.db.get('SELECT * FROM Users WHERE user_id = (%s)',
+                          ('hello', ))
+
+        self.cursor.execute.assert_called_with(
+            query='SELECT * FROM Users WHERE user_id = (%s)',
+            params=('hello', )
+        )
+        self.cursor.fetchall.assert_awaited()
+
+    async def test04_db_get_one(self):
+        await self.db.get_one('SELECT * FROM Users WHERE user_id = (%s)',
+                              ('hello', ))
+
+        self.cursor.execute.assert_called_with(
+            query='SELECT * FROM Users WHERE user_id = (%s)',
+            params=('hello', )
+        )
+        self.cursor.fetchone.assert_awaited()
+
+    async def test05_db_pool_stats_checkout_error(self):
+        self.mock_pool.connection = Mock(side_effect=PoolTimeout('timeout'))
+        self.mock_pool.get_stats = Mock(return_value={})
+
+        with self.assertRaises(PoolTimeout):
+            await self.db.get('SELECT * FROM Users')
+
+        stats = self.db.get_pool_stats()
+        self.assertEqual(1, stats['connection_errors'])
+        self.assertEqual(0, stats['waiting'])
+
+    async def test06_db_set_many(self):
+        self.cursor.rowcount = 2
+        params = [('John Doe', 'user1234'), ('Jane Doe', 'user5678')]
+
+        count = await self.db.set_many(
+            'UPDATE Users SET username = (%s) WHERE user_id = (%s)', params)
+
+        self.assertEqual(2, count)
+        self.cursor.executemany.assert_awaited_once()
+        self.mock_conn.commit.assert_awaited_once()
+
+    async def test07_db_transaction(self):
+        self.mock_conn.transaction = MagicMock()
+
+        async with self.db.transaction():
+            self.assertTrue(self.db.in_transaction())
+            await self.db.get_one('SELECT * FROM Users WHERE user_id = (%s)',
+                                  ('user1234', ))
+            await self.db.set('UPDATE Users SET username = (%s)',
+                              ('John Doe', ))
+
+        self.assertFalse(self.db.in_transaction())
+        self.mock_pool.connection.assert_called_once()
+        self.mock_conn.commit.assert_not_awaited()
+
+    async def test08_db_get_registered_query_is_prepared(self):
+        await self.db.get_one(queries.USER_BY_ID, ('user1234', ))
+
+        self.cursor.execute.assert_called_with(
+            query='SELECT user_id, org_name, username, created_at, '
+                  'updated_at FROM Users WHERE user_id = %s',
+            params=('user1234', ),
+            prepare=True
+        )
+
+    async def test09_db_slow_query_is_logged(self):
+        db = AsyncDatabase(self.mock_pool, SlowQueryLog(threshold_ms=0))
+
+        with self.assertLogs('db.slow_log', level='WARNING'):
+            await db.get('SELECT * FROM Users')
+
+        self.assertEqual(1, len(db.get_slow_queries()))
+
+    async def test10_db_set_returning(self):
+        self.cursor.fetchone = AsyncMock(return_value={'is_rsvped': True})
+
+        row = await self.db.set_returning(queries.RSVP, ('1', 'random'))
+
+        self.assertEqual({'is_rsvped': True}, row)
+        self.mock_conn.commit.assert_awaited_once()
+
+    async def test11_db_slow_query_is_logged_with_plan(self):
+        self.cursor.fetchone = AsyncMock(
+            return_value={'QUERY PLAN': [{'Plan': {}}]})
+        self.mock_conn.transaction = MagicMock()
+        db = AsyncDatabase(self.mock_pool, SlowQueryLog(
+            threshold_ms=0, explain_sample_rate=1.0))
+
+        with self.assertLogs('db.slow_log', level='WARNING'):
+            await db.get_one('SELECT * FROM Users WHERE user_id = (%s)',
+                             ('user1234', ))
+
+        self.cursor.execute.assert_awaited_with(
+            'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+            'SELECT * FROM Users WHERE user_id = (%s)',
+            ('user1234', )
+        )
+        # The explain savepoint never keeps what it ran
+        self.mock_conn.transaction.assert_called_once_with(
+            force_rollback=True)
+        self.assertEqual([{'Plan': {}}], db.get_slow_queries()[0]['plan'])
@@ -1,8 +1,15 @@
+import json
 import unittest
-from unittest.mock import Mock
-from datetime import datetime
+from contextlib import contextmanager
+from unittest.mock import MagicMock, Mock
+from datetime import datetime, timezone
 import requests
+from psycopg.rows import tuple_row
 from controllers.attendance_controller import AttendanceController
+from models.attendance import Attendance
+from db import queries
+from db.database import Database
+from db.jobs import JobQueue
 
 
 class Test_Get_Attendances(unittest.TestCase):
@@ -63,13 +70,81 @@ class Test_Get_Attendances(unittest.TestCase):
         self.assertEqual(400, ctx.exception.code)
         self.assertEqual("Missing event_id..", ctx.exception.description)
 
+    def test04_get_attendances(self):
+        """Happy Path. Tuple rows are serialized in column order"""
+        self.attendance_controller.db.get = Mock(return_value=[
+            ('1', 'email@gmail.com', 'attendee', 'random', True, False,
+             False, 'Mon, 08 Nov 2021 16:11:54 GMT',
+             'Mon, 08 Nov 2021 16:11:54 GMT')
+        ])
+
+        actual = self.attendance_controller.get_attendances('1')
+
+        self.assertEqual('email@gmail.com', actual[0]['user_email'])
+        self.assertEqual('random', actual[0]['personal_code'])
+        self.assertFalse(actual[0]['is_checked_in'])
+        self.assertEqual(tuple_row, self.attendance_controller.db.get
+                         .call_args.kwargs['row_factory'])
+
+    def _rows(self, *emails):
+        return [('1', email, 'attendee', 'random', True, False, False,
+                 'Mon, 08 Nov 2021 16:11:54 GMT',
+                 'Mon, 08 Nov 2021 16:11:54 GMT') for email in emails]
+
+    def test05_get_attendance_page(self):
+        """Happy Path. A full page comes with the cursor of the next one"""
+        db = self.attendance_controller.db
+        db.get = Mock(return_value=self._rows('a@a.com', 'b@b.com',
+                                              'c@c.com'))
+
+        actual = self.attendance_controller.get_attendance_page(
+            '1', 'true', limit='2')
+
+        self.assertEqual(['a@a.com', 'b@b.com'],
+                         [row['user_email'] for row in actual['attendances']])
+        self.assertEqual('b@b.com', self.attendance_controller.decode_cursor(
+            actual['next_cursor']))
+        statement, params = db.get.call_args.args
+        self.assertTrue(statement.endswith(
+            'AND is_invited = %s ORDER BY user_email LIMIT %s'))
+        self.assertEqual(['1', 'true', 3], params)
+
+    def test06_get_attendance_page(self):
+        """Last page: starts after the cursor, no next cursor"""
+        db = self.attendance_controller.db
+        db.get = Mock(return_value=self._rows('c@c.com'))
+        cursor = self.attendance_controller.encode_cursor('b@b.com')
+
+        actual = self.attendance_controller.get_attendance_page(
+            '1', limit=2, cursor=cursor)
+
+        self.assertIsNone(actual['next_cursor'])
+        self.assertEqual(1, len(actual['attendances']))
+        statement, params = db.get.call_args.args
+        self.assertIn('AND user_email > %s', statement)
+        self.assertEqual(['1', 'b@b.com', 3], params)
+
+    def test07_get_attendance_page(self):
+        """Bad input test: limit out of range or not a number"""
+        for limit in ('0', '1001', 'ten'):
+            with self.assertRaises(Exception) as ctx:
+                self.attendance_controller.get_attendance_page(
+                    '1', limit=limit)
+            self.assertEqual(400, ctx.exception.code)
+
+    def test08_get_attendance_page(self):
+        """Bad input test: cursor that was not issued by the server"""
+        with self.assertRaises(Exception) as ctx:
+            self.attendance_controller.get_attendance_page('1', cursor='%%')
+        self.assertEqual(400, ctx.exception.code)
+
 
 class Test_Check_In(unittest.TestCase):
 
     def setUp(self) -> None:
         # Mock db and db methods
-        db = Mock()
-        db.get_one = Mock(return_value={
+        db = MagicMock()
+        db.set_returning = Mock(return_value={
                 'event_id': '1',
                 'user_email': 'email@gmail.com',
                 'user_role': 'attendee',
@@ -104,6 +179,8 @@ class Test_Check_In(unittest.TestCase):
         actual = self.attendance_controller.check_in('1', 'random')
 
         self.assertEqual(expected, actual)
+        self.attendance_controller.db.set_returning.assert_called_once_with(
+            queries.CHECK_IN, ['1', 'random'])
 
     def test02_check_in(self):
         """Bad input test: missing personal code"""
@@ -141,12 +218,60 @@ class Test_Check_In(unittest.TestCase):
         self.assertEqual("Missing event_id or personal_code..",
                          ctx3.exception.description)
 
+    def test05_check_in(self):
+        """Bad input test: no row updated for the personal code"""
+        self.attendance_controller.db.set_returning = Mock(return_value=None)
+        with self.assertRaises(Exception) as ctx:
+            self.attendance_controller.check_in('1', 'wrong')
+
+        self.assertEqual(400, ctx.exception.code)
+
+    def test06_check_in_batch(self):
+        """Happy Path: per-code results in request order"""
+        db = self.attendance_controller.db
+        db.set_returning = Mock(return_value=[
+            {'personal_code': 'b', 'result': 'already_checked_in'},
+            {'personal_code': 'a', 'result': 'checked_in'},
+            {'personal_code': 'x', 'result': 'invalid'},
+        ])
+
+        actual = self.attendance_controller.check_in_batch(
+            '1', ['a', 'b', 'x', 'a'])
+
+        self.assertEqual({
+            'event_id': '1',
+            'checked_in': 2,
+            'already_checked_in': 1,
+            'invalid': 1,
+            'results': [
+                {'personal_code': 'a', 'result': 'checked_in'},
+                {'personal_code': 'b', 'result': 'already_checked_in'},
+                {'personal_code': 'x', 'result': 'invalid'},
+                {'personal_code': 'a', 'result': 'checked_in'},
+            ],
+        }, actual)
+        db.set_returning.assert_called_once_with(
+            queries.CHECK_IN_BATCH, [['a', 'b', 'x', 'a'], '1', '1'],
+            one=False)
+
+    def test07_check_in_batch(self):
+        """Bad input test: no codes, codes that are not strings, too many"""
+        for codes in (None, [], ['a', ''], ['a', 1]):
+            with self.assertRaises(Exception) as ctx:
+                self.attendance_controller.check_in_batch('1', codes)
+            self.assertEqual(400, ctx.exception.code)
+
+        self.attendance_controller.CHECK_IN_BATCH_SIZE = 2
+        with self.assertRaises(Exception) as ctx:
+            self.attendance_controller.check_in_batch('1', ['a', 'b', 'c'])
+        self.assertEqual(400, ctx.exception.code)
+
 
 class Test_Invite(unittest.TestCase):
 
     def setUp(self) -> None:
         # Mock db and db methods
-        db = Mock()
+        db = MagicMock()
         db.get = Mock(return_value=[
             {
                 'event_id': '1',
@@ -178,30 +303,42 @@ class Test_Invite(unittest.TestCase):
             }
         )
         db.set = Mock(return_value=None)
+        db.set_returning = Mock(return_value=[
+            {'user_email': 'invite1@gmail.com', 'personal_code': 'random'}
+        ])
+        jobs = Mock()
+        jobs.enqueue = Mock(return_value=7)
+        self.requests = Mock()
 
         # Create AttendanceController
-        self.attendance_controller = AttendanceController(db)
+        self.attendance_controller = AttendanceController(db, jobs,
+                                                          self.requests,
+                                                          'secret')
 
     def tearDown(self) -> None:
         self.attendance_controller = None
 
     def test01_invite(self):
         """Happy Path"""
-        expected = [
-            {
-                'event_id': '1',
-                'user_email': 'email@gmail.com',
-                'user_role': 'attendee',
-                'personal_code': 'random',
-                'is_invited': True,
-                'is_rsvped': False,
-                'is_checked_in': False,
-                'created_at': 'Mon, 08 Nov 2021 16:11:54 GMT',
-                'updated_at': 'Mon, 08 Nov 2021 16:11:54 GMT'
-            }
-        ]
+        mock_post = self.requests.post
+        expected = {
+            'event_id': '1',
+            'requested': 1,
+            'inserted': 1,
+            'duplicates': 0,
+            'failures': [],
+            'job_id': 7,
+        }
         actual = self.attendance_controller.invite("1", ["invite1@gmail.com"])
         self.assertEqual(expected, actual)
+        # Emails are sent by the worker
+        mock_post.assert_not_called()
+        self.attendance_controller.jobs.enqueue.assert_called_once_with(
+            JobQueue.INVITE_EMAILS, '1', {
+                'event_id': '1',
+                'items': [{'email': 'invite1@gmail.com',
+                           'personal_code': 'random'}],
+            })
 
     def test02_invite(self):
         """Bad input test: empty event id"""
@@ -213,62 +350,364 @@ class Test_Invite(unittest.TestCase):
         self.assertEqual("Missing event_id..",
                          ctx.exception.description)
 
-    @unittest.mock.patch("controllers.attendance_controller.requests.post")
-    def test03_send_email(self, mock_post):
-        mock_response = Mock(status_code=200)
-        mock_post.return_value = mock_response
-        response = self.attendance_controller.send_email(
-            "sampleUser1", "invite1@gmail.com", "random_pc", "event_name",
-            "event_description", "event_location", "event_start_time",
-            "event_end_time", "1")
+    def test03_send_batch(self):
+        mock_post = self.requests.post
+        mock_post.return_value = Mock(status_code=200)
+        variables = self.attendance_controller.invite_variables(
+            self.attendance_controller.db.get_one())
+        response = self.attendance_controller.send_batch(
+            "sampleUser1", variables, "1",
+            [{'email': 'invite1@gmail.com', 'personal_code': 'a'},
+             {'email': 'invite2@gmail.com', 'personal_code': 'b'}])
         self.assertEqual(response.status_code, 200)
 
-    @unittest.mock.patch("controllers.attendance_controller.requests.post")
-    def test04_send_email(self, mock_post):
+        # One call, each recipient with their own invite link
+        data = mock_post.call_args.kwargs['data']
+        self.assertEqual(['invite1@gmail.com', 'invite2@gmail.com'],
+                         data['to'])
+        recipient_variables = json.loads(data['recipient-variables'])
+        self.assertTrue(recipient_variables['invite2@gmail.com']
+                        ['invite_link'].endswith('personal_code=b'))
+        self.assertEqual('%recipient.invite_link%',
+                         json.loads(data['h:X-Mailgun-Variables'])
+                         ['invite_link'])
+
+    def test04_send_batch(self):
+        mock_post = self.requests.post
         mock_response = Mock(status_code=404)
         mock_post.return_value = mock_response
-        response = self.attendance_controller.send_email(
-            "sampleUser1", "invite1@gmail.com", "random_pc", "event_name",
-            "event_description", "event_location", "event_start_time",
-            "event_end_time", "1")
+        response = self.attendance_controller.send_batch(
+            "sampleUser1", {}, "1",
+            [{'email': 'invite1@gmail.com', 'personal_code': 'a'}])
         self.assertEqual(response.status_code, 404)
 
-    @unittest.mock.patch("controllers.attendance_controller.requests.post")
-    def test05_invite(self, mock_post):
+    def test05_send_invitations(self):
         """failed to invite"""
-        mock_response = Mock(status_code=404)
-        mock_post.return_value = mock_response
-        mock_post.side_effect = requests.exceptions.ConnectionError()
+        mock_post = self.requests.post
+        mock_post.side_effect = requests.exceptions.ConnectionError('down')
+
+        items = [{'email': 'invite1@gmail.com', 'personal_code': 'random'}]
+        actual = self.attendance_controller.send_invitations(
+            {'event_id': '1', 'items': items})
+        self.assertEqual([dict(items[0], reason='down')], actual)
+
+    def test06_invite_batch(self):
+        """Emails are normalized, de-duplicated and inserted in chunks"""
+        db = self.attendance_controller.db
+        db.set_returning = Mock(side_effect=[
+            [{'user_email': 'invite1@gmail.com', 'personal_code': 'a'},
+             {'user_email': 'invite2@gmail.com', 'personal_code': 'b'}],
+            # invite3 was already invited
+            [],
+        ])
+        self.attendance_controller.INVITE_CHUNK_SIZE = 2
 
-        with self.assertRaises(requests.exceptions.RequestException):
-            # This should cause error
-            self.attendance_controller.send_email(
-                "sampleUser1", "invite1@gmail.com", "random_pc", "event_name",
-                "event_description", "event_location", "event_start_time",
-                "event_end_time", "1")
+        actual = self.attendance_controller.invite(
+            "1", ["invite1@gmail.com", " Invite1@Gmail.com ",
+                  "invite2@gmail.com", "invite3@gmail.com", "not-an-email"])
 
-        expected = [{
-                'event_id': '1',
-                'user_email': 'email@gmail.com',
-                'user_role': 'attendee',
-                'personal_code': 'random',
-                'is_invited': True,
-                'is_rsvped': False,
-                'is_checked_in': False,
-                'created_at': 'Mon, 08 Nov 2021 16:11:54 GMT',
-                'updated_at': 'Mon, 08 Nov 2021 16:11:54 GMT'
-            }
-        ]
+        self.assertEqual({
+            'event_id': '1',
+            'requested': 5,
+            'inserted': 2,
+            'duplicates': 2,
+            'failures': [{'email': 'not-an-email',
+                          'reason': 'invalid_email'}],
+            'job_id': 7,
+        }, actual)
+        db.set.assert_not_called()
+        self.assertEqual(2, db.set_returning.call_count)
+        self.assertEqual(
+            ['1', ['invite1@gmail.com', 'invite2@gmail.com'],
+             [Attendance.generate_personal_code('1', 'invite1@gmail.com',
+                                                b'secret'),
+              Attendance.generate_personal_code('1', 'invite2@gmail.com',
+                                                b'secret')]],
+            db.set_returning.call_args_list[0].args[1])
+        db.lane.assert_called_with(Database.BULK)
+        # One job for all the new invitees
+        payload = self.attendance_controller.jobs.enqueue.call_args.args[2]
+        self.assertEqual(['invite1@gmail.com', 'invite2@gmail.com'],
+                         [item['email'] for item in payload['items']])
+
+    def test07_normalize_emails(self):
+        emails, duplicates, invalid = AttendanceController.normalize_emails(
+            ['B@b.com', 'a@a.com', 'b@B.com ', None, 'x'])
+        self.assertEqual(['b@b.com', 'a@a.com'], emails)
+        self.assertEqual(1, duplicates)
+        self.assertEqual([None, 'x'], invalid)
+
+    def test08_send_invitations(self):
+        """Happy Path: one call per MAILGUN_BATCH_SIZE recipients"""
+        mock_post = self.requests.post
+        mock_post.return_value = Mock(status_code=200)
+        self.attendance_controller.MAILGUN_BATCH_SIZE = 2
+        actual = self.attendance_controller.send_invitations({
+            'event_id': '1',
+            'items': [{'email': f'invite{i}@gmail.com', 'personal_code': 'a'}
+                      for i in range(5)],
+        })
+        self.assertEqual([], actual)
+        self.assertEqual(3, mock_post.call_count)
+        # The event is looked up once
+        self.attendance_controller.db.get_one.assert_called_once()
+
+    def test09_send_invitations(self):
+        """An error status fails every recipient of the batch"""
+        mock_post = self.requests.post
+        ok = Mock(status_code=200)
+        error = Mock(status_code=500)
+        error.raise_for_status = Mock(
+            side_effect=requests.exceptions.HTTPError('500 Server Error'))
+        mock_post.side_effect = [ok, error]
+        self.attendance_controller.MAILGUN_BATCH_SIZE = 1
+        items = [{'email': 'invite1@gmail.com', 'personal_code': 'a'},
+                 {'email': 'invite2@gmail.com', 'personal_code': 'b'}]
+        actual = self.attendance_controller.send_invitations(
+            {'event_id': '1', 'items': items})
+        self.assertEqual([dict(items[1], reason='500 Server Error')], actual)
+
+    def test10_invite(self):
+        """Nobody new to email: no job"""
+        self.attendance_controller.db.set_returning = Mock(return_value=[])
         actual = self.attendance_controller.invite("1", ["invite1@gmail.com"])
-        self.assertEqual(expected, actual)
+        self.assertIsNone(actual['job_id'])
+        self.assertEqual(1, actual['duplicates'])
+        self.attendance_controller.jobs.enqueue.assert_not_called()
+
+    def test11_get_invite_progress(self):
+        jobs = self.attendance_controller.jobs
+        jobs.get_progress = Mock(return_value={
+            'job_id': 7, 'sent': 1,
+            'failed_items': [{'email': 'invite2@gmail.com',
+                              'personal_code': 'b', 'reason': 'error'}]})
+        self.assertEqual({'job_id': 7, 'sent': 1,
+                          'failures': [{'email': 'invite2@gmail.com',
+                                        'reason': 'error'}]},
+                         self.attendance_controller.get_invite_progress(
+                             '1', 7))
+        jobs.get_progress.assert_called_once_with('1', 7)
+
+        jobs.get_progress = Mock(return_value=None)
+        with self.assertRaises(Exception) as ctx:
+            self.attendance_controller.get_invite_progress('1', 8)
+        self.assertEqual(404, ctx.exception.code)
+
+    def test12_generate_personal_code(self):
+        """Short, fixed-length, URL-safe codes that depend on the key"""
+        code = Attendance.generate_personal_code('1', 'invite1@gmail.com',
+                                                 b'secret')
+        self.assertRegex(code, r'^[A-Za-z0-9_-]{16}$')
+        self.assertEqual(code, Attendance.generate_personal_code(
+            '1', 'invite1@gmail.com', b'secret'))
+        self.assertEqual(16, len(Attendance.generate_personal_code(
+            'S01' + 'b' * 60, 'a' * 200 + '@columbia.edu', b'secret')))
+        for other in [('2', 'invite1@gmail.com', b'secret'),
+                      ('1', 'invite2@gmail.com', b'secret'),
+                      ('1', 'invite1@gmail.com', b'other')]:
+            self.assertNotEqual(code,
+                                Attendance.generate_personal_code(*other))
+        # Without a key anyone could derive the codes
+        for key in (b'', None):
+            with self.assertRaises(ValueError):
+                Attendance.generate_personal_code('1', 'invite1@gmail.com',
+                                                  key)
+
+    def test13_invite(self):
+        """The invitations roll back if their email job can't be queued"""
+        db = self.attendance_controller.db
+        log = []
+
+        @contextmanager
+        def transaction():
+            log.append('begin')
+            try:
+                yield
+            except Exception:
+                log.append('rollback')
+                raise
+            log.append('commit')
+
+        db.transaction = transaction
+        db.set_returning = Mock(side_effect=lambda *args, **kwargs: (
+            log.append('insert') or [{'user_email': 'invite1@gmail.com',
+                                      'personal_code': 'random'}]))
+        self.attendance_controller.jobs.enqueue = Mock(
+            side_effect=RuntimeError('jobs unavailable'))
+
+        with self.assertRaises(RuntimeError):
+            self.attendance_controller.invite("1", ["invite1@gmail.com"])
+        # The chunk's savepoint, then the job in the same transaction
+        self.assertEqual(['begin', 'begin', 'insert', 'commit', 'rollback'],
+                         log)
+
+
+class Test_Stats(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # Mock db and db methods
+        db = MagicMock()
+        db.get_one = Mock(return_value={
+            'event_id': '1', 'total': 3, 'invited': 3, 'rsvped': 2,
+            'checked_in': 1,
+            'updated_at': 'Mon, 08 Nov 2021 16:11:54 GMT'})
+
+        # Create AttendanceController
+        self.attendance_controller = AttendanceController(db)
+
+    def tearDown(self) -> None:
+        self.attendance_controller = None
+
+    def test01_get_stats(self):
+        """Happy Path: one read of the counters"""
+        actual = self.attendance_controller.get_stats('1')
+        self.assertEqual(2, actual['rsvped'])
+        self.attendance_controller.db.get_one.assert_called_once_with(
+            queries.EVENT_STATS, ['1'])
+
+    def test02_get_stats(self):
+        """Bad input test: empty or unknown event id"""
+        with self.assertRaises(Exception) as ctx:
+            self.attendance_controller.get_stats('')
+        self.assertEqual(400, ctx.exception.code)
+
+        self.attendance_controller.db.get_one = Mock(return_value=None)
+        with self.assertRaises(Exception) as ctx:
+            self.attendance_controller.get_stats('2')
+        self.assertEqual(400, ctx.exception.code)
+
+    def test03_rebuild_stats(self):
+        """Counters that drifted are overwritten with the recount"""
+        db = self.attendance_controller.db
+        db.get_one = Mock(return_value={
+            'total': 3, 'invited': 3, 'rsvped': 2, 'checked_in': 0})
+        db.set_returning = Mock(return_value={
+            'total': 3, 'invited': 3, 'rsvped': 2, 'checked_in': 1})
+
+        actual = self.attendance_controller.rebuild_stats('1')
+
+        self.assertFalse(actual['consistent'])
+        self.assertEqual(1, actual['after']['checked_in'])
+        db.transaction.assert_called_once()
+        db.get_one.assert_called_once_with(queries.LOCK_EVENT_STATS, ['1'])
+        db.set_returning.assert_called_once_with(
+            queries.REBUILD_EVENT_STATS, ['1', '1'])
+
+    def test04_rebuild_stats(self):
+        """An event without counters yet counts as all zeros"""
+        db = self.attendance_controller.db
+        db.get_one = Mock(return_value=None)
+        db.set_returning = Mock(return_value={
+            'total': 0, 'invited': 0, 'rsvped': 0, 'checked_in': 0})
+
+        self.assertTrue(
+            self.attendance_controller.rebuild_stats('1')['consistent'])
+
+
+class Test_Roster(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # Mock db and db methods
+        db = MagicMock()
+        db.get_one = Mock(return_value={'version': 1636387914000000})
+        db.get = Mock(return_value=[
+            ('pc1', 'invite1@gmail.com', True, True, True,
+             datetime(2021, 11, 15, 12, 10, tzinfo=timezone.utc)),
+            ('pc2', 'invite2@gmail.com', True, False, False, None),
+        ])
+
+        # Create AttendanceController
+        self.attendance_controller = AttendanceController(db)
+
+    def tearDown(self) -> None:
+        self.attendance_controller = None
+
+    def test01_get_roster(self):
+        """Happy Path: compact snapshot keyed by personal code"""
+        actual = self.attendance_controller.get_roster('1')
+
+        self.assertEqual({
+            'event_id': '1',
+            'version': 1636387914000000,
+            'fields': ['user_email', 'is_invited', 'is_rsvped',
+                       'is_checked_in', 'checked_in_at'],
+            'attendees': {
+                'pc1': ['invite1@gmail.com', True, True, True,
+                        '2021-11-15T12:10:00+00:00'],
+                'pc2': ['invite2@gmail.com', True, False, False, None],
+            },
+        }, actual)
+        db = self.attendance_controller.db
+        db.lane.assert_called_once_with(Database.BULK)
+        self.assertEqual(tuple_row, db.get.call_args.kwargs['row_factory'])
+
+    def test02_get_roster_version(self):
+        """Bad input test: unknown event id"""
+        self.attendance_controller.db.get_one = Mock(return_value=None)
+        with self.assertRaises(Exception) as ctx:
+            self.attendance_controller.get_roster_version('2')
+        self.assertEqual(400, ctx.exception.code)
+
+    def test03_sync_check_ins(self):
+        """Happy Path: the latest entry of each code is merged"""
+        db = self.attendance_controller.db
+        db.set_returning = Mock(return_value=[
+            {'personal_code': 'pc1', 'result': 'applied'},
+            {'personal_code': 'pc2', 'result': 'superseded'},
+            {'personal_code': 'pc9', 'result': 'invalid'},
+        ])
+
+        actual = self.attendance_controller.sync_check_ins('1', [
+            {'personal_code': 'pc1', 'checked_in_at': '2021-11-15T12:10:00Z'},
+            {'personal_code': 'pc2', 'checked_in_at': '2021-11-15T12:11:00'},
+            {'personal_code': 'pc1', 'checked_in_at': '2021-11-15T12:12:00Z',
+             'is_checked_in': False},
+            {'personal_code': 'pc9', 'checked_in_at': '2021-11-15T12:13:00Z'},
+        ])
+
+        self.assertEqual(1, actual['applied'])
+        self.assertEqual(1, actual['superseded'])
+        self.assertEqual(1, actual['invalid'])
+        self.assertEqual(['pc1', 'pc2', 'pc9'],
+                         [r['personal_code'] for r in actual['results']])
+        query, params = db.set_returning.call_args.args
+        self.assertEqual(queries.SYNC_CHECK_INS, query)
+        self.assertEqual(['pc1', 'pc2', 'pc9'], params[0])
+        self.assertEqual([False, True, True], params[1])
+        self.assertEqual(datetime(2021, 11, 15, 12, 12, tzinfo=timezone.utc),
+                         params[2][0])
+        self.assertEqual(['1', '1'], params[3:])
+        db.lane.assert_called_once_with(Database.BULK)
+
+    def test04_sync_check_ins(self):
+        """Large logs are merged SYNC_BATCH_SIZE codes per statement"""
+        db = self.attendance_controller.db
+        db.set_returning = Mock(return_value=[])
+        self.attendance_controller.SYNC_BATCH_SIZE = 2
+        actual = self.attendance_controller.sync_check_ins('1', [
+            {'personal_code': f'pc{i}',
+             'checked_in_at': '2021-11-15T12:10:00Z'} for i in range(5)])
+        self.assertEqual(3, db.set_returning.call_count)
+        self.assertEqual(5, actual['invalid'])
+
+    def test05_sync_check_ins(self):
+        """Bad input test: missing log or malformed entries"""
+        for check_ins in (None, [], [{'personal_code': 'pc1'}],
+                          [{'personal_code': 'pc1', 'checked_in_at': 'now'}],
+                          [{'personal_code': 1,
+                            'checked_in_at': '2021-11-15T12:10:00Z'}],
+                          ['pc1']):
+            with self.assertRaises(Exception) as ctx:
+                self.attendance_controller.sync_check_ins('1', check_ins)
+            self.assertEqual(400, ctx.exception.code)
 
 
 class Test_RSVP(unittest.TestCase):
 
     def setUp(self) -> None:
         # Mock db and db methods
-        db = Mock()
-        db.get_one = Mock(return_value={
+        db = MagicMock()
+        db.set_returning = Mock(return_value={
                 'event_id': '1',
                 'user_email': 'email@gmail.com',
                 'user_role': 'attendee',
@@ -328,8 +767,8 @@ class Test_UNRSVP(unittest.TestCase):
 
     def setUp(self) -> None:
         # Mock db and db methods
-        db = Mock()
-        db.get_one = Mock(return_value={
+        db = MagicMock()
+        db.set_returning = Mock(return_value={
                 'event_id': '1',
                 'user_email': 'email@gmail.com',
                 'user_role': 'attendee',
@@ -386,3 +825,91 @@ class Test_UNRSVP(unittest.TestCase):
 
     # TODO: testing foreign key violation? unique violation?
     # make it return a foresign key violation and see if it does what it does
+
+
+class Test_Query_Budget(unittest.TestCase):
+    """Statements per endpoint, counted by a Database on a mock pool"""
+
+    def setUp(self) -> None:
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.fetchall = Mock(return_value=[])
+        cursor.fetchone = Mock(return_value={
+            'event_id': '1',
+            'user_email': 'email@gmail.com',
+            'user_role': 'attendee',
+            'personal_code': 'random',
+            'is_invited': True,
+            'is_rsvped': True,
+            'is_checked_in': False,
+            'created_at': 'Mon, 08 Nov 2021 16:11:54 GMT',
+            'updated_at': 'Mon, 08 Nov 2021 16:11:54 GMT'
+        })
+        conn = MagicMock()
+        conn.__enter__ = Mock(return_value=conn)
+        conn.cursor = Mock(return_value=cursor)
+        pool = Mock()
+        pool.connection = Mock(return_value=conn)
+
+        self.conn = conn
+        self.cursor = cursor
+        self.db = Database(pool)
+        self.attendance_controller = AttendanceController(self.db,
+                                                          code_key='secret')
+
+    def tearDown(self) -> None:
+        self.attendance_controller = None
+        self.db = None
+
+    def test01_get_attendances(self):
+        with self.db.count_queries() as counter:
+            self.attendance_controller.get_attendances('1')
+        self.assertEqual(1, counter.count)
+
+    def test02_rsvp(self):
+        with self.db.count_queries() as counter:
+            self.attendance_controller.rsvp('1', 'random')
+        self.assertEqual(1, counter.count)
+
+    def test03_check_in(self):
+        with self.db.count_queries() as counter:
+            self.attendance_controller.check_in('1', 'random')
+        self.assertEqual(1, counter.count)
+
+    def test04_invite(self):
+        """Event lookup, one INSERT per chunk of emails and the email job"""
+        self.cursor.fetchone = Mock(return_value={
+            'event_id': '1',
+            'event_name': '2021 career fair',
+            'event_description': 'description',
+            'event_location': 'columbia',
+            'event_start_time': datetime(2021, 11, 15, 12, 10),
+            'event_end_time': datetime(2021, 11, 15, 14, 0),
+            'username': 'sampleUser1',
+            'job_id': 7,
+        })
+        self.cursor.fetchall = Mock(return_value=[
+            {'user_email': 'invite0@gmail.com', 'personal_code': 'random'}])
+        emails = [f'invite{i}@gmail.com' for i in range(2500)]
+
+        with self.db.count_queries() as counter:
+            self.attendance_controller.invite('1', emails)
+        self.assertEqual(5, counter.count)
+
+    def test05_check_in_batch(self):
+        """One statement for the whole batch"""
+        codes = [f'code{i}' for i in range(500)]
+        with self.db.count_queries() as counter:
+            self.attendance_controller.check_in_batch('1', codes)
+        self.assertEqual(1, counter.count)
+
+    def test06_check_in_route_timeout(self):
+        """A route's statement timeout is pipelined with the statement"""
+        self.db.start_request(statement_timeout_ms=200)
+        with self.db.count_queries() as counter:
+            self.attendance_controller.check_in('1', 'random')
+        self.assertEqual(2, counter.count)
+        self.assertEqual(1, counter.shapes[queries.SET_STATEMENT_TIMEOUT])
+        self.assertEqual({}, counter.repeated())
+        # set_config and CHECK_IN in one round trip
+        self.conn.pipeline.assert_called_once()
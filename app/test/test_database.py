@@ -1,7 +1,23 @@
+import configparser
+import os
 import unittest
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
 
+from flask import Flask
+from psycopg import errors
+from psycopg.pq import TransactionStatus
+from psycopg_pool import PoolTimeout
+
+from db import queries
+from db.admission import AdmissionGate, Overloaded
+from db.cache import MISSING, QueryCache, tables_of
+from db.config import PoolConfig
 from db.database import Database
+from db.limits import QueryLimits, QueryTimeout
+from db.notifications import AttendanceFeed
+from db.shards import ShardRouter
+from db.slow_log import SlowQueryLog
+from models.attendance import Attendance
 
 
 class Test_Database(unittest.TestCase):
@@ -94,3 +110,929 @@ class Test_Database(unittest.TestCase):
             query='SELECT * FROM Users WHERE user_id = (%s)',
             params=('hello', )
         )
+
+    def test05_db_pool_stats(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_pool.get_stats = Mock(return_value={'pool_size': 2})
+
+        self.db.get('SELECT * FROM Users')
+        self.db.set('DELETE FROM Users')
+
+        stats = self.db.get_pool_stats()
+        self.assertEqual(2, stats['checkouts'])
+        self.assertEqual(0, stats['checked_out'])
+        self.assertEqual(0, stats['waiting'])
+        self.assertEqual(0, stats['connection_errors'])
+        self.assertEqual(2, sum(stats['wait_ms_histogram'].values()))
+        self.assertEqual({'pool_size': 2}, stats['pool'])
+
+    def test06_db_pool_stats_checkout_error(self):
+        self.mock_pool.connection = Mock(side_effect=PoolTimeout('timeout'))
+        self.mock_pool.get_stats = Mock(return_value={})
+
+        with self.assertRaises(Overloaded) as ctx:
+            self.db.get('SELECT * FROM Users')
+
+        self.assertEqual(503, ctx.exception.code)
+        self.assertEqual('1', ctx.exception.get_response()
+                         .headers['Retry-After'])
+        stats = self.db.get_pool_stats()
+        self.assertEqual(1, stats['connection_errors'])
+        self.assertEqual(0, stats['checkouts'])
+        self.assertEqual(0, stats['waiting'])
+
+    def test07_db_set_many(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        cursor.rowcount = 2
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        params = [('John Doe', 'user1234'), ('Jane Doe', 'user5678')]
+        count = self.db.set_many(
+            'UPDATE Users SET username = (%s) WHERE user_id = (%s)', params)
+
+        self.assertEqual(2, count)
+        cursor.executemany.assert_called_once_with(
+            'UPDATE Users SET username = (%s) WHERE user_id = (%s)', params)
+        self.mock_pool.connection.assert_called_once()
+        self.mock_conn.commit.assert_called_once()
+
+    def test08_db_set_many_error(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        cursor.executemany = Mock(side_effect=Exception('db exception'))
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        with self.assertRaises(Exception):
+            self.db.set_many('DELETE FROM Users WHERE user_id = (%s)',
+                             [('user1234', )])
+
+        self.mock_conn.rollback.assert_called_once()
+        self.mock_conn.commit.assert_not_called()
+
+    def test09_db_pipeline(self):
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.pipeline = MagicMock()
+
+        with self.db.pipeline() as cur:
+            cur.execute('DELETE FROM Users WHERE user_id = (%s)', ('a', ))
+            cur.execute('DELETE FROM Users WHERE user_id = (%s)', ('b', ))
+
+        self.assertEqual(2, cursor.execute.call_count)
+        self.mock_conn.pipeline.assert_called_once()
+        self.mock_pool.connection.assert_called_once()
+        self.mock_conn.commit.assert_called_once()
+
+    def test10_db_pipeline_error(self):
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.pipeline = MagicMock()
+
+        with self.assertRaises(ValueError):
+            with self.db.pipeline() as cur:
+                cur.execute('DELETE FROM Users')
+                raise ValueError('abort')
+
+        self.mock_conn.rollback.assert_called_once()
+        self.mock_conn.commit.assert_not_called()
+
+    def test11_db_copy_in(self):
+        copy = MagicMock()
+        copy.__enter__ = Mock(return_value=copy)
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.copy = Mock(return_value=copy)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        rows = [('abc', 'a@a.com'), ('abc', 'b@b.com')]
+        count = self.db.copy_in('Attendance', ('event_id', 'user_email'),
+                                rows)
+
+        self.assertEqual(2, count)
+        copy.write_row.assert_any_call(('abc', 'a@a.com'))
+        copy.write_row.assert_any_call(('abc', 'b@b.com'))
+        self.mock_conn.commit.assert_called_once()
+
+    def test12_db_transaction(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        cursor.fetchone = Mock(return_value={'user_id': 'user1234'})
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.transaction = MagicMock()
+
+        with self.db.transaction():
+            self.assertTrue(self.db.in_transaction())
+            self.db.get_one('SELECT * FROM Users WHERE user_id = (%s)',
+                            ('user1234', ))
+            self.db.set('UPDATE Users SET username = (%s)', ('John Doe', ))
+            self.db.get_one('SELECT * FROM Users WHERE user_id = (%s)',
+                            ('user1234', ))
+
+        self.assertFalse(self.db.in_transaction())
+        # one checkout for all three statements
+        self.mock_pool.connection.assert_called_once()
+        self.mock_conn.transaction.assert_called_once()
+        self.assertEqual(3, cursor.execute.call_count)
+        # the transaction block commits, not set()
+        self.mock_conn.commit.assert_not_called()
+        self.mock_conn.rollback.assert_not_called()
+
+    def test13_db_transaction_error(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        cursor.execute = Mock(side_effect=Exception('db exception'))
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        transaction = MagicMock()
+        self.mock_conn.transaction = Mock(return_value=transaction)
+
+        with self.assertRaises(Exception):
+            with self.db.transaction():
+                self.db.set('UPDATE Users SET username = (%s)',
+                            ('John Doe', ))
+
+        self.assertFalse(self.db.in_transaction())
+        # the error propagates through the transaction block
+        self.assertIsNotNone(transaction.__exit__.call_args[0][1])
+        self.mock_conn.rollback.assert_not_called()
+
+    def test14_db_bind_connection(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        self.db.bind_connection()
+        self.db.get('SELECT * FROM Users')
+        self.db.set('DELETE FROM Users')
+        self.db.get('SELECT * FROM Users')
+        self.mock_conn.__exit__.assert_not_called()
+        self.db.release_connection()
+
+        self.mock_pool.connection.assert_called_once()
+        self.mock_conn.__exit__.assert_called_once()
+        # outside of a transaction each write still commits
+        self.mock_conn.commit.assert_called_once()
+
+    def test41_db_transaction_after_read(self):
+        """A read on a bound connection leaves a transaction open; it is
+        committed first so the block is a transaction, not a savepoint"""
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.transaction = MagicMock()
+
+        self.db.bind_connection()
+        self.db.get('SELECT * FROM Users')
+        self.mock_conn.info.transaction_status = TransactionStatus.INTRANS
+        with self.db.transaction():
+            self.mock_conn.commit.assert_called_once()
+            self.db.set('DELETE FROM Users')
+            # nested blocks are savepoints of the open transaction
+            with self.db.transaction():
+                pass
+        self.db.release_connection()
+
+        self.mock_conn.commit.assert_called_once()
+        self.assertEqual(2, self.mock_conn.transaction.call_count)
+
+    def test15_db_get_registered_query_is_prepared(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        self.db.get_one(queries.USER_BY_ID, ('user1234', ))
+
+        cursor.execute.assert_called_with(
+            query='SELECT user_id, org_name, username, created_at, '
+                  'updated_at FROM Users WHERE user_id = %s',
+            params=('user1234', ),
+            prepare=True
+        )
+
+    def test16_db_prepare_statements(self):
+        conn = Mock()
+
+        Database.prepare_statements(conn)
+
+        warm = queries.warm_queries()
+        self.assertEqual(len(warm), conn.execute.call_count)
+        conn.execute.assert_any_call(queries.ATTENDANCES_BY_EVENT,
+                                     [None], prepare=True)
+        executed = [c[0][0] for c in conn.execute.call_args_list]
+        self.assertNotIn(queries.INSERT_ATTENDANCES, executed)
+        conn.commit.assert_called_once()
+
+    def test17_db_prepare_statements_error(self):
+        conn = Mock()
+        conn.execute = Mock(side_effect=Exception('relation does not exist'))
+
+        Database.prepare_statements(conn)
+
+        conn.rollback.assert_called_once()
+        conn.commit.assert_not_called()
+
+    def test18_db_slow_query_is_logged_with_plan(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        cursor.fetchone = Mock(return_value={'QUERY PLAN': [{'Plan': {}}]})
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.transaction = MagicMock()
+        db = Database(self.mock_pool,
+                      SlowQueryLog(threshold_ms=0, explain_sample_rate=1.0))
+
+        with self.assertLogs('db.slow_log', level='WARNING'):
+            db.get_one('SELECT * FROM Users WHERE user_id = (%s)',
+                       ('user1234', ))
+
+        cursor.execute.assert_called_with(
+            'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+            'SELECT * FROM Users WHERE user_id = (%s)',
+            ('user1234', )
+        )
+        # The explain savepoint never keeps what it ran
+        self.mock_conn.transaction.assert_called_once_with(
+            force_rollback=True)
+        entries = db.get_slow_queries()
+        self.assertEqual(1, len(entries))
+        self.assertEqual(['user1234'], entries[0]['params'])
+        self.assertEqual([{'Plan': {}}], entries[0]['plan'])
+
+    def test19_db_fast_query_is_not_logged(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        self.db.set('UPDATE Users SET username = (%s)', ('John Doe', ))
+
+        self.assertEqual([], self.db.get_slow_queries())
+        cursor.execute.assert_called_once()
+
+    def _replica(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        replica_conn = MagicMock()
+        replica_conn.__enter__ = Mock(return_value=replica_conn)
+        replica_pool = Mock()
+        replica_pool.connection = Mock(return_value=replica_conn)
+        return replica_pool, replica_conn
+
+    def test20_db_reads_go_to_replica(self):
+        replica_pool, replica_conn = self._replica()
+        db = Database(self.mock_pool, replica=replica_pool)
+
+        db.start_request()
+        db.get('SELECT * FROM Users')
+        db.get_one('SELECT * FROM Users WHERE user_id = (%s)', ('a', ))
+        self.assertEqual(2, replica_pool.connection.call_count)
+        self.mock_pool.connection.assert_not_called()
+
+        # read-your-writes: after a write, reads stay on the primary
+        db.set('UPDATE Users SET username = (%s)', ('John Doe', ))
+        db.get('SELECT * FROM Users')
+        self.assertEqual(2, replica_pool.connection.call_count)
+        self.assertEqual(2, self.mock_pool.connection.call_count)
+
+        # until the next request
+        db.start_request()
+        db.get('SELECT * FROM Users')
+        self.assertEqual(3, replica_pool.connection.call_count)
+
+    def test21_db_read_your_writes_window(self):
+        replica_pool, replica_conn = self._replica()
+        db = Database(self.mock_pool, replica=replica_pool,
+                      read_your_writes_seconds=0)
+
+        db.set('UPDATE Users SET username = (%s)', ('John Doe', ))
+        db.get('SELECT * FROM Users')
+
+        replica_pool.connection.assert_called_once()
+
+    def test22_db_replica_unavailable(self):
+        replica_pool, replica_conn = self._replica()
+        replica_pool.connection = Mock(side_effect=PoolTimeout('timeout'))
+        replica_pool.get_stats = Mock(return_value={})
+        self.mock_pool.get_stats = Mock(return_value={})
+        db = Database(self.mock_pool, replica=replica_pool)
+
+        db.get('SELECT * FROM Users')
+
+        self.mock_pool.connection.assert_called_once()
+        stats = db.get_pool_stats()
+        self.assertEqual(1, stats['replica']['connection_errors'])
+        self.assertEqual(1, stats['checkouts'])
+
+    def test23_db_transaction_reads_stay_on_primary(self):
+        replica_pool, replica_conn = self._replica()
+        self.mock_conn.transaction = MagicMock()
+        db = Database(self.mock_pool, replica=replica_pool)
+
+        with db.transaction():
+            db.get('SELECT * FROM Users')
+
+        replica_pool.connection.assert_not_called()
+        self.mock_pool.connection.assert_called_once()
+
+    def test24_db_prepare_statements_reads_only(self):
+        conn = Mock()
+
+        Database.prepare_statements(conn, reads_only=True)
+
+        executed = [c[0][0] for c in conn.execute.call_args_list]
+        self.assertIn(queries.ATTENDANCES_BY_EVENT, executed)
+        self.assertNotIn(queries.CHECK_IN, executed)
+
+    def _cached_db(self):
+        cursor = Mock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.__exit__ = Mock(return_value=False)
+        cursor.fetchone = Mock(return_value={'user_id': 'user1234'})
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.transaction = MagicMock()
+        return Database(self.mock_pool, cache=QueryCache()), cursor
+
+    def test25_db_cache_hit(self):
+        db, cursor = self._cached_db()
+
+        first = db.get_one(queries.USER_BY_ID, ('user1234', ))
+        first['username'] = 'changed by caller'
+        second = db.get_one(queries.USER_BY_ID, ('user1234', ))
+
+        self.assertEqual({'user_id': 'user1234'}, second)
+        cursor.execute.assert_called_once()
+        stats = db.get_cache_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test26_db_cache_not_used_for_unregistered_queries(self):
+        db, cursor = self._cached_db()
+
+        db.get_one('SELECT * FROM Users WHERE user_id = (%s)', ('a', ))
+        db.get_one('SELECT * FROM Users WHERE user_id = (%s)', ('a', ))
+
+        self.assertEqual(2, cursor.execute.call_count)
+
+    def test27_db_cache_invalidated_by_write(self):
+        db, cursor = self._cached_db()
+
+        db.get_one(queries.USER_BY_ID, ('user1234', ))
+        db.get_one(queries.EVENT_BY_ID, ('abc', ))
+        db.set('UPDATE Users SET username = (%s)', ('John Doe', ))
+        db.get_one(queries.USER_BY_ID, ('user1234', ))
+        db.get_one(queries.EVENT_BY_ID, ('abc', ))
+
+        # Users entry was dropped, Events entry was not
+        self.assertEqual(4, cursor.execute.call_count)
+        self.assertEqual(1, db.get_cache_stats()['invalidations'])
+
+    def test28_db_cache_invalidated_after_transaction(self):
+        db, cursor = self._cached_db()
+
+        db.get_one(queries.USER_BY_ID, ('user1234', ))
+        with db.transaction():
+            db.set('UPDATE Users SET username = (%s)', ('John Doe', ))
+            self.assertEqual(1, db.get_cache_stats()['entries'])
+            # reads inside a transaction bypass the cache
+            db.get_one(queries.USER_BY_ID, ('user1234', ))
+        self.assertEqual(0, db.get_cache_stats()['entries'])
+        self.assertEqual(3, cursor.execute.call_count)
+
+    def test42_db_cache_filled_from_primary(self):
+        """Cached queries miss on the primary, other reads use the
+        replica"""
+        replica_pool, replica_conn = self._replica()
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.fetchone = Mock(return_value={'user_id': 'user1234'})
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        db = Database(self.mock_pool, replica=replica_pool,
+                      cache=QueryCache())
+
+        db.get_one(queries.USER_BY_ID, ('user1234', ))
+        db.get_one(queries.USER_BY_ID, ('user1234', ))
+        self.mock_pool.connection.assert_called_once()
+        replica_pool.connection.assert_not_called()
+
+        db.get('SELECT * FROM Users')
+        replica_pool.connection.assert_called_once()
+
+    def test29_db_bounded_checkout_wait(self):
+        self.mock_conn.cursor = MagicMock()
+        db = Database(self.mock_pool, checkout_timeout=0.5, retry_after=3)
+
+        db.get('SELECT * FROM Users')
+        self.mock_pool.connection.assert_called_with(timeout=0.5)
+
+        self.mock_pool.connection = Mock(side_effect=PoolTimeout('timeout'))
+        with self.assertRaises(Overloaded) as ctx:
+            db.set('UPDATE Users SET username = (%s)', ('John Doe', ))
+        self.assertEqual('3', ctx.exception.get_response()
+                         .headers['Retry-After'])
+
+    def test30_db_statement_timeout(self):
+        self.mock_conn.cursor = MagicMock()
+        self.mock_conn.pipeline = MagicMock()
+
+        self.db.start_request(statement_timeout_ms=200)
+        self.db.get('SELECT * FROM Users')
+        self.mock_conn.execute.assert_called_with(
+            queries.SET_STATEMENT_TIMEOUT, ('200', ), prepare=True)
+        # Sent with the statement, not in a round trip of its own
+        self.mock_conn.pipeline.assert_called_once()
+
+        self.mock_conn.execute.reset_mock()
+        self.mock_conn.pipeline.reset_mock()
+        with self.db.statement_timeout(None):
+            self.db.get('SELECT * FROM Users')
+        self.mock_conn.execute.assert_not_called()
+        self.mock_conn.pipeline.assert_not_called()
+
+    def test31_db_statement_timeout_exceeded(self):
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.execute = Mock(side_effect=errors.QueryCanceled('canceled'))
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.pipeline = MagicMock()
+
+        with self.db.statement_timeout(200):
+            with self.assertRaises(QueryTimeout) as ctx:
+                self.db.set('UPDATE Users SET username = (%s)',
+                            ('John Doe', ))
+
+        self.assertEqual(503, ctx.exception.code)
+        self.mock_conn.rollback.assert_called()
+
+    def test32_db_request_budget(self):
+        self.mock_conn.cursor = MagicMock()
+        self.mock_conn.pipeline = MagicMock()
+        db = Database(self.mock_pool,
+                      limits=QueryLimits(statement_timeout_ms=5000,
+                                         request_budget_ms=1000))
+
+        db.start_request(statement_timeout_ms=200)
+        db.get('SELECT * FROM Users')
+        self.mock_conn.execute.assert_called_with(
+            queries.SET_STATEMENT_TIMEOUT, ('200', ), prepare=True)
+
+        db.start_request()
+        db.get('SELECT * FROM Users')
+        # capped by what is left of the budget
+        timeout = int(self.mock_conn.execute.call_args.args[1][0])
+        self.assertLessEqual(timeout, 1000)
+        self.assertGreater(timeout, 900)
+
+        db._local.budget_ms = 0
+        with self.assertRaises(QueryTimeout):
+            db.get('SELECT * FROM Users')
+
+    @patch('db.database.ConnectionPool')
+    def test33_db_get_connection_statement_timeout(self, mock_pool_cls):
+        Database.get_connection('postgresql://localhost/test',
+                                read_only=True, statement_timeout_ms=5000)
+
+        options = mock_pool_cls.call_args.kwargs['kwargs']['options']
+        self.assertEqual('-c default_transaction_read_only=on '
+                         '-c statement_timeout=5000', options)
+
+    def _sharded(self):
+        shard_conn = MagicMock()
+        shard_conn.__enter__ = Mock(return_value=shard_conn)
+        shard_pool = Mock()
+        shard_pool.connection = Mock(return_value=shard_conn)
+        shard_pool.get_stats = Mock(return_value={})
+        self.mock_pool.get_stats = Mock(return_value={})
+        self.mock_conn.cursor = MagicMock()
+        router = ShardRouter([shard_pool], {'columbia.edu': 1})
+        return Database(self.mock_pool, shards=router), shard_pool
+
+    def test34_db_use_shard(self):
+        db, shard_pool = self._sharded()
+
+        self.assertEqual(1, db.use_shard(user_id='a@columbia.edu'))
+        db.get('SELECT * FROM Users')
+        shard_pool.connection.assert_called_once()
+        self.assertTrue(db.tag_event_id('bxyz').startswith('S01'))
+
+        self.assertEqual(0, db.use_shard(event_id='bxyz'))
+        db.get('SELECT * FROM Users')
+        self.mock_pool.connection.assert_called_once()
+
+        self.assertEqual(1, db.use_shard(event_id='S01bxyz'))
+        self.assertEqual(1, db.get_pool_stats()['shards'][0]['checkouts'])
+
+    def test35_db_use_shard_in_transaction(self):
+        db, _ = self._sharded()
+        self.mock_conn.transaction = MagicMock()
+
+        with db.transaction():
+            # same shard is fine
+            db.use_shard(event_id='bxyz')
+            with self.assertRaises(RuntimeError):
+                db.use_shard(user_id='a@columbia.edu')
+
+    def test39_db_use_shard_number(self):
+        db, shard_pool = self._sharded()
+
+        self.assertEqual(2, db.shard_count)
+        self.assertEqual(1, db.use_shard(shard=1))
+        db.get('SELECT * FROM Jobs')
+        shard_pool.connection.assert_called_once()
+        with self.assertRaises(ValueError):
+            db.use_shard(shard=2)
+
+    def test36_db_init_app_routes_by_view_args(self):
+        db, shard_pool = self._sharded()
+        app = Flask(__name__)
+        db.init_app(app)
+
+        @app.route('/events/<event_id>')
+        def event(event_id):
+            db.get_one('SELECT * FROM Events WHERE event_id = %s',
+                       (event_id, ))
+            return 'ok'
+
+        client = app.test_client()
+        client.get('/events/S01bxyz')
+        shard_pool.connection.assert_called_once()
+        client.get('/events/bxyz')
+        self.mock_pool.connection.assert_called_once()
+
+    def test37_db_lane(self):
+        self.mock_conn.cursor = MagicMock()
+        self.mock_pool.get_stats = Mock(return_value={})
+        bulk_conn = MagicMock()
+        bulk_conn.__enter__ = Mock(return_value=bulk_conn)
+        bulk_pool = Mock()
+        bulk_pool.connection = Mock(return_value=bulk_conn)
+        bulk_pool.get_stats = Mock(return_value={})
+        db = Database(self.mock_pool, lanes={Database.BULK: bulk_pool})
+
+        with db.lane(Database.BULK):
+            db.set_many('UPDATE Users SET username = %s', [('x', )])
+        db.get('SELECT * FROM Users')
+        with db.lane('export'):
+            # no pool of its own
+            db.get('SELECT * FROM Users')
+
+        bulk_pool.connection.assert_called_once()
+        self.assertEqual(2, self.mock_pool.connection.call_count)
+        self.assertEqual(1, db.get_pool_stats()['lanes']['bulk']['checkouts'])
+
+    def test38_db_set_returning(self):
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.fetchone = Mock(return_value={'is_checked_in': True})
+        self.mock_conn.cursor = Mock(return_value=cursor)
+
+        row = self.db.set_returning(queries.CHECK_IN, ('1', 'random'))
+
+        self.assertEqual({'is_checked_in': True}, row)
+        cursor.execute.assert_called_once_with(
+            query=queries.CHECK_IN, params=('1', 'random'), prepare=True)
+        self.mock_conn.commit.assert_called_once()
+
+    def test40_db_copy_in_statement_timeout(self):
+        """COPY can't be pipelined: the timeout is set on its own"""
+        copy = MagicMock()
+        copy.__enter__ = Mock(return_value=copy)
+        cursor = MagicMock()
+        cursor.__enter__ = Mock(return_value=cursor)
+        cursor.copy = Mock(return_value=copy)
+        self.mock_conn.cursor = Mock(return_value=cursor)
+        self.mock_conn.pipeline = MagicMock()
+
+        with self.db.statement_timeout(200):
+            with self.db.count_queries() as counter:
+                self.db.copy_in('Attendance', ('event_id', 'user_email'),
+                                [('abc', 'a@a.com')])
+
+        self.mock_conn.execute.assert_called_once_with(
+            queries.SET_STATEMENT_TIMEOUT, ('200', ), prepare=True)
+        self.mock_conn.pipeline.assert_not_called()
+        self.assertEqual(2, counter.count)
+
+
+class Test_PoolConfig(unittest.TestCase):
+
+    def test01_defaults(self):
+        config = PoolConfig()
+        self.assertEqual('postgresql://postgres@db:5432/aapi',
+                         config.conninfo)
+        self.assertEqual(1, config.min_size)
+        self.assertEqual(2, config.max_size)
+
+    @patch.dict(os.environ, {
+        'DATABASE_URL': 'postgresql://postgres@localhost:5432/aapi',
+        'DB_POOL_MIN_SIZE': '4',
+        'DB_POOL_MAX_SIZE': '16',
+        'DB_POOL_TIMEOUT': '2.5',
+        'DB_POOL_MAX_IDLE': '60',
+        'DB_POOL_MAX_LIFETIME': '1800',
+    })
+    def test02_from_env(self):
+        config = PoolConfig.from_env()
+        self.assertEqual('postgresql://postgres@localhost:5432/aapi',
+                         config.conninfo)
+        self.assertEqual(4, config.min_size)
+        self.assertEqual(16, config.max_size)
+        self.assertEqual(2.5, config.timeout)
+        self.assertEqual(60.0, config.max_idle)
+        self.assertEqual(1800.0, config.max_lifetime)
+
+    def test03_invalid_size(self):
+        with self.assertRaises(ValueError):
+            PoolConfig(min_size=4, max_size=2)
+
+
+class Test_QueryCounter(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.mock_conn = MagicMock()
+        self.mock_conn.__enter__ = Mock(return_value=self.mock_conn)
+        self.mock_pool = Mock()
+        self.mock_pool.connection = Mock(return_value=self.mock_conn)
+        self.db = Database(self.mock_pool)
+
+    def test01_count_queries(self):
+        with self.db.count_queries() as counter:
+            for user_id in ('a', 'b', 'c'):
+                self.db.get_one('SELECT * FROM Users WHERE user_id = %s',
+                                (user_id, ))
+            self.db.set_many('UPDATE Users SET username = %s', [('x', )])
+
+        self.assertEqual(4, counter.count)
+        self.assertEqual({'SELECT * FROM Users WHERE user_id = %s': 3},
+                         counter.repeated())
+        # nothing is counted outside the block
+        self.db.get('SELECT * FROM Users')
+        self.assertEqual(4, counter.count)
+
+    def test02_init_app_headers(self):
+        app = Flask(__name__)
+        self.db.init_app(app, count_queries=True)
+
+        @app.route('/users')
+        def users():
+            for user_id in ('a', 'b', 'c'):
+                self.db.get_one('SELECT * FROM Users WHERE user_id = %s',
+                                (user_id, ))
+            return 'ok'
+
+        with self.assertLogs('db.query_counter', level='WARNING'):
+            response = app.test_client().get('/users')
+
+        self.assertEqual('3', response.headers['X-DB-Query-Count'])
+        self.assertEqual('1', response.headers['X-DB-Repeated-Queries'])
+        self.assertIn('X-DB-Query-Time-Ms', response.headers)
+
+    def test03_init_app_disabled(self):
+        app = Flask(__name__)
+        self.db.init_app(app)
+
+        @app.route('/users')
+        def users():
+            self.db.get('SELECT * FROM Users')
+            return 'ok'
+
+        response = app.test_client().get('/users')
+        self.assertNotIn('X-DB-Query-Count', response.headers)
+
+
+class Test_ShardRouter(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.router = ShardRouter([Mock(), Mock()], {'columbia.edu': 2})
+
+    def test01_shard_of_user(self):
+        self.assertEqual(3, self.router.count)
+        self.assertEqual(2, self.router.shard_of_user('a@Columbia.edu'))
+        shard = self.router.shard_of_user('a@gmail.com')
+        self.assertIn(shard, range(3))
+        # stable across calls (and processes: crc32)
+        self.assertEqual(shard, self.router.shard_of_user('b@gmail.com'))
+
+    def test02_event_ids(self):
+        event_id = self.router.tag_event_id('bwaPbxV1aRTSykhZ84WRx5A', 2)
+        self.assertEqual('S02bwaPbxV1aRTSykhZ84WRx5A', event_id)
+        self.assertEqual(2, self.router.shard_of_event(event_id))
+        # pre-sharding IDs and unknown shards stay on shard 0
+        self.assertEqual(0, self.router.shard_of_event('bwaPbxV1aRTSyk'))
+        self.assertEqual(0, self.router.shard_of_event('S07bwaPbxV1aRT'))
+
+    def test03_single_shard(self):
+        router = ShardRouter()
+        self.assertEqual('bxyz', router.tag_event_id('bxyz', 0))
+        self.assertEqual(0, router.shard_of_user('a@columbia.edu'))
+
+    def test04_parse_orgs(self):
+        self.assertEqual({'columbia.edu': 1, 'example.com': 2},
+                         ShardRouter.parse_orgs(
+                             'columbia.edu=1, example.com=2'))
+        self.assertEqual({}, ShardRouter.parse_orgs(None))
+        with self.assertRaises(ValueError):
+            ShardRouter([], {'columbia.edu': 1})
+
+
+class Test_QueryLimits(unittest.TestCase):
+
+    def test01_from_env(self):
+        env = {'DB_STATEMENT_TIMEOUT_MS': '0', 'DB_REQUEST_BUDGET_MS': '800'}
+        with patch.dict(os.environ, env):
+            limits = QueryLimits.from_env({'check_in': 200})
+
+        self.assertIsNone(limits.statement_timeout_ms)
+        self.assertEqual(800, limits.request_budget_ms)
+        self.assertEqual(200, limits.for_endpoint('check_in'))
+        self.assertIsNone(limits.for_endpoint('get_event'))
+
+
+class Test_Queries(unittest.TestCase):
+
+    def test01_whitespace_is_normalized(self):
+        self.assertEqual(
+            'SELECT event_id, user_email, user_role, personal_code, '
+            'is_invited, is_rsvped, is_checked_in, created_at, updated_at '
+            'FROM Attendance WHERE event_id = %s',
+            queries.ATTENDANCES_BY_EVENT)
+        self.assertTrue(queries.is_registered(queries.ATTENDANCES_BY_EVENT))
+        self.assertFalse(queries.is_registered('SELECT 1'))
+
+    def test02_duplicate_name(self):
+        with self.assertRaises(ValueError):
+            queries.register('user_by_id', 'SELECT 1')
+
+    def test03_prepared_columns(self):
+        """Warm statements on Attendance and Users list their columns, so
+        a migration adding a column doesn't break them"""
+        for query in (queries.USER_BY_ID, queries.CHECK_IN, queries.RSVP,
+                      queries.UNRSVP):
+            self.assertNotIn('*', query)
+        self.assertTrue(queries.CHECK_IN.endswith(
+            'RETURNING ' + ', '.join(Attendance.FIELDS)))
+
+
+class Test_SlowQueryLog(unittest.TestCase):
+
+    def test01_explain_statement(self):
+        self.assertEqual(
+            'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT 1',
+            SlowQueryLog.explain_statement('SELECT 1'))
+        # writes are explained without running them
+        self.assertEqual(
+            'EXPLAIN (FORMAT JSON) UPDATE Users SET username = %s',
+            SlowQueryLog.explain_statement('UPDATE Users SET username = %s'))
+        # so are data-modifying CTEs
+        self.assertEqual(
+            f'EXPLAIN (FORMAT JSON) {queries.CHECK_IN_BATCH}',
+            SlowQueryLog.explain_statement(queries.CHECK_IN_BATCH))
+        self.assertEqual(
+            'EXPLAIN (FORMAT JSON) WITH codes AS (SELECT 1) '
+            'UPDATE Attendance SET is_checked_in = TRUE',
+            SlowQueryLog.explain_statement(
+                'WITH codes AS (SELECT 1) '
+                'UPDATE Attendance SET is_checked_in = TRUE'))
+
+    def test02_max_entries(self):
+        log = SlowQueryLog(threshold_ms=10, max_entries=2)
+        self.assertFalse(log.is_slow(9.9))
+        self.assertTrue(log.is_slow(10))
+        with self.assertLogs('db.slow_log', level='WARNING'):
+            for i in range(3):
+                log.record('SELECT %s', (i, ), 12.5)
+        self.assertEqual([[1], [2]], [e['params'] for e in log.entries()])
+
+
+class Test_QueryCache(unittest.TestCase):
+
+    def test01_tables_of(self):
+        self.assertEqual(frozenset(['events', 'users']), tables_of(
+            'SELECT * FROM Events JOIN Users ON Users.user_id = '
+            'Events.user_id WHERE event_id = %s'))
+        self.assertEqual(frozenset(['attendance']), tables_of(
+            'UPDATE Attendance SET is_rsvped = True'))
+
+    def test02_lru_eviction(self):
+        cache = QueryCache(max_entries=2)
+        for i in range(3):
+            cache.put(cache.key('SELECT * FROM Users', (i, )),
+                      'SELECT * FROM Users', {'i': i}, cache.generation)
+        self.assertIs(MISSING, cache.get(cache.key('SELECT * FROM Users',
+                                                   (0, ))))
+        self.assertEqual({'i': 2}, cache.get(
+            cache.key('SELECT * FROM Users', (2, ))))
+        self.assertEqual(1, cache.to_dict()['evictions'])
+
+    def test03_ttl(self):
+        cache = QueryCache(ttl_seconds=0)
+        key = cache.key('SELECT * FROM Users', None)
+        cache.put(key, 'SELECT * FROM Users', [], cache.generation)
+        self.assertIs(MISSING, cache.get(key))
+        self.assertEqual(1, cache.to_dict()['expirations'])
+
+    def test04_memory_cap(self):
+        cache = QueryCache(max_bytes=1000)
+        cache.put('big', 'SELECT * FROM Users', ['x' * 2000],
+                  cache.generation)
+        self.assertEqual(0, cache.to_dict()['entries'])
+        for i in range(10):
+            cache.put(i, 'SELECT * FROM Users', {'v': 'x' * 100},
+                      cache.generation)
+        self.assertLessEqual(cache.to_dict()['bytes'], 1000)
+        self.assertGreater(cache.to_dict()['evictions'], 0)
+
+    def test05_stale_put_is_ignored(self):
+        cache = QueryCache()
+        generation = cache.generation
+        cache.invalidate(frozenset(['users']))
+        cache.put('k', 'SELECT * FROM Users', {}, generation)
+        self.assertIs(MISSING, cache.get('k'))
+
+
+class Test_AdmissionGate(unittest.TestCase):
+
+    def test01_admit_and_release(self):
+        gate = AdmissionGate(max_active=1, max_queue=0)
+        gate.acquire()
+        with self.assertRaises(Overloaded):
+            gate.acquire()
+        gate.release()
+        gate.acquire()
+
+        stats = gate.to_dict()
+        self.assertEqual(1, stats['active'])
+        self.assertEqual(2, stats['admitted'])
+        self.assertEqual(1, stats['rejected'])
+
+    def test02_queue_timeout(self):
+        gate = AdmissionGate(max_active=1, max_queue=1, queue_timeout=0.01)
+        gate.acquire()
+        with self.assertRaises(Overloaded):
+            gate.acquire()
+
+        stats = gate.to_dict()
+        self.assertEqual(1, stats['timed_out'])
+        self.assertEqual(0, stats['queued'])
+
+    def test03_invalid_limits(self):
+        with self.assertRaises(ValueError):
+            AdmissionGate(max_active=0)
+
+    def test04_from_env_disabled(self):
+        with patch.dict(os.environ, {'ADMISSION_MAX_ACTIVE': '0'}):
+            self.assertIsNone(AdmissionGate.from_env())
+
+    def test05_init_app(self):
+        app = Flask(__name__)
+        gate = AdmissionGate(max_active=1, max_queue=0, retry_after=2)
+        gate.init_app(app)
+
+        @app.route('/busy')
+        def busy():
+            # A second request while this one holds the only slot
+            with app.test_request_context('/other'):
+                with self.assertRaises(Overloaded):
+                    gate.acquire()
+            return 'ok'
+
+        @app.route('/health')
+        def health():
+            return 'ok'
+
+        client = app.test_client()
+        self.assertEqual(200, client.get('/busy').status_code)
+        gate.acquire()
+        response = client.get('/busy')
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('2', response.headers['Retry-After'])
+        self.assertEqual(200, client.get('/health').status_code)
+        gate.release()
+        self.assertEqual(0, gate.to_dict()['active'])
+
+    def test06_uwsgi_threads(self):
+        """Every admitted, queued and streaming request gets a thread, so
+        the gate (not uWSGI's backlog) decides what waits and what is
+        shed"""
+        config = configparser.ConfigParser()
+        config.read(os.path.join(os.path.dirname(__file__), '..',
+                                 'uwsgi.ini'))
+        gate = AdmissionGate.from_env()
+        feed = AttendanceFeed.from_env([])
+        self.assertGreaterEqual(config.getint('uwsgi', 'threads'),
+                                gate.max_active + gate.max_queue
+                                + feed.max_subscribers)
@@ -41,6 +41,7 @@ class Test_EventController(unittest.TestCase):
         })
 
         db.set = Mock(return_value=None)
+        db.tag_event_id = Mock(side_effect=lambda event_id: event_id)
 
         # Create EventController
         self.event_controller = EventController(db)
@@ -286,3 +287,28 @@ class Test_EventController(unittest.TestCase):
         actual = self.event_controller.\
             get_formatted_address_with_lgt_ltt_from_gmaps("", -12.12, 21.21)
         self.assertDictEqual(expected, actual)
+
+    def test03_formatted_event_address(self):
+        """Geocoding goes through the pooled NetworkService"""
+        self.event_controller.requests = Mock()
+        self.event_controller.requests.request = Mock(return_value=Mock(
+            status_code=200,
+            json=Mock(return_value={'results': [{
+                'formatted_address': '2920 Broadway, New York',
+                'geometry': {'location': {'lat': 40.8, 'lng': -73.9}},
+            }]})))
+        expected = {
+            'lat': 40.8,
+            'long': -73.9,
+            'address': '2920 Broadway New York',
+        }
+        actual = self.event_controller.\
+            get_formatted_address_with_lgt_ltt_from_gmaps(
+                "2920 Broadway, New York", None, None)
+        self.assertDictEqual(expected, actual)
+        method, url = self.event_controller.requests.request.call_args.args
+        self.assertEqual('GET', method)
+        self.assertIn('maps.googleapis.com', url)
+        self.assertEqual('2920 Broadway, New York', self.event_controller
+                         .requests.request.call_args.kwargs['params']
+                         ['address'])
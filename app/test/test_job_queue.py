@@ -0,0 +1,175 @@
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+from db import queries
+from db.jobs import JobQueue
+from services.job_worker import JobWorker
+
+
+A = {'email': 'a@x.com', 'personal_code': 'aaaa'}
+B = {'email': 'b@x.com', 'personal_code': 'bbbb'}
+
+
+def make_job(attempts=1, items=None, kind=JobQueue.INVITE_EMAILS):
+    return {
+        'job_id': 7,
+        'kind': kind,
+        'event_id': '1',
+        'payload': {'event_id': '1',
+                    'items': items if items is not None else [A, B]},
+        'attempts': attempts,
+        'max_attempts': 3,
+    }
+
+
+class Test_JobQueue(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.db = MagicMock()
+        self.queue = JobQueue(self.db, max_attempts=3, backoff_seconds=10,
+                              max_backoff_seconds=30, lease_seconds=60)
+
+    def tearDown(self) -> None:
+        self.queue = None
+
+    def test01_enqueue(self):
+        self.db.set_returning = Mock(return_value={'job_id': 7})
+        job_id = self.queue.enqueue(JobQueue.INVITE_EMAILS, '1',
+                                    {'event_id': '1', 'items': ['a', 'b']})
+        self.assertEqual(7, job_id)
+        query, params = self.db.set_returning.call_args.args
+        self.assertEqual(queries.INSERT_JOB, query)
+        self.assertEqual([JobQueue.INVITE_EMAILS, '1'], params[:2])
+        self.assertEqual({'event_id': '1', 'items': ['a', 'b']}, params[2].obj)
+        # total, max_attempts
+        self.assertEqual([2, 3], params[3:])
+
+    def test02_claim(self):
+        self.db.set_returning = Mock(return_value=None)
+        self.assertIsNone(self.queue.claim())
+        self.db.set_returning.assert_called_once_with(queries.CLAIM_JOB, [60])
+        self.assertIn('FOR UPDATE SKIP LOCKED', queries.CLAIM_JOB)
+
+    def test03_backoff(self):
+        self.assertEqual(10, self.queue.backoff(1))
+        self.assertEqual(20, self.queue.backoff(2))
+        self.assertEqual(30, self.queue.backoff(3))
+
+    def test04_finish(self):
+        """All items done"""
+        self.assertEqual(JobQueue.DONE,
+                         self.queue.finish(make_job(), 2, []))
+        query, params = self.db.set.call_args.args
+        self.assertEqual(queries.FINISH_JOB, query)
+        self.assertEqual([JobQueue.DONE], params[:1])
+        self.assertEqual([], params[1].obj['items'])
+        # sent, failed, delay, error, job_id, attempts
+        self.assertEqual([2, 0, 0.0, None, 7, 1], params[2:])
+
+    def test05_finish(self):
+        """Failed items are retried with backoff"""
+        self.assertEqual(JobQueue.QUEUED,
+                         self.queue.finish(make_job(attempts=2), 1, ['b'],
+                                           'error'))
+        params = self.db.set.call_args.args[1]
+        self.assertEqual(['b'], params[1].obj['items'])
+        self.assertEqual([1, 0, 20, 'error', 7, 2], params[2:])
+
+    def test06_finish(self):
+        """Out of attempts: failed items are counted as failed"""
+        self.assertEqual(JobQueue.FAILED,
+                         self.queue.finish(make_job(attempts=3), 0, ['a', 'b'],
+                                           'error'))
+        params = self.db.set.call_args.args[1]
+        self.assertEqual([0, 2, 0.0], params[2:5])
+
+    def test07_get_progress(self):
+        self.db.get_one = Mock(return_value={
+            'job_id': 7, 'status': 'queued', 'total': 5, 'sent': 2,
+            'failed': 1})
+        progress = self.queue.get_progress('1', 7)
+        self.assertEqual(2, progress['pending'])
+        self.db.get_one.assert_called_once_with(queries.JOB_PROGRESS,
+                                                [7, '1'])
+
+        self.db.get_one = Mock(return_value=None)
+        self.assertIsNone(self.queue.get_progress('1', 8))
+
+
+class Test_JobWorker(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.db = Mock()
+        self.db.shard_count = 2
+        self.queue = Mock()
+        self.queue.finish = Mock(side_effect=lambda job, sent, failed,
+                                 error=None: 'status')
+        self.handler = Mock(return_value=[])
+        self.worker = JobWorker(self.db, self.queue,
+                                {JobQueue.INVITE_EMAILS: self.handler})
+
+    def tearDown(self) -> None:
+        self.worker = None
+
+    def test01_run_once(self):
+        """One claim per shard"""
+        self.queue.claim = Mock(side_effect=[make_job(), None])
+        self.assertEqual(1, self.worker.run_once())
+        self.assertEqual([unittest.mock.call(shard=0),
+                          unittest.mock.call(shard=1)],
+                         self.db.use_shard.call_args_list)
+        self.handler.assert_called_once_with(make_job()['payload'])
+        self.queue.finish.assert_called_once_with(make_job(), 2, [], None)
+
+    def test02_process(self):
+        """Failed items are handed back to the queue"""
+        self.handler.return_value = [dict(B, reason='timeout')]
+        self.worker.process(make_job())
+        self.queue.finish.assert_called_once_with(
+            make_job(), 1, [dict(B, reason='timeout')],
+            '1 of 2 items failed')
+
+    def test03_process(self):
+        """A handler error fails every item of the attempt"""
+        self.handler.side_effect = ValueError('Unknown event 1')
+        self.worker.process(make_job())
+        self.queue.finish.assert_called_once_with(
+            make_job(), 0, [dict(A, reason='Unknown event 1'),
+                            dict(B, reason='Unknown event 1')],
+            'Unknown event 1')
+
+    def test04_process(self):
+        """Unknown job kind"""
+        self.worker.process(make_job(kind='other'))
+        self.handler.assert_not_called()
+        self.assertEqual('Unknown job kind other',
+                         self.queue.finish.call_args.args[3])
+        # the progress of the job shows why its items failed
+        self.assertEqual(['Unknown job kind other'] * 2,
+                         [item['reason'] for item
+                          in self.queue.finish.call_args.args[2]])
+
+    def test05_stop(self):
+        self.queue.claim = Mock(return_value=None)
+        self.worker.poll_seconds = 0
+        self.db.use_shard = Mock(side_effect=lambda shard: self.worker.stop())
+        self.worker.run()
+        self.assertFalse(self.worker.running)
+
+    @patch('services.job_worker.time.sleep')
+    def test06_run_error(self, sleep):
+        """An error while polling is logged and retried with a growing
+        sleep"""
+        self.queue.claim = Mock(side_effect=[
+            OSError('shard down'), OSError('shard down'), make_job(), None,
+            None, None])
+        self.worker.poll_seconds = 1
+        sleep.side_effect = lambda seconds: (
+            sleep.call_count == 3 and self.worker.stop())
+
+        with self.assertLogs('services.job_worker', 'ERROR'):
+            self.worker.run()
+
+        self.assertEqual([unittest.mock.call(2), unittest.mock.call(4),
+                          unittest.mock.call(1)], sleep.call_args_list)
+        self.handler.assert_called_once()
@@ -0,0 +1,50 @@
+import os
+import unittest
+from unittest.mock import Mock, patch
+
+from services.network_service import NetworkService
+
+
+class Test_NetworkService(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.network = NetworkService(pool_connections=2, pool_maxsize=4,
+                                      retries=3, backoff_factor=0.5,
+                                      timeout=5)
+
+    def tearDown(self) -> None:
+        self.network = None
+
+    def test01_session(self):
+        """One session per process, pooled and retried as configured"""
+        session = self.network.session
+        self.assertIs(session, self.network.session)
+        adapter = session.get_adapter('https://api.mailgun.net')
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertEqual(3, adapter.max_retries.total)
+        self.assertEqual(0.5, adapter.max_retries.backoff_factor)
+        # POST is not retried by the session
+        self.assertFalse(adapter.max_retries.is_retry('POST', 503))
+        self.assertTrue(adapter.max_retries.is_retry('GET', 503))
+
+    def test02_session_after_fork(self):
+        session = self.network.session
+        with patch('services.network_service.os.getpid',
+                   return_value=-1):
+            self.assertIsNot(session, self.network.session)
+
+    def test03_request(self):
+        """The default timeout applies unless given"""
+        self.network._session = Mock()
+        self.network._pid = os.getpid()
+        self.network._session.request = Mock(return_value=Mock(
+            json=Mock(return_value={'email': 'a@b.com'})))
+
+        self.assertEqual({'email': 'a@b.com'},
+                         self.network.get('https://oauth2.googleapis.com'))
+        self.network._session.request.assert_called_with(
+            'GET', 'https://oauth2.googleapis.com', timeout=5)
+
+        self.network.post('https://api.mailgun.net', data={}, timeout=1)
+        self.network._session.request.assert_called_with(
+            'POST', 'https://api.mailgun.net', data={}, timeout=1)
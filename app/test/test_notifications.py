@@ -0,0 +1,141 @@
+import json
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+import psycopg
+
+from db.admission import Overloaded
+from db.notifications import AttendanceFeed
+
+
+def make_change(event_id='1', email='a@columbia.edu', checked_in=True):
+    return json.dumps({'event_id': event_id, 'user_email': email,
+                       'is_invited': True, 'is_rsvped': True,
+                       'is_checked_in': checked_in})
+
+
+@patch.object(AttendanceFeed, '_listen', Mock())
+class Test_AttendanceFeed(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.feed = AttendanceFeed(['shard0', 'shard1'], max_subscribers=3,
+                                   queue_size=2, heartbeat_seconds=0.01,
+                                   max_seconds=0.05, reconnect_seconds=0)
+
+    def tearDown(self) -> None:
+        self.feed = None
+
+    def test01_publish(self):
+        """Changes only reach the subscribers of their event and shard"""
+        first = self.feed.subscribe(0, '1')
+        second = self.feed.subscribe(0, '2')
+        other_shard = self.feed.subscribe(1, '1')
+        self.feed.publish(0, make_change('1'))
+        self.assertEqual(make_change('1'), first.changes.get_nowait())
+        self.assertTrue(second.changes.empty())
+        self.assertTrue(other_shard.changes.empty())
+        self.assertEqual([0, 1], self.feed.to_dict()['listening_shards'])
+
+    def test02_publish(self):
+        """Bad payloads are dropped"""
+        subscription = self.feed.subscribe(0, '1')
+        self.feed.publish(0, 'not json')
+        self.feed.publish(0, '{}')
+        self.assertTrue(subscription.changes.empty())
+
+    def test03_lagged(self):
+        """A full queue marks the subscriber lagged"""
+        subscription = self.feed.subscribe(0, '1')
+        for _ in range(3):
+            self.feed.publish(0, make_change())
+        self.assertTrue(subscription.lagged)
+        self.assertEqual(2, subscription.changes.qsize())
+
+    def test04_subscribe(self):
+        """At most max_subscribers per worker"""
+        subscriptions = [self.feed.subscribe(0, '1') for _ in range(3)]
+        with self.assertRaises(Overloaded):
+            self.feed.subscribe(0, '2')
+        self.assertEqual(1, self.feed.to_dict()['rejected'])
+
+        self.feed.unsubscribe(subscriptions[0])
+        self.feed.unsubscribe(subscriptions[0])
+        self.assertEqual(2, self.feed.count)
+        self.feed.subscribe(0, '2')
+
+    def test05_stream(self):
+        """Retry, changes, heartbeats, and unsubscribe at max_seconds"""
+        subscription = self.feed.subscribe(0, '1')
+        self.feed.publish(0, make_change())
+        messages = list(self.feed.stream(subscription))
+        self.assertEqual('retry: 3000\n\n', messages[0])
+        self.assertEqual(f'event: attendance\ndata: {make_change()}\n\n',
+                         messages[1])
+        self.assertIn(': keep-alive\n\n', messages[2:])
+        self.assertEqual(0, self.feed.count)
+
+    def test06_stream(self):
+        """A lagged subscriber is told to resync instead of the backlog"""
+        subscription = self.feed.subscribe(0, '1')
+        for _ in range(3):
+            self.feed.publish(0, make_change())
+        messages = list(self.feed.stream(subscription))
+        self.assertEqual('event: resync\ndata: {}\n\n', messages[1])
+        self.assertNotIn(f'event: attendance\ndata: {make_change()}\n\n',
+                         messages)
+
+    def test07_stream(self):
+        """A client leaving mid-stream unsubscribes"""
+        subscription = self.feed.subscribe(0, '1')
+        stream = self.feed.stream(subscription)
+        next(stream)
+        stream.close()
+        self.assertEqual(0, self.feed.count)
+
+
+class Test_AttendanceFeed_Listen(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.feed = AttendanceFeed(['shard0'], reconnect_seconds=0)
+
+    def tearDown(self) -> None:
+        self.feed = None
+
+    def make_conn(self, notifies):
+        conn = MagicMock()
+        conn.__enter__.return_value = conn
+        conn.notifies = Mock(side_effect=notifies)
+        return conn
+
+    def test01_listen(self):
+        """Listens until the shard has no subscribers"""
+        with patch.object(AttendanceFeed, '_listen', Mock()):
+            subscription = self.feed.subscribe(0, '1')
+
+        def notifies(timeout):
+            yield Mock(payload=make_change())
+            self.feed.unsubscribe(subscription)
+
+        conn = self.make_conn(notifies)
+        with patch('psycopg.connect', Mock(return_value=conn)) as connect:
+            self.feed._listen(0)
+        connect.assert_called_once_with('shard0', autocommit=True)
+        conn.execute.assert_called_once_with('LISTEN attendance_changes')
+        self.assertEqual(make_change(), subscription.changes.get_nowait())
+        self.assertEqual([], self.feed.to_dict()['listening_shards'])
+
+    def test02_listen(self):
+        """Subscribers resync after the listener reconnects"""
+        with patch.object(AttendanceFeed, '_listen', Mock()):
+            subscription = self.feed.subscribe(0, '1')
+
+        def notifies(timeout):
+            self.feed.unsubscribe(subscription)
+            return []
+
+        conn = self.make_conn(notifies)
+        connect = Mock(side_effect=[psycopg.OperationalError('down'), conn])
+        with patch('psycopg.connect', connect):
+            self.feed._listen(0)
+        self.assertEqual(2, connect.call_count)
+        self.assertTrue(subscription.lagged)
@@ -0,0 +1,76 @@
+import os
+import re
+import unittest
+
+from db import queries
+
+DB_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'db')
+
+
+def read(*path):
+    with open(os.path.join(DB_DIR, *path)) as f:
+        return f.read()
+
+
+def function(sql, name):
+    '''Returns the CREATE FUNCTION statement of name.'''
+    match = re.search(r'CREATE OR REPLACE FUNCTION %s\(\).*?\$\$ LANGUAGE'
+                      % name, sql, re.S)
+    return match.group(0)
+
+
+def columns(sql):
+    '''Returns the columns of every CREATE TABLE, by lowercase name.'''
+    tables = {}
+    for name, body in re.findall(r'CREATE TABLE (\w+) \((.*?)\n\);', sql,
+                                 re.S):
+        tables[name.lower()] = {
+            line.split()[0].lower() for line in body.splitlines()
+            if line.strip() and not re.match(r'\s*(PRIMARY|FOREIGN|--)',
+                                             line)}
+    return tables
+
+
+# The image of the app only has app/; the schema is checked from the repo
+@unittest.skipUnless(os.path.isdir(DB_DIR), 'db/ is not available')
+class Test_Schema(unittest.TestCase):
+
+    def test01_init_sql(self):
+        """Dev and prod databases are created alike"""
+        self.assertEqual(read('dev', 'init.sql'), read('prod', 'init.sql'))
+
+    def test02_roster_version(self):
+        """An update that only moves checked_in_at bumps the roster
+        version (EventStats.updated_at) of its event"""
+        stats = function(read('dev', 'init.sql'), 'update_event_stats')
+        update = stats[stats.index("TG_OP = 'UPDATE'"):stats.index('ELSE')]
+        self.assertIn('updated_at = current_timestamp', update)
+        # Every event of the statement, not only those whose counters move
+        where = update[update.rindex('WHERE'):]
+        self.assertEqual('WHERE stats.event_id = delta.event_id;',
+                         ' '.join(where.split()))
+
+        # Databases created before get the same function
+        self.assertEqual(stats, function(
+            read('migrations', '005_roster_version.sql'),
+            'update_event_stats'))
+
+    def test03_join_using_columns(self):
+        """Columns that both tables of a JOIN ... USING have (other than
+        the USING ones) are qualified, or Postgres rejects the query as
+        ambiguous"""
+        tables = columns(read('dev', 'init.sql'))
+        joins = 0
+        for query in queries._by_name.values():
+            for left, right, using in re.findall(
+                    r'FROM (\w+) (?:LEFT )?JOIN (\w+) USING \((\w+)\)',
+                    query.sql):
+                joins += 1
+                shared = (tables[left.lower()] & tables[right.lower()]
+                          - {using.lower()})
+                for column in shared:
+                    self.assertNotRegex(
+                        query.sql, r'(?<![\w.])%s\b' % column,
+                        f'{query.name}: {column} is ambiguous')
+        # ROSTER_VERSION and EVENT_STATS
+        self.assertGreaterEqual(joins, 2)
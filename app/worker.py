@@ -0,0 +1,22 @@
+import logging
+import signal
+
+import app
+from db.jobs import JobQueue
+from services.job_worker import JobWorker
+
+
+def main():
+    # Same configuration (pools, shards) as the web workers
+    logging.basicConfig(level=logging.INFO)
+    ctx = app.Context()
+    worker = JobWorker.from_env(ctx.db, ctx.jobs, {
+        JobQueue.INVITE_EMAILS: ctx.attendance.send_invitations,
+    })
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
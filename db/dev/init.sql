@@ -56,13 +56,177 @@ CREATE TABLE Attendance (
     is_checked_in BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP WITH TIME ZONE  NOT NULL  DEFAULT current_timestamp,
     updated_at TIMESTAMP WITH TIME ZONE  NOT NULL  DEFAULT current_timestamp,
+    checked_in_at TIMESTAMP WITH TIME ZONE,  -- last change of is_checked_in
     PRIMARY KEY (event_id, user_email),
     FOREIGN KEY (event_id) REFERENCES Events
 );
 
+-- rsvp, unrsvp and check_in look attendances up by personal code
+CREATE UNIQUE INDEX attendance_personal_code ON Attendance (event_id, personal_code);
+
+-- Per-event attendance counters, kept in sync by the attendance_stats
+-- triggers below
+CREATE TABLE EventStats (
+    event_id VARCHAR(255) NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    invited INTEGER NOT NULL DEFAULT 0,
+    rsvped INTEGER NOT NULL DEFAULT 0,
+    checked_in INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE  NOT NULL  DEFAULT current_timestamp,
+    PRIMARY KEY (event_id),
+    FOREIGN KEY (event_id) REFERENCES Events
+);
+
+-- Job queue (app/db/jobs.py), consumed by app/worker.py
+CREATE TABLE Jobs (
+    job_id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(64) NOT NULL,
+    event_id VARCHAR(255),
+    payload JSONB NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'queued',  -- queued, running, done, failed
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_at TIMESTAMP WITH TIME ZONE  NOT NULL  DEFAULT current_timestamp,
+    locked_at TIMESTAMP WITH TIME ZONE,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE  NOT NULL  DEFAULT current_timestamp,
+    FOREIGN KEY (event_id) REFERENCES Events
+);
+CREATE INDEX jobs_claimable ON Jobs (run_at) WHERE status IN ('queued', 'running');
+
 -- Updated_at trigger
 CREATE TRIGGER users_updated_at
     BEFORE UPDATE
     ON Users
     FOR EACH ROW
-    EXECUTE PROCEDURE update_updated_at_column();
\ No newline at end of file
+    EXECUTE PROCEDURE update_updated_at_column();
+
+-- Attendance counters: one statement-level trigger per operation, so a bulk
+-- invite updates EventStats once per statement instead of once per row
+CREATE OR REPLACE FUNCTION update_event_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO EventStats AS stats
+            (event_id, total, invited, rsvped, checked_in)
+        SELECT event_id, count(*),
+               count(*) FILTER (WHERE is_invited),
+               count(*) FILTER (WHERE is_rsvped),
+               count(*) FILTER (WHERE is_checked_in)
+        FROM new_rows GROUP BY event_id
+        ON CONFLICT (event_id) DO UPDATE SET
+            total = stats.total + EXCLUDED.total,
+            invited = stats.invited + EXCLUDED.invited,
+            rsvped = stats.rsvped + EXCLUDED.rsvped,
+            checked_in = stats.checked_in + EXCLUDED.checked_in,
+            updated_at = current_timestamp;
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Every updated event gets a new updated_at, its roster version,
+        -- even when the counters don't move: a sync that only moves
+        -- checked_in_at, or an rsvp and an unrsvp in one statement
+        UPDATE EventStats AS stats SET
+            invited = stats.invited + delta.invited,
+            rsvped = stats.rsvped + delta.rsvped,
+            checked_in = stats.checked_in + delta.checked_in,
+            updated_at = current_timestamp
+        FROM (
+            SELECT event_id, sum(invited) AS invited, sum(rsvped) AS rsvped,
+                   sum(checked_in) AS checked_in
+            FROM (
+                SELECT event_id, is_invited::int AS invited,
+                       is_rsvped::int AS rsvped,
+                       is_checked_in::int AS checked_in
+                FROM new_rows
+                UNION ALL
+                SELECT event_id, -is_invited::int, -is_rsvped::int,
+                       -is_checked_in::int
+                FROM old_rows
+            ) AS changes
+            GROUP BY event_id
+        ) AS delta
+        WHERE stats.event_id = delta.event_id;
+    ELSE
+        UPDATE EventStats AS stats SET
+            total = stats.total - delta.total,
+            invited = stats.invited - delta.invited,
+            rsvped = stats.rsvped - delta.rsvped,
+            checked_in = stats.checked_in - delta.checked_in,
+            updated_at = current_timestamp
+        FROM (
+            SELECT event_id, count(*) AS total,
+                   count(*) FILTER (WHERE is_invited) AS invited,
+                   count(*) FILTER (WHERE is_rsvped) AS rsvped,
+                   count(*) FILTER (WHERE is_checked_in) AS checked_in
+            FROM old_rows GROUP BY event_id
+        ) AS delta
+        WHERE stats.event_id = delta.event_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER attendance_stats_insert
+    AFTER INSERT
+    ON Attendance
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_event_stats();
+
+CREATE TRIGGER attendance_stats_update
+    AFTER UPDATE
+    ON Attendance
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_event_stats();
+
+CREATE TRIGGER attendance_stats_delete
+    AFTER DELETE
+    ON Attendance
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_event_stats();
+
+-- Publishes each inserted attendance, and each whose flags changed, on the
+-- attendance_changes channel for the live dashboards
+-- (GET /events/<event_id>/stream). NOTIFY is delivered on commit, so
+-- listeners never see rolled back writes.
+CREATE OR REPLACE FUNCTION notify_attendance_changes()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('attendance_changes', json_build_object(
+                    'event_id', event_id, 'user_email', user_email,
+                    'is_invited', is_invited, 'is_rsvped', is_rsvped,
+                    'is_checked_in', is_checked_in)::text)
+        FROM new_rows;
+    ELSE
+        PERFORM pg_notify('attendance_changes', json_build_object(
+                    'event_id', n.event_id, 'user_email', n.user_email,
+                    'is_invited', n.is_invited, 'is_rsvped', n.is_rsvped,
+                    'is_checked_in', n.is_checked_in)::text)
+        FROM new_rows AS n
+        JOIN old_rows AS o
+          ON o.event_id = n.event_id AND o.user_email = n.user_email
+        WHERE (n.is_invited, n.is_rsvped, n.is_checked_in)
+              IS DISTINCT FROM (o.is_invited, o.is_rsvped, o.is_checked_in);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER attendance_notify_insert
+    AFTER INSERT
+    ON Attendance
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE notify_attendance_changes();
+
+CREATE TRIGGER attendance_notify_update
+    AFTER UPDATE
+    ON Attendance
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE notify_attendance_changes();
@@ -0,0 +1,113 @@
+-- Adds the per-event attendance counters (EventStats) to a database
+-- created before them. Run once, e.g.:
+--   psql postgresql://postgres@localhost:5432/aapi -f db/migrations/001_event_stats.sql
+-- then check them with `python rebuild_stats.py` (app/).
+BEGIN;
+
+-- Writes wait until the counters are backfilled
+LOCK TABLE Attendance IN SHARE MODE;
+
+-- Per-event attendance counters, kept in sync by the attendance_stats
+-- triggers below
+CREATE TABLE EventStats (
+    event_id VARCHAR(255) NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    invited INTEGER NOT NULL DEFAULT 0,
+    rsvped INTEGER NOT NULL DEFAULT 0,
+    checked_in INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE  NOT NULL  DEFAULT current_timestamp,
+    PRIMARY KEY (event_id),
+    FOREIGN KEY (event_id) REFERENCES Events
+);
+
+-- Attendance counters: one statement-level trigger per operation, so a bulk
+-- invite updates EventStats once per statement instead of once per row
+CREATE OR REPLACE FUNCTION update_event_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO EventStats AS stats
+            (event_id, total, invited, rsvped, checked_in)
+        SELECT event_id, count(*),
+               count(*) FILTER (WHERE is_invited),
+               count(*) FILTER (WHERE is_rsvped),
+               count(*) FILTER (WHERE is_checked_in)
+        FROM new_rows GROUP BY event_id
+        ON CONFLICT (event_id) DO UPDATE SET
+            total = stats.total + EXCLUDED.total,
+            invited = stats.invited + EXCLUDED.invited,
+            rsvped = stats.rsvped + EXCLUDED.rsvped,
+            checked_in = stats.checked_in + EXCLUDED.checked_in,
+            updated_at = current_timestamp;
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE EventStats AS stats SET
+            invited = stats.invited + delta.invited,
+            rsvped = stats.rsvped + delta.rsvped,
+            checked_in = stats.checked_in + delta.checked_in,
+            updated_at = current_timestamp
+        FROM (
+            SELECT event_id, sum(invited) AS invited, sum(rsvped) AS rsvped,
+                   sum(checked_in) AS checked_in
+            FROM (
+                SELECT event_id, is_invited::int AS invited,
+                       is_rsvped::int AS rsvped,
+                       is_checked_in::int AS checked_in
+                FROM new_rows
+                UNION ALL
+                SELECT event_id, -is_invited::int, -is_rsvped::int,
+                       -is_checked_in::int
+                FROM old_rows
+            ) AS changes
+            GROUP BY event_id
+        ) AS delta
+        WHERE stats.event_id = delta.event_id
+          AND (delta.invited, delta.rsvped, delta.checked_in) <> (0, 0, 0);
+    ELSE
+        UPDATE EventStats AS stats SET
+            total = stats.total - delta.total,
+            invited = stats.invited - delta.invited,
+            rsvped = stats.rsvped - delta.rsvped,
+            checked_in = stats.checked_in - delta.checked_in,
+            updated_at = current_timestamp
+        FROM (
+            SELECT event_id, count(*) AS total,
+                   count(*) FILTER (WHERE is_invited) AS invited,
+                   count(*) FILTER (WHERE is_rsvped) AS rsvped,
+                   count(*) FILTER (WHERE is_checked_in) AS checked_in
+            FROM old_rows GROUP BY event_id
+        ) AS delta
+        WHERE stats.event_id = delta.event_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER attendance_stats_insert
+    AFTER INSERT
+    ON Attendance
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_event_stats();
+
+CREATE TRIGGER attendance_stats_update
+    AFTER UPDATE
+    ON Attendance
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_event_stats();
+
+CREATE TRIGGER attendance_stats_delete
+    AFTER DELETE
+    ON Attendance
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_event_stats();
+
+INSERT INTO EventStats (event_id, total, invited, rsvped, checked_in)
+SELECT event_id, count(*),
+       count(*) FILTER (WHERE is_invited),
+       count(*) FILTER (WHERE is_rsvped),
+       count(*) FILTER (WHERE is_checked_in)
+FROM Attendance GROUP BY event_id;
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- Adds the last-writer-wins clock of offline check-in sync
+-- (POST /events/<event_id>/roster/sync) to a database created before it:
+--   psql postgresql://postgres@localhost:5432/aapi -f db/migrations/002_checked_in_at.sql
+-- Apply before deploying the app version that uses it. The app's prepared
+-- statements list their columns, so it can run while the app serves; an
+-- app version with RETURNING * in CHECK_IN/RSVP/UNRSVP fails with "cached
+-- plan must not change result type" until its workers are restarted.
+ALTER TABLE Attendance ADD COLUMN IF NOT EXISTS checked_in_at TIMESTAMP WITH TIME ZONE;
@@ -0,0 +1,50 @@
+-- Adds the NOTIFY triggers of the live attendance stream
+-- (GET /events/<event_id>/stream) to a database created before them:
+--   psql postgresql://postgres@localhost:5432/aapi -f db/migrations/003_attendance_notify.sql
+-- Until it runs, streams connect but stay silent.
+BEGIN;
+-- Publishes each inserted attendance, and each whose flags changed, on the
+-- attendance_changes channel for the live dashboards
+-- (GET /events/<event_id>/stream). NOTIFY is delivered on commit, so
+-- listeners never see rolled back writes.
+CREATE OR REPLACE FUNCTION notify_attendance_changes()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('attendance_changes', json_build_object(
+                    'event_id', event_id, 'user_email', user_email,
+                    'is_invited', is_invited, 'is_rsvped', is_rsvped,
+                    'is_checked_in', is_checked_in)::text)
+        FROM new_rows;
+    ELSE
+        PERFORM pg_notify('attendance_changes', json_build_object(
+                    'event_id', n.event_id, 'user_email', n.user_email,
+                    'is_invited', n.is_invited, 'is_rsvped', n.is_rsvped,
+                    'is_checked_in', n.is_checked_in)::text)
+        FROM new_rows AS n
+        JOIN old_rows AS o
+          ON o.event_id = n.event_id AND o.user_email = n.user_email
+        WHERE (n.is_invited, n.is_rsvped, n.is_checked_in)
+              IS DISTINCT FROM (o.is_invited, o.is_rsvped, o.is_checked_in);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS attendance_notify_insert ON Attendance;
+CREATE TRIGGER attendance_notify_insert
+    AFTER INSERT
+    ON Attendance
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE notify_attendance_changes();
+
+DROP TRIGGER IF EXISTS attendance_notify_update ON Attendance;
+CREATE TRIGGER attendance_notify_update
+    AFTER UPDATE
+    ON Attendance
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE notify_attendance_changes();
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- Indexes the personal codes of a database created before the index, on
+-- every shard. Codes already sent keep working: existing rows keep their
+-- codes, only new invitations get the short HMAC codes. Built
+-- CONCURRENTLY so invites and check-ins go on meanwhile, which can't run
+-- in a transaction:
+--   psql postgresql://postgres@localhost:5432/aapi -f db/migrations/004_personal_code_index.sql
+-- If the build fails it leaves an invalid index; drop it and run again:
+--   DROP INDEX CONCURRENTLY attendance_personal_code;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS attendance_personal_code
+    ON Attendance (event_id, personal_code);
@@ -0,0 +1,66 @@
+-- Makes every update of an event's attendances bump EventStats.updated_at,
+-- the roster version of GET /events/<event_id>/roster. Before, updates
+-- that left the counters unchanged (a sync moving only checked_in_at)
+-- kept the version, and devices were answered 304 with a stale roster.
+--   psql postgresql://postgres@localhost:5432/aapi -f db/migrations/005_roster_version.sql
+CREATE OR REPLACE FUNCTION update_event_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO EventStats AS stats
+            (event_id, total, invited, rsvped, checked_in)
+        SELECT event_id, count(*),
+               count(*) FILTER (WHERE is_invited),
+               count(*) FILTER (WHERE is_rsvped),
+               count(*) FILTER (WHERE is_checked_in)
+        FROM new_rows GROUP BY event_id
+        ON CONFLICT (event_id) DO UPDATE SET
+            total = stats.total + EXCLUDED.total,
+            invited = stats.invited + EXCLUDED.invited,
+            rsvped = stats.rsvped + EXCLUDED.rsvped,
+            checked_in = stats.checked_in + EXCLUDED.checked_in,
+            updated_at = current_timestamp;
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Every updated event gets a new updated_at, its roster version,
+        -- even when the counters don't move: a sync that only moves
+        -- checked_in_at, or an rsvp and an unrsvp in one statement
+        UPDATE EventStats AS stats SET
+            invited = stats.invited + delta.invited,
+            rsvped = stats.rsvped + delta.rsvped,
+            checked_in = stats.checked_in + delta.checked_in,
+            updated_at = current_timestamp
+        FROM (
+            SELECT event_id, sum(invited) AS invited, sum(rsvped) AS rsvped,
+                   sum(checked_in) AS checked_in
+            FROM (
+                SELECT event_id, is_invited::int AS invited,
+                       is_rsvped::int AS rsvped,
+                       is_checked_in::int AS checked_in
+                FROM new_rows
+                UNION ALL
+                SELECT event_id, -is_invited::int, -is_rsvped::int,
+                       -is_checked_in::int
+                FROM old_rows
+            ) AS changes
+            GROUP BY event_id
+        ) AS delta
+        WHERE stats.event_id = delta.event_id;
+    ELSE
+        UPDATE EventStats AS stats SET
+            total = stats.total - delta.total,
+            invited = stats.invited - delta.invited,
+            rsvped = stats.rsvped - delta.rsvped,
+            checked_in = stats.checked_in - delta.checked_in,
+            updated_at = current_timestamp
+        FROM (
+            SELECT event_id, count(*) AS total,
+                   count(*) FILTER (WHERE is_invited) AS invited,
+                   count(*) FILTER (WHERE is_rsvped) AS rsvped,
+                   count(*) FILTER (WHERE is_checked_in) AS checked_in
+            FROM old_rows GROUP BY event_id
+        ) AS delta
+        WHERE stats.event_id = delta.event_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
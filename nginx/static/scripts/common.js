@@ -50,6 +50,32 @@ const apiGetAttendees = (eventID, success, error) => {
     });
 }
 
+// One page of attendees; page.next_cursor fetches the next one (null: last)
+const apiGetAttendeesPage = (eventID, cursor, limit, success, error) => {
+    console.log("--> apiGetAttendeesPage");
+    const params = { limit: limit };
+    if (cursor) {
+        params.cursor = cursor;
+    }
+    $.ajax({
+        url: `${BASE_ENDPOINT}/events/${eventID}/attendances?${$.param(params)}`,
+        success: logSuccess(success),
+        error: logError(error),
+    });
+}
+
+// Live attendee changes (Server-Sent Events). onChange gets each changed
+// attendee; onResync means changes were missed and the list must be
+// reloaded. The browser reconnects by itself; call close() to stop.
+const apiStreamAttendees = (eventID, onChange, onResync) => {
+    console.log("--> apiStreamAttendees");
+    const source = new EventSource(`${BASE_ENDPOINT}/events/${eventID}/stream`);
+    source.addEventListener("attendance",
+                            message => onChange(JSON.parse(message.data)));
+    source.addEventListener("resync", () => onResync());
+    return source;
+}
+
 const apiSendInvitations = (eventID, emails, success, error) => {
     console.log("--> apiSendInvitations");
     $.ajax({